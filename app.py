@@ -3,12 +3,28 @@ import os
 import json
 import io
 import base64
+import time
+import threading
 from datetime import datetime
 sys.path.append(os.path.abspath(os.path.dirname(__file__)))
-from flask import Flask, request, jsonify, send_from_directory, send_file
+from flask import Flask, request, jsonify, send_from_directory, send_file, Response, stream_with_context, g
 from flask_cors import CORS
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.middleware.proxy_fix import ProxyFix
 import requests
 from dotenv import load_dotenv
+from funçoes import http_cliente, imagens, estaticos, miniaturas, metricas, preparo_imagens, provedores
+from funçoes.cache_imagens import CacheImagens, chave_cache
+from funçoes.cache_respostas import normalizar_pergunta
+from funçoes.coalescencia import Coalescedor
+from funçoes.conversas import Conversas
+from funçoes.ia import cache_respostas, responder_cohere_stream, responder_cohere_lote, LOTE_MAXIMO
+from funçoes.jobs import FilaJobs, FilaCheia, ESTADOS_FINAIS
+from funçoes.saude_modelos import saude_modelos
+from funçoes.aquecimento import AquecedorModelos
+from funçoes.admissao import Admissao, ADMISSAO_FILA_MAXIMA, ADMISSAO_LATENCIA_MAXIMA
+from funçoes.prazos import (Prazo, PrazoEsgotado, HEADER_PRAZO, PRAZO_PERGUNTAR, PRAZO_PERGUNTAR_STREAM,
+                            PRAZO_PERGUNTAR_LOTE, PRAZO_IMAGEM)
 
 # Carregar variáveis de ambiente do arquivo .env, se existir
 load_dotenv()
@@ -16,18 +32,94 @@ load_dotenv()
 app = Flask(__name__, static_folder='pag')
 CORS(app)
 
+# Maior corpo aceito: o upload de /api/editar-imagem mais a folga do multipart. O Werkzeug
+# aplica o limite enquanto lê o corpo, inclusive sem Content-Length (413)
+app.config['MAX_CONTENT_LENGTH'] = int(preparo_imagens.EDICAO_MAX_MB * 1024 * 1024) + 64 * 1024
+
+# Quantos proxies na frente do app acrescentam o IP do cliente ao X-Forwarded-For
+# (1 para o roteador do Procfile; 0 quando o app recebe as conexões direto). Só
+# essas últimas entradas do header são confiáveis: as anteriores vêm do cliente.
+PROXIES_CONFIAVEIS = int(os.environ.get('PROXIES_CONFIAVEIS', 1))
+if PROXIES_CONFIAVEIS > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXIES_CONFIAVEIS)
+
+# Duração de cada requisição, por rota (registrado antes dos outros hooks para medir tudo)
+@app.before_request
+def iniciar_medicao():
+    g.inicio = time.perf_counter()
+
+@app.after_request
+def registrar_medicao(response):
+    if 'inicio' in g:
+        rota = request.url_rule.rule if request.url_rule else 'sem_rota'
+        metricas.observar('atomai_rota_segundos', time.perf_counter() - g.inicio, rota=rota,
+                          metodo=request.method, status=response.status_code)
+    return response
+
+# Diretório com as páginas e arquivos estáticos
+PAG_DIR = os.path.join(os.path.dirname(__file__), "pag")
+
 # Diretório para salvar imagens geradas
-OUTPUT_DIR = os.path.join(os.path.dirname(__file__), "pag", "imagens_geradas")
+OUTPUT_DIR = os.environ.get('IMAGENS_DIR') or os.path.join(os.path.dirname(__file__), "pag", "imagens_geradas")
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
+# Diretório para dados internos do servidor (índices de cache etc.), fora da pasta pública
+DADOS_DIR = os.environ.get('DADOS_DIR') or os.path.join(os.path.dirname(__file__), "dados")
+
+# Cache das imagens geradas, com arquivos nomeados pelo hash do conteúdo
+cache_imagens = CacheImagens(OUTPUT_DIR, os.path.join(DADOS_DIR, "cache_imagens.jsonl"))
+cache_imagens.iniciar()
+
+# Imagens de entrada da edição (image-to-image) já reduzidas e em JPEG, pelo hash do arquivo enviado
+cache_entradas = CacheImagens(os.path.join(DADOS_DIR, "entradas"),
+                              tamanho_maximo=int(preparo_imagens.EDICAO_CACHE_MB * 1024 * 1024), prefixo='entrada_')
+cache_entradas.iniciar()
+
+# Perguntas iguais feitas ao mesmo tempo (em qualquer worker) compartilham uma única chamada à IA
+coalescedor = Coalescedor(os.path.join(DADOS_DIR, "coalescencia.sqlite3"))
+
+# Histórico de cada conversa, enviado à IA dentro de um orçamento de tokens
+conversas = Conversas(os.path.join(DADOS_DIR, "conversas.sqlite3"))
+
 # Pegar chaves de API das variáveis de ambiente (com fallback para valores vazios)
 COHERE_API_KEY = os.environ.get('COHERE_API_KEY', '')
 HUGGINGFACE_API_TOKEN = os.environ.get('HUGGINGFACE_API_TOKEN', '')
+# Token exigido para ligar o perfil e ver as pilhas de chamadas (vazio desliga essas rotas)
+PERFIL_TOKEN = os.environ.get('PERFIL_TOKEN', '')
+
+# Métricas somadas entre os workers, com as cópias de cada processo em dados/metricas
+metricas.registro.configurar(os.path.join(DADOS_DIR, "metricas"))
+
+def _prazo(maximo):
+    """Prazo deste pedido: o máximo da rota, ou menos se o cliente pediu (header X-Prazo)"""
+    return Prazo.do_pedido(maximo, request.headers.get(HEADER_PRAZO))
+
+def _prazo_esgotado(erro):
+    """Resposta 504 para um pedido cujo prazo acabou antes da resposta ficar pronta"""
+    rota = request.url_rule.rule if request.url_rule else 'sem_rota'
+    metricas.contar('atomai_prazos_esgotados_total', rota=rota)
+    app.logger.warning(f'Prazo esgotado em {rota}')
+    return jsonify({'erro': str(erro), 'resposta': 'A IA demorou demais para responder. Tente novamente.',
+                    'prazo_esgotado': True}), 504
+
+# Prazo esgotado fora dos blocos try das rotas
+app.register_error_handler(PrazoEsgotado, _prazo_esgotado)
+
+def _chamar_cohere(pergunta, historico=None, prazo=None):
+    """
+    Chamada direta ao provedor de chat (a Cohere; o local com PROVEDORES_OFFLINE=1);
+    retorna o status, o texto da resposta e se ela veio de um provedor de reserva
+
+    Lança:
+    - PrazoEsgotado: se a Cohere não respondeu dentro do prazo
+    """
+    return provedores.responder(pergunta, COHERE_API_KEY, historico, prazo or Prazo(PRAZO_PERGUNTAR))
 
 @app.route('/api/perguntar', methods=['POST'])
 def perguntar():
     try:
-        data = request.get_json()
+        with metricas.etapa('ler_json'):
+            data = request.get_json()
         if not data:
             return jsonify({'erro': 'Dados JSON não recebidos.', 'resposta': 'Erro ao processar sua pergunta.'}), 400
             
@@ -35,43 +127,396 @@ def perguntar():
         if not pergunta:
             return jsonify({'erro': 'Pergunta não enviada.', 'resposta': 'Por favor, envie uma pergunta.'}), 400
         
-        # Chamada direta à API da Cohere
-        url = 'https://api.cohere.ai/v1/chat'
-        headers = {
-            'Authorization': f'Bearer {COHERE_API_KEY}',
-            'Content-Type': 'application/json'
-        }
-        payload = {
-            'message': pergunta,
-            'model': 'command-r-plus',
-            'chat_history': []
-        }
+        prazo = _prazo(PRAZO_PERGUNTAR)
+        sessao = _sessao(data)
+        historico = conversas.historico(sessao)
         
-        response = requests.post(url, headers=headers, json=payload)
+        if historico:
+            # Com histórico a resposta depende da conversa: nada de cache nem de coalescência
+            resultado = _chamar_cohere(pergunta, historico, prazo)
+        else:
+            # Pergunta repetida: responder direto do cache, sem chamar a API
+            resposta = cache_respostas.buscar(pergunta)
+            if resposta is not None:
+                conversas.registrar(sessao, pergunta, resposta)
+                return jsonify({'resposta': resposta, 'cache': True, 'sessao': sessao})
+            
+            # Perguntas iguais simultâneas esperam a mesma chamada à API. Ela roda com o prazo
+            # máximo da rota, e cada pedido só a espera até o próprio prazo (X-Prazo)
+            resultado = coalescedor.executar(f'perguntar:{normalizar_pergunta(pergunta)}',
+                                             lambda: _chamar_cohere(pergunta, prazo=Prazo(PRAZO_PERGUNTAR)), prazo)
         
-        if response.status_code == 200:
-            data = response.json()
-            return jsonify({'resposta': data.get('text', 'Sem resposta da IA.')})
+        if resultado['status'] == 200:
+            resposta = resultado['texto']
+            if resposta:
+                if not historico and not resultado['reserva']:
+                    cache_respostas.guardar(pergunta, resposta)
+                conversas.registrar(sessao, pergunta, resposta)
+            return jsonify({'resposta': resposta or 'Sem resposta da IA.', 'sessao': sessao})
         else:
-            app.logger.error(f'Erro na API Cohere: {response.status_code} - {response.text}')
-            return jsonify({'resposta': f'Erro ao consultar a IA: {response.status_code}'}), 500
+            return jsonify({'resposta': f'Erro ao consultar a IA: {resultado["status"]}', 'sessao': sessao}), 500
             
+    except PrazoEsgotado as e:
+        return _prazo_esgotado(e)
     except Exception as e:
         app.logger.error(f'Erro no servidor: {str(e)}')
         return jsonify({'resposta': f'Erro ao processar sua pergunta: {str(e)}'}), 500
 
+def _sessao(data):
+    """Sessão de conversa enviada pelo cliente, ou uma nova se não veio (ou não é válida)"""
+    sessao = data.get('sessao')
+    return sessao if Conversas.sessao_valida(sessao) else Conversas.nova_sessao()
+
+# Versão em streaming de /api/perguntar: envia os pedaços da resposta
+# como NDJSON (um objeto JSON por linha) à medida que a IA os gera
+@app.route('/api/perguntar/stream', methods=['POST'])
+def perguntar_stream():
+    with metricas.etapa('ler_json'):
+        data = request.get_json(silent=True)
+    if not data:
+        return jsonify({'erro': 'Dados JSON não recebidos.', 'resposta': 'Erro ao processar sua pergunta.'}), 400
+    
+    pergunta = data.get('pergunta')
+    if not pergunta:
+        return jsonify({'erro': 'Pergunta não enviada.', 'resposta': 'Por favor, envie uma pergunta.'}), 400
+    
+    prazo = _prazo(PRAZO_PERGUNTAR_STREAM)
+    sessao = _sessao(data)
+    historico = conversas.historico(sessao)
+    
+    def gerar():
+        try:
+            partes = []
+            for texto in responder_cohere_stream(pergunta, COHERE_API_KEY, historico, prazo):
+                partes.append(texto)
+                yield json.dumps({'texto': texto}) + '\n'
+            resposta = ''.join(partes)
+            if resposta and not resposta.startswith('Erro: '):
+                conversas.registrar(sessao, pergunta, resposta)
+            yield json.dumps({'fim': True, 'sessao': sessao}) + '\n'
+        except PrazoEsgotado as e:
+            # O status 200 já foi enviado: o fim do prazo vai como um evento de erro
+            metricas.contar('atomai_prazos_esgotados_total', rota='/api/perguntar/stream')
+            yield json.dumps({'erro': str(e), 'prazo_esgotado': True, 'sessao': sessao}) + '\n'
+        except Exception as e:
+            app.logger.error(f'Erro no streaming da resposta: {str(e)}')
+            yield json.dumps({'erro': f'Erro ao processar sua pergunta: {str(e)}'}) + '\n'
+    
+    return Response(stream_with_context(gerar()), mimetype='application/x-ndjson',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Várias perguntas de uma vez, sem conversa: cada resposta vai como uma linha
+# NDJSON assim que fica pronta (fora de ordem; 'indices' diz a que posições
+# do pedido ela corresponde), e uma pergunta que falha não derruba o lote
+@app.route('/api/perguntar/lote', methods=['POST'])
+def perguntar_lote():
+    with metricas.etapa('ler_json'):
+        data = request.get_json(silent=True)
+    perguntas = data.get('perguntas') if isinstance(data, dict) else None
+    if not isinstance(perguntas, list) or not perguntas:
+        return jsonify({'erro': 'Envie "perguntas" como uma lista não vazia.'}), 400
+    if len(perguntas) > LOTE_MAXIMO:
+        return jsonify({'erro': f'No máximo {LOTE_MAXIMO} perguntas por lote.'}), 400
+    if not all(isinstance(pergunta, str) and pergunta.strip() for pergunta in perguntas):
+        return jsonify({'erro': 'Cada pergunta precisa ser um texto não vazio.'}), 400
+    
+    prazo = _prazo(PRAZO_PERGUNTAR_LOTE)
+    
+    def gerar():
+        inicio = time.monotonic()
+        unicas = len({normalizar_pergunta(pergunta) for pergunta in perguntas})
+        yield json.dumps({'total': len(perguntas), 'unicas': unicas}) + '\n'
+        sucesso = falhas = 0
+        try:
+            for item in responder_cohere_lote(perguntas, COHERE_API_KEY, prazo=prazo):
+                if 'erro' in item:
+                    falhas += 1
+                else:
+                    sucesso += 1
+                yield json.dumps(item) + '\n'
+        except Exception as e:
+            app.logger.error(f'Erro no lote de perguntas: {str(e)}')
+            yield json.dumps({'erro': f'Erro ao processar o lote: {str(e)}'}) + '\n'
+        yield json.dumps({'fim': True, 'sucesso': sucesso, 'falhas': falhas,
+                          'segundos': round(time.monotonic() - inicio, 3)}) + '\n'
+    
+    return Response(stream_with_context(gerar()), mimetype='application/x-ndjson',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/')
 def index():
-    return send_from_directory('pag', 'index.html')
+    return estaticos.servir_arquivo(PAG_DIR, 'index.html')
 
 @app.route('/<path:path>')
 def serve_static(path):
-    return send_from_directory('pag', path)
+    return estaticos.servir_arquivo(PAG_DIR, path)
+
+def _chave_cliente():
+    """Identifica o cliente pelo IP (atrás de proxy, o que o ProxyFix tirou do X-Forwarded-For)"""
+    return request.remote_addr or 'desconhecido'
+
+def _resposta_imagem(filename, **extras):
+    """JSON de uma imagem gerada: URL do original e srcset com as miniaturas"""
+    url = f"/imagens_geradas/{filename}"
+    return dict({'imagem_url': url, 'imagem_srcset': miniaturas.srcset(url)}, **extras)
+
+def _nome_publico(img_path):
+    """Caminho da imagem relativo a OUTPUT_DIR, como aparece na URL (ex.: 'ab/img_ab12....png')"""
+    return os.path.relpath(img_path, OUTPUT_DIR).replace(os.sep, '/')
+
+def _buscar_imagem_em_cache(prompt_melhorado, parametros):
+    with metricas.etapa('buscar_cache_imagem'):
+        em_cache = cache_imagens.buscar(prompt_melhorado, provedores.registro.modelos(provedores.TEXTO_IMAGEM),
+                                        parametros["num_inference_steps"], parametros["guidance_scale"],
+                                        parametros["negative_prompt"])
+    if em_cache:
+        modelo, img_path = em_cache
+        metricas.contar('atomai_imagens_total', resultado='cache')
+        app.logger.info(f'Imagem encontrada no cache (modelo {modelo})')
+        return _resposta_imagem(_nome_publico(img_path), cache=True)
+    return None
+
+def _prazo_do_job(dados):
+    """Prazo de um job de imagem, contado desde o pedido (jobs antigos, sem prazo, ganham PRAZO_IMAGEM)"""
+    return Prazo.ate(dados['prazo']) if 'prazo' in dados else Prazo(PRAZO_IMAGEM)
+
+def _iniciar_rascunho(provedor, prompt_melhorado, prazo, progresso):
+    """
+    Gera em segundo plano um rascunho rápido (poucos passos, no modelo mais rápido
+    e saudável do provedor) e o publica como resultado parcial do job
+
+    Retorna:
+    - função sem argumentos que encerra o rascunho (chamada quando a imagem final
+      fica pronta ou falha): abandona a geração, impede que ele seja publicado
+      depois e devolve o rascunho já publicado, ou None
+    """
+    payload = imagens.montar_payload_rascunho(prompt_melhorado)
+    parametros = payload["parameters"]
+    # O lado entra na chave: rascunhos de tamanhos diferentes são imagens diferentes
+    variante = f'lado:{imagens.RASCUNHO_LADO}' if imagens.RASCUNHO_LADO else None
+    cancelado = threading.Event()
+    encerrado = threading.Event()
+    publicacao = threading.Lock()
+    publicado = []
+
+    def publicar(img_path):
+        with publicacao:
+            if not encerrado.is_set():
+                metricas.contar('atomai_imagens_total', resultado='rascunho')
+                publicado.append(_resposta_imagem(_nome_publico(img_path), rascunho=True))
+                progresso('Rascunho pronto, gerando a versão final', publicado[0])
+
+    def encerrar():
+        with publicacao:
+            encerrado.set()
+        cancelado.set()
+        return publicado[0] if publicado else None
+
+    em_cache = cache_imagens.buscar(prompt_melhorado, provedor.modelos(provedores.TEXTO_IMAGEM),
+                                    parametros["num_inference_steps"], parametros["guidance_scale"],
+                                    parametros["negative_prompt"], variante)
+    if em_cache:
+        publicar(em_cache[1])
+        return encerrar
+
+    def gerar():
+        # Um único modelo, o de menor latência esperada agora
+        modelo = saude_modelos.ordenar(provedor.modelos(provedores.TEXTO_IMAGEM))[0]
+        try:
+            with metricas.etapa('gerar_rascunho'):
+                resultado = provedor.gerar_imagem(payload, OUTPUT_DIR, HUGGINGFACE_API_TOKEN, prazo, [modelo],
+                                                  timeout=imagens.RASCUNHO_TIMEOUT, cancelado=cancelado,
+                                                  medir=False)
+        except PrazoEsgotado:
+            return
+        if resultado is None:
+            return
+        modelo, arquivo = resultado
+        img_path = cache_imagens.guardar_arquivo(prompt_melhorado, modelo, parametros["num_inference_steps"],
+                                                 parametros["guidance_scale"], parametros["negative_prompt"],
+                                                 arquivo['caminho'], arquivo['sha256'], arquivo['tamanho'],
+                                                 arquivo['extensao'], variante)
+        publicar(img_path)
+
+    def gerar_com_log():
+        try:
+            gerar()
+        except Exception as e:
+            app.logger.error(f'Erro ao gerar rascunho: {str(e)}')
+
+    threading.Thread(target=gerar_com_log, name='rascunho', daemon=True).start()
+    return encerrar
+
+def _gerar_imagem(dados, progresso):
+    """Executa um job de geração de imagem e retorna o mesmo JSON que a rota devolvia antes da fila"""
+    prompt = dados['prompt']
+    prazo = _prazo_do_job(dados)
+    
+    # Melhoria do prompt para obter melhores resultados
+    prompt_melhorado = imagens.melhorar_prompt(prompt)
+    
+    # Configuração dos parâmetros
+    payload = imagens.montar_payload(prompt_melhorado)
+    parametros = payload["parameters"]
+    
+    # Outro job pode ter gerado a mesma imagem enquanto este esperava na fila
+    em_cache = _buscar_imagem_em_cache(prompt_melhorado, parametros)
+    if em_cache:
+        return em_cache
+    
+    # Enquanto a imagem final não fica pronta, um rascunho rápido é mostrado ao usuário
+    progresso('Gerando imagem')
+    principais = provedores.registro.ordenar(provedores.TEXTO_IMAGEM, reserva=False)
+    encerrar_rascunho = None
+    if (imagens.RASCUNHO_ATIVO and imagens.RASCUNHO_PASSOS < parametros["num_inference_steps"]
+            and principais and principais[0].rascunho):
+        encerrar_rascunho = _iniciar_rascunho(principais[0], prompt_melhorado, prazo, progresso)
+    
+    # Provedores principais; no Hugging Face os modelos correm entre si e a primeira imagem válida vence
+    try:
+        # Cada modelo tem até 20 s, mas nunca mais do que resta do prazo do pedido
+        resultado = provedores.gerar_imagem(payload, OUTPUT_DIR, reserva=False, credencial=HUGGINGFACE_API_TOKEN,
+                                            prazo=prazo, timeout=20)
+        esgotado = False
+    except PrazoEsgotado:
+        resultado, esgotado = None, True
+        metricas.contar('atomai_prazos_esgotados_total', rota='job:gerar-imagem')
+    finally:
+        rascunho = encerrar_rascunho() if encerrar_rascunho else None
+    
+    # Se nenhum provedor principal funcionou (ou o prazo acabou),
+    # o rascunho já mostrado é melhor que uma imagem de reserva
+    if not resultado and rascunho:
+        app.logger.warning('Imagem final não foi gerada, mantendo o rascunho')
+        return rascunho
+    
+    extras = {}
+    if not resultado:
+        # Provedor de reserva (o local, em milissegundos), mesmo com o prazo esgotado
+        app.logger.warning('Prazo do pedido esgotado, usando provedor de reserva' if esgotado
+                           else 'Todos os modelos falharam, usando provedor de reserva')
+        resultado = provedores.gerar_imagem(payload, OUTPUT_DIR, reserva=True)
+        extras = {'fallback': True, 'prazo_esgotado': True} if esgotado else {'fallback': True}
+    
+    if resultado:
+        provedor, modelo, arquivo = resultado
+        
+        # A imagem já foi gravada em pedaços durante o download: só falta movê-la
+        # para o nome baseado no hash do conteúdo
+        with metricas.etapa('guardar_cache_imagem'):
+            img_path = cache_imagens.guardar_arquivo(prompt_melhorado, modelo, parametros["num_inference_steps"],
+                                                     parametros["guidance_scale"], parametros["negative_prompt"],
+                                                     arquivo['caminho'], arquivo['sha256'], arquivo['tamanho'],
+                                                     arquivo['extensao'])
+        metricas.contar('atomai_imagens_total', resultado='reserva' if extras else 'modelo')
+        filename = _nome_publico(img_path)
+        imagens.reencodar_em_segundo_plano(img_path)
+        
+        app.logger.info(f'Imagem gerada com sucesso usando modelo {modelo} ({provedor.nome})')
+        # Retornar o caminho para o arquivo
+        return _resposta_imagem(filename, **extras)
+    
+    # Sem provedor de reserva (PROVEDOR_LOCAL_RESERVA vazio): usar fallback para Unsplash
+    app.logger.warning('Nenhum provedor de reserva gerou a imagem, usando fallback Unsplash')
+    metricas.contar('atomai_imagens_total', resultado='unsplash')
+    unsplash_url = f"https://source.unsplash.com/800x500/?{prompt.replace(' ', ',')}"
+    if esgotado:
+        return {'imagem_url': unsplash_url, 'fallback': True, 'prazo_esgotado': True}
+    return {'imagem_url': unsplash_url, 'fallback': True}
+
+def _entrada_edicao(sha256, strength):
+    """Identifica a imagem de entrada de uma edição nas chaves do cache de imagens"""
+    return f'{sha256}:{strength}'
+
+def _editar_imagem(dados, progresso):
+    """Executa um job de edição (image-to-image) a partir da entrada já preparada"""
+    prompt_melhorado = imagens.melhorar_prompt(dados['prompt'])
+    entrada = _entrada_edicao(dados['sha256'], dados['strength'])
+    
+    # Outro job pode ter feito a mesma edição enquanto este esperava na fila
+    em_cache = cache_imagens.buscar(prompt_melhorado, provedores.registro.modelos(provedores.IMAGEM_IMAGEM),
+                                    30, 7.5, '', entrada)
+    if em_cache:
+        metricas.contar('atomai_imagens_total', resultado='cache')
+        return _resposta_imagem(_nome_publico(em_cache[1]), cache=True)
+    
+    try:
+        with open(dados['entrada'], 'rb') as f:
+            conteudo = f.read()
+    except OSError:
+        raise RuntimeError('A imagem enviada não está mais disponível. Envie-a novamente.')
+    
+    progresso('Editando imagem')
+    payload = imagens.montar_payload_edicao(prompt_melhorado, conteudo, dados['strength'])
+    try:
+        # Os provedores de reserva só entram se configurados (PROVEDOR_LOCAL_RESERVA)
+        resultado = provedores.gerar_imagem(payload, OUTPUT_DIR, provedores.IMAGEM_IMAGEM,
+                                            credencial=HUGGINGFACE_API_TOKEN, prazo=_prazo_do_job(dados), timeout=30)
+    except PrazoEsgotado:
+        # O job termina com erro: "Tempo limite do pedido esgotado."
+        metricas.contar('atomai_prazos_esgotados_total', rota='job:editar-imagem')
+        raise
+    if not resultado:
+        # Sem fallback do Unsplash: uma foto qualquer não serve como edição da imagem enviada
+        metricas.contar('atomai_imagens_total', resultado='erro')
+        raise RuntimeError('Nenhum modelo conseguiu editar a imagem. Tente novamente mais tarde.')
+    
+    provedor, modelo, arquivo = resultado
+    reserva = provedores.registro.e_reserva(provedor, provedores.IMAGEM_IMAGEM)
+    with metricas.etapa('guardar_cache_imagem'):
+        img_path = cache_imagens.guardar_arquivo(prompt_melhorado, modelo, 30, 7.5, '', arquivo['caminho'],
+                                                 arquivo['sha256'], arquivo['tamanho'], arquivo['extensao'], entrada)
+    metricas.contar('atomai_imagens_total', resultado='reserva' if reserva else 'modelo')
+    imagens.reencodar_em_segundo_plano(img_path)
+    app.logger.info(f'Imagem editada com sucesso usando modelo {modelo} ({provedor.nome})')
+    return _resposta_imagem(_nome_publico(img_path), **({'fallback': True} if reserva else {}))
+
+# Fila de jobs: a geração de imagens roda em segundo plano e o cliente acompanha pelo id do job
+fila_jobs = FilaJobs(os.path.join(DADOS_DIR, "jobs.sqlite3"))
+fila_jobs.registrar('gerar-imagem', _gerar_imagem)
+fila_jobs.registrar('editar-imagem', _editar_imagem)
+fila_jobs.iniciar()
+
+# Mantém os modelos aquecidos enquanto houver pedidos de imagem (a thread começa no primeiro pedido);
+# offline não há modelo externo para aquecer
+aquecedor = AquecedorModelos(
+    [] if provedores.registro.offline else provedores.huggingface.modelos(provedores.TEXTO_IMAGEM),
+    HUGGINGFACE_API_TOKEN, url_base=provedores.huggingface.url_base)
+
+def _sobrecarga_imagens():
+    """Segundos para o cliente tentar de novo se a geração de imagens está sobrecarregada, ou None"""
+    if fila_jobs.estatisticas()['fila'] >= ADMISSAO_FILA_MAXIMA:
+        return 5
+    latencia = provedores.registro.melhor_latencia(provedores.TEXTO_IMAGEM)
+    # Com um provedor de reserva (ex.: o local durante uma queda do Hugging Face) os
+    # pedidos ainda são atendidos, então só a fila cheia os descarta
+    if latencia >= ADMISSAO_LATENCIA_MAXIMA and not provedores.registro.ordenar(provedores.TEXTO_IMAGEM, reserva=True):
+        return min(latencia, 60)
+    return None
+
+# Limite de pedidos por cliente e descarte de carga nas rotas /api/*, com os
+# baldes de fichas compartilhados pelos workers
+admissao = Admissao(os.path.join(DADOS_DIR, "admissao.bin"))
+admissao.registrar_sobrecarga('gerar-imagem', _sobrecarga_imagens)
+
+@app.before_request
+def controlar_admissao():
+    recusa = admissao.admitir(request.path, _chave_cliente())
+    if recusa is None:
+        return None
+    espera, motivo = recusa
+    if motivo == 'limite':
+        mensagem = 'Muitos pedidos seguidos. Aguarde um pouco e tente novamente.'
+    else:
+        mensagem = 'Servidor sobrecarregado. Tente novamente em instantes.'
+    return (jsonify({'erro': mensagem, 'resposta': mensagem, 'motivo': motivo}), 429,
+            {'Retry-After': Admissao.retry_after(espera)})
 
 @app.route('/api/gerar-imagem', methods=['POST'])
 def gerar_imagem():
     try:
-        data = request.get_json()
+        with metricas.etapa('ler_json'):
+            data = request.get_json()
         if not data:
             return jsonify({'erro': 'Dados JSON não recebidos.'}), 400
             
@@ -79,90 +524,218 @@ def gerar_imagem():
         if not prompt:
             return jsonify({'erro': 'Descrição da imagem não enviada.'}), 400
         
-        # Melhoria do prompt para obter melhores resultados
-        if not prompt.lower().startswith(("a photo of", "an image of")):
-            prompt_melhorado = f"A detailed high quality image of {prompt}, 4k resolution, detailed"
-        else:
-            prompt_melhorado = prompt
+        aquecedor.registrar_pedido()
         
-        # Tentar vários modelos em caso de falha
-        modelos = [
-            "runwayml/stable-diffusion-v1-5",
-            "stabilityai/stable-diffusion-xl-base-1.0",
-            "prompthero/openjourney"
-        ]
+        # Prompt repetido: devolver a imagem já gerada na hora, sem passar pela fila
+        prompt_melhorado = imagens.melhorar_prompt(prompt)
+        parametros = imagens.montar_payload(prompt_melhorado)["parameters"]
+        em_cache = _buscar_imagem_em_cache(prompt_melhorado, parametros)
+        if em_cache:
+            return jsonify(em_cache)
         
-        headers = {"Authorization": f"Bearer {HUGGINGFACE_API_TOKEN}"}
+        # O mesmo prompt já na fila ou gerando: o cliente acompanha o job existente
+        modelos = provedores.registro.modelos(provedores.TEXTO_IMAGEM)
+        chave = chave_cache(prompt_melhorado, ','.join(modelos), parametros["num_inference_steps"],
+                            parametros["guidance_scale"], parametros["negative_prompt"])
+        # O prazo vai junto do job como timestamp: ele pode rodar em outro processo
+        dados = {'prompt': prompt, 'prazo': _prazo(PRAZO_IMAGEM).instante()}
+        job_id = fila_jobs.enfileirar('gerar-imagem', dados, _chave_cliente(), chave)
+        return jsonify({'job_id': job_id, 'estado': 'fila', 'status_url': f'/api/jobs/{job_id}'}), 202
+    
+    except FilaCheia as e:
+        return jsonify({'erro': str(e)}), 429 if e.por_cliente else 503, {'Retry-After': '5'}
+    except Exception as e:
+        app.logger.error(f'Erro ao gerar imagem: {str(e)}')
+        return jsonify({'erro': f'Erro ao gerar imagem: {str(e)}'}), 500
+
+# Edição de uma imagem enviada (image-to-image): multipart com os campos 'imagem', 'prompt' e,
+# opcionalmente, 'strength' (0 a 1). A imagem é reduzida e cacheada aqui; a edição vai para a fila de jobs.
+@app.route('/api/editar-imagem', methods=['POST'])
+def editar_imagem():
+    # O multipart é lido em pedaços e, se for grande, vai para um arquivo temporário, sem ficar
+    # inteiro na memória; passando de MAX_CONTENT_LENGTH a leitura para com RequestEntityTooLarge
+    try:
+        arquivo = request.files.get('imagem')
+        prompt = request.form.get('prompt', '').strip()
+        if arquivo is None:
+            return jsonify({'erro': 'Imagem não enviada.'}), 400
+        if not prompt:
+            return jsonify({'erro': 'Descrição da edição não enviada.'}), 400
+        try:
+            strength = min(1.0, max(0.0, float(request.form.get('strength', 0.8))))
+        except ValueError:
+            return jsonify({'erro': 'strength deve ser um número entre 0 e 1.'}), 400
         
-        # Configuração dos parâmetros
-        payload = {
-            "inputs": prompt_melhorado,
-            "parameters": {
-                "num_inference_steps": 30,
-                "guidance_scale": 7.5,
-                "negative_prompt": "blurry, bad anatomy, bad hands, cropped, worst quality, low quality, text, watermark"
-            }
-        }
+        try:
+            entrada = preparo_imagens.preparar(arquivo.stream, cache_entradas)
+        except preparo_imagens.EntradaInvalida as e:
+            return jsonify({'erro': str(e)}), 400
         
-        # Tentar cada modelo até obter sucesso
-        for modelo in modelos:
-            try:
-                app.logger.info(f'Tentando gerar imagem com modelo: {modelo}')
-                api_url = f"https://api-inference.huggingface.co/models/{modelo}"
-                
-                # Chamada à API do Hugging Face
-                response = requests.post(api_url, headers=headers, json=payload, timeout=20)
-                
-                # Verificar se é um erro de modelo carregando
-                if response.status_code != 200:
-                    if "loading" in response.text.lower():
-                        app.logger.info(f'Modelo {modelo} ainda carregando, tentando próximo modelo...')
-                        continue
-                    
-                    app.logger.warning(f'Erro no modelo {modelo}: {response.status_code} - {response.text}')
-                    continue  # Tentar o próximo modelo
-                
-                # Se chegou aqui, temos uma resposta bem-sucedida
-                # Processar a imagem recebida do Hugging Face
-                try:
-                    # Verificar se o conteúdo é uma imagem válida
-                    from PIL import Image
-                    image = Image.open(io.BytesIO(response.content))
-                    
-                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                    filename = f"img_{timestamp}.png"
-                    img_path = os.path.join(OUTPUT_DIR, filename)
-                    
-                    # Salvar a imagem
-                    with open(img_path, "wb") as f:
-                        f.write(response.content)
-                    
-                    app.logger.info(f'Imagem gerada com sucesso usando modelo {modelo}')
-                    # Retornar o caminho para o arquivo
-                    return jsonify({'imagem_url': f"/imagens_geradas/{filename}"})
-                    
-                except Exception as img_error:
-                    app.logger.error(f'Erro ao processar imagem do modelo {modelo}: {str(img_error)}')
-                    continue  # Tentar o próximo modelo
-            
-            except requests.RequestException as req_error:
-                app.logger.error(f'Erro de requisição no modelo {modelo}: {str(req_error)}')
-                continue  # Tentar o próximo modelo
+        aquecedor.registrar_pedido()
         
-        # Se chegou aqui, nenhum dos modelos funcionou
-        # Usar fallback para Unsplash
-        app.logger.warning('Todos os modelos falharam, usando fallback Unsplash')
-        unsplash_url = f"https://source.unsplash.com/800x500/?{prompt.replace(' ', ',')}"
-        return jsonify({'imagem_url': unsplash_url, 'fallback': True})
-            
+        # Mesma imagem, prompt e intensidade: devolve a edição já feita
+        prompt_melhorado = imagens.melhorar_prompt(prompt)
+        chave_entrada = _entrada_edicao(entrada['sha256'], strength)
+        modelos = provedores.registro.modelos(provedores.IMAGEM_IMAGEM)
+        em_cache = cache_imagens.buscar(prompt_melhorado, modelos, 30, 7.5, '', chave_entrada)
+        if em_cache:
+            metricas.contar('atomai_imagens_total', resultado='cache')
+            return jsonify(_resposta_imagem(_nome_publico(em_cache[1]), cache=True))
+        
+        chave = chave_cache(prompt_melhorado, ','.join(modelos), 30, 7.5, '', chave_entrada)
+        dados = {'prompt': prompt, 'strength': strength, 'sha256': entrada['sha256'], 'entrada': entrada['caminho'],
+                 'prazo': _prazo(PRAZO_IMAGEM).instante()}
+        job_id = fila_jobs.enfileirar('editar-imagem', dados, _chave_cliente(), chave)
+        return jsonify({'job_id': job_id, 'estado': 'fila', 'status_url': f'/api/jobs/{job_id}'}), 202
+    
+    except RequestEntityTooLarge:
+        return jsonify({'erro': f'Imagem maior que {preparo_imagens.EDICAO_MAX_MB:g} MB.'}), 413
+    except FilaCheia as e:
+        return jsonify({'erro': str(e)}), 429 if e.por_cliente else 503, {'Retry-After': '5'}
     except Exception as e:
-        app.logger.error(f'Erro ao gerar imagem: {str(e)}')
-        return jsonify({'erro': f'Erro ao gerar imagem: {str(e)}'}), 500
+        app.logger.error(f'Erro ao editar imagem: {str(e)}')
+        return jsonify({'erro': f'Erro ao editar imagem: {str(e)}'}), 500
+
+# Estado de um job (o resultado fica em 'resultado' quando o estado for 'concluido')
+@app.route('/api/jobs/<job_id>')
+def status_job(job_id):
+    estado = fila_jobs.consultar(job_id)
+    if estado is None:
+        return jsonify({'erro': 'Job não encontrado.'}), 404
+    return jsonify(estado)
+
+# Acompanhamento de um job por Server-Sent Events: um evento a cada mudança de estado
+@app.route('/api/jobs/<job_id>/eventos')
+def eventos_job(job_id):
+    if fila_jobs.consultar(job_id) is None:
+        return jsonify({'erro': 'Job não encontrado.'}), 404
+    
+    # Sob o asgi.py, marcado quando o cliente desconecta: a thread sai na próxima espera
+    desconectado = request.environ.get('atomai.desconectado') or threading.Event()
+    
+    def gerar():
+        ultimo = None
+        while True:
+            estado = fila_jobs.consultar(job_id)
+            if estado is None:
+                return
+            if estado != ultimo:
+                ultimo = estado
+                yield f"data: {json.dumps(estado)}\n\n"
+            if estado['estado'] in ESTADOS_FINAIS:
+                return
+            if desconectado.wait(0.5):
+                return
+    
+    return Response(stream_with_context(gerar()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 # Rota para servir as imagens geradas
 @app.route('/imagens_geradas/<path:filename>')
 def serve_generated_image(filename):
-    return send_from_directory(OUTPUT_DIR, filename)
+    # Variante redimensionada/convertida, ex.: ?w=256&fmt=webp
+    largura = request.args.get('w', type=int)
+    formato = request.args.get('fmt')
+    if largura or formato:
+        variante = miniaturas.obter_variante(OUTPUT_DIR, filename, largura, formato)
+        if variante:
+            return estaticos.servir_arquivo(OUTPUT_DIR, variante)
+        # Variante ainda não pronta: entrega o original, sem deixá-lo em cache nessa URL
+        resposta = estaticos.servir_arquivo(OUTPUT_DIR, filename)
+        resposta.headers['Cache-Control'] = 'no-cache'
+        return resposta
+    return estaticos.servir_arquivo(OUTPUT_DIR, filename)
+
+# Rota com as imagens geradas mais recentes, lidas do índice do cache (?limite=20&antes=<timestamp>&modelo=...)
+@app.route('/api/imagens')
+def listar_imagens():
+    limite = max(1, min(request.args.get('limite', 20, type=int), 200))
+    lista = cache_imagens.listar(limite, request.args.get('antes', type=float), request.args.get('modelo'))
+    imagens_lista = [_resposta_imagem(entrada['arquivo'], prompt=entrada['prompt'], modelo=entrada['modelo'],
+                                      tamanho=entrada['tamanho'], criado=entrada['criado'])
+                     for entrada in lista]
+    # Para a próxima página: ?antes=<proximo>
+    proximo = lista[-1]['criado'] if len(lista) == limite else None
+    return jsonify({'imagens': imagens_lista, 'proximo': proximo})
+
+# Rota com os contadores de reaproveitamento de conexões com as APIs externas
+@app.route('/api/status/conexoes')
+def status_conexoes():
+    return jsonify(http_cliente.estatisticas_pool())
+
+# Rota com as estatísticas dos caches
+@app.route('/api/status/cache')
+def status_cache():
+    return jsonify({'imagens': cache_imagens.estatisticas(), 'respostas': cache_respostas.estatisticas()})
+
+# Rota com a quantidade de jobs em cada estado
+@app.route('/api/status/jobs')
+def status_jobs():
+    return jsonify(fila_jobs.estatisticas())
+
+# Rota com quantos pedidos iguais simultâneos foram atendidos por uma única chamada
+@app.route('/api/status/coalescencia')
+def status_coalescencia():
+    return jsonify({'perguntas': coalescedor.estatisticas(),
+                    'imagens': {'coalescidos': fila_jobs.estatisticas()['coalescidos']}})
+
+# Rota com a quantidade e o tamanho das conversas guardadas
+@app.route('/api/status/conversas')
+def status_conversas():
+    return jsonify(conversas.estatisticas())
+
+# Rota com os pedidos admitidos, limitados e descartados em cada grupo de rotas (neste processo)
+@app.route('/api/status/admissao')
+def status_admissao():
+    return jsonify(admissao.estatisticas())
+
+# Acertos e falhas dos caches, lidos dos próprios caches a cada coleta
+def _metricas_caches():
+    respostas = cache_respostas.estatisticas()
+    imagens_cache = cache_imagens.estatisticas()
+    return [
+        ('atomai_cache_total', {'cache': 'respostas', 'resultado': 'acerto'},
+         respostas['acertos_exatos'] + respostas['acertos_aproximados']),
+        ('atomai_cache_total', {'cache': 'respostas', 'resultado': 'falha'}, respostas['falhas']),
+        ('atomai_cache_total', {'cache': 'imagens', 'resultado': 'acerto'}, imagens_cache['acertos']),
+        ('atomai_cache_total', {'cache': 'imagens', 'resultado': 'falha'}, imagens_cache['falhas']),
+    ]
+
+metricas.registro.registrar_coletor(_metricas_caches)
+
+# Métricas no formato do Prometheus (latências por rota, modelo e etapa; fallbacks; caches; bytes gravados)
+@app.route('/api/status/metricas')
+def status_metricas():
+    return Response(metricas.registro.exportar(), mimetype='text/plain; version=0.0.4')
+
+def _perfil_autorizado():
+    return bool(PERFIL_TOKEN) and request.headers.get('Authorization') == f'Bearer {PERFIL_TOKEN}'
+
+# Amostrador de perfil deste processo: POST {"ativo": true, "intervalo": 0.01} liga, {"ativo": false} desliga;
+# GET devolve as pilhas no formato "folded" (flamegraph.pl / speedscope)
+@app.route('/api/status/perfil', methods=['GET', 'POST'])
+def status_perfil():
+    if not _perfil_autorizado():
+        return jsonify({'erro': 'Defina PERFIL_TOKEN e envie-o em Authorization: Bearer.'}), 403
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        if data.get('ativo'):
+            metricas.perfil.ligar(data.get('intervalo'))
+        else:
+            metricas.perfil.desligar()
+        return jsonify(metricas.perfil.estatisticas())
+    return Response(metricas.perfil.folded(request.args.get('limite', type=int)), mimetype='text/plain',
+                    headers={'X-Perfil-Amostras': str(metricas.perfil.estatisticas()['amostras'])})
+
+# Rota com os provedores registrados: capacidades, custos estimados e latência esperada agora
+@app.route('/api/status/provedores')
+def status_provedores():
+    return jsonify(provedores.registro.tabela())
+
+# Rota com a saúde de cada modelo do Hugging Face (latências, falhas e circuit breaker) e o aquecimento
+@app.route('/api/status/modelos')
+def status_modelos():
+    return jsonify({'modelos': saude_modelos.tabela(), 'aquecimento': aquecedor.estatisticas()})
 
 if __name__ == '__main__':
     # Em desenvolvimento usamos modo debug
@@ -0,0 +1,328 @@
+"""
+Modo de execução assíncrono (ASGI) do Atomai
+
+Em vez de ocupar um worker síncrono do gunicorn por requisição, o servidor
+ASGI (uvicorn) mantém um laço de eventos que aceita todas as conexões e
+repassa cada requisição para a aplicação Flask em um pool de threads próprio
+da API externa envolvida. Assim, uma fila de gerações de imagem lentas no
+Hugging Face não impede o chat (Cohere) nem os arquivos estáticos de serem
+atendidos. As rotas continuam sendo as mesmas de app.py, com o mesmo
+contrato JSON.
+
+Isto é concorrência limitada por threads, não I/O não bloqueante: as
+chamadas às APIs continuam sendo as do requests (bloqueantes), e cada
+posição de um pool é uma thread parada no Hugging Face ou na Cohere até a
+resposta ou o prazo (funçoes/prazos.py). O ganho é o isolamento entre as
+APIs e o limite por pool (503 em vez de uma fila sem fim), mantendo o
+código das rotas síncrono; reescrever as chamadas com um cliente
+assíncrono ficaria para quando o número de threads paradas pesar. Um
+adaptador pronto (asgiref.wsgi.WsgiToAsgi, a2wsgi) usa um único pool para
+tudo, por isso a ponte é feita aqui.
+
+A desconexão do cliente é avisada à aplicação pelo evento em
+environ['atomai.desconectado'] (threading.Event): streams longos, como o
+de progresso dos jobs, a consultam entre uma espera e outra e liberam a
+thread logo, em vez de só no próximo pedaço enviado.
+
+O corpo do pedido não é lido antes da aplicação: ele passa para o
+wsgi.input à medida que o Flask o lê, então o MAX_CONTENT_LENGTH do app
+vale também para uploads chunked, e um Content-Length acima dele recebe
+413 sem que o corpo seja lido.
+
+Uso:
+    gunicorn asgi:app -k uvicorn.workers.UvicornWorker
+
+Configuração (variáveis de ambiente):
+- ASGI_LIMITE_HUGGINGFACE: pedidos de imagem simultâneos; a geração roda na fila de jobs e o pedido só
+  enfileira (padrão: 4)
+- ASGI_LIMITE_UPLOADS: edições de imagem simultâneas, que recebem o upload e o reduzem na CPU (padrão: 4)
+- ASGI_LIMITE_COHERE: requisições simultâneas para a Cohere (padrão: 16)
+- ASGI_LIMITE_LOTE: lotes de perguntas simultâneos, cada um aberto por minutos (padrão: 4)
+- ASGI_LIMITE_EVENTOS: consultas e streams de progresso de jobs (padrão: 32)
+- ASGI_LIMITE_GERAL: demais rotas, incluindo arquivos estáticos (padrão: 8)
+- ASGI_FILA_MAXIMA: requisições aguardando por pool antes de responder 503 (padrão: 64)
+"""
+
+import asyncio
+import io
+import json
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from app import app as flask_app
+
+ASGI_FILA_MAXIMA = int(os.environ.get('ASGI_FILA_MAXIMA', 64))
+
+# Pools de threads por API externa: o número de threads limita as chamadas
+# simultâneas para cada uma delas
+LIMITES = {
+    'huggingface': int(os.environ.get('ASGI_LIMITE_HUGGINGFACE', 4)),
+    'uploads': int(os.environ.get('ASGI_LIMITE_UPLOADS', 4)),
+    'cohere': int(os.environ.get('ASGI_LIMITE_COHERE', 16)),
+    'lote': int(os.environ.get('ASGI_LIMITE_LOTE', 4)),
+    'eventos': int(os.environ.get('ASGI_LIMITE_EVENTOS', 32)),
+    'geral': int(os.environ.get('ASGI_LIMITE_GERAL', 8)),
+}
+
+# Prefixos de rota e o pool que os atende (o primeiro que casar vence)
+ROTAS = [
+    ('/api/gerar-imagem', 'huggingface'),
+    ('/api/editar-imagem', 'uploads'),
+    # Antes de /api/perguntar: um lote fica aberto até todas as respostas saírem
+    ('/api/perguntar/lote', 'lote'),
+    ('/api/perguntar', 'cohere'),
+    # Consultas e streams de progresso dos jobs, que podem ficar abertos por bastante tempo
+    ('/api/jobs', 'eventos'),
+]
+
+# Pedaços do corpo (como chegam do servidor ASGI) lidos do cliente antes da aplicação pedi-los
+FILA_CORPO = 4
+
+_executores = {}
+_pendentes = {nome: 0 for nome in LIMITES}
+_pendentes_lock = threading.Lock()
+
+
+def _executor(nome):
+    if nome not in _executores:
+        _executores[nome] = ThreadPoolExecutor(max_workers=LIMITES[nome], thread_name_prefix=f'asgi-{nome}')
+    return _executores[nome]
+
+
+def _pool_para(caminho):
+    for prefixo, nome in ROTAS:
+        if caminho.startswith(prefixo):
+            return nome
+    return 'geral'
+
+
+class _Entrada(io.RawIOBase):
+    """
+    wsgi.input que lê o corpo do cliente à medida que a aplicação pede
+
+    O corpo não é guardado: um upload multipart vai direto para o parser do
+    Werkzeug, que aplica o MAX_CONTENT_LENGTH enquanto lê (413), e um
+    cliente mais rápido que a aplicação espera a fila limitada esvaziar.
+    """
+
+    def __init__(self, fila, loop):
+        self._fila = fila
+        self._loop = loop
+        self._resto = b''
+        self._fim = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, destino):
+        while not self._resto and not self._fim:
+            pedaco = asyncio.run_coroutine_threadsafe(self._fila.get(), self._loop).result()
+            if pedaco is None:
+                self._fim = True
+            else:
+                self._resto = pedaco
+        quantidade = min(len(destino), len(self._resto))
+        destino[:quantidade] = self._resto[:quantidade]
+        self._resto = self._resto[quantidade:]
+        return quantidade
+
+
+def _montar_environ(scope, corpo, cancelado):
+    servidor = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+        'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+        'SERVER_NAME': str(servidor[0]),
+        'SERVER_PORT': str(servidor[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': corpo,
+        # O corpo termina quando o cliente termina de enviar, com ou sem Content-Length (chunked)
+        'wsgi.input_terminated': True,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        # Marcado quando o cliente desconecta (veja a documentação do módulo)
+        'atomai.desconectado': cancelado,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+        environ['REMOTE_PORT'] = str(scope['client'][1])
+
+    for nome, valor in scope.get('headers', []):
+        nome = nome.decode('latin1').upper().replace('-', '_')
+        valor = valor.decode('latin1')
+        if nome == 'CONTENT_TYPE' or nome == 'CONTENT_LENGTH':
+            chave = nome
+        else:
+            chave = f'HTTP_{nome}'
+        environ[chave] = f'{environ[chave]},{valor}' if chave in environ else valor
+    return environ
+
+
+def _tamanho_declarado(scope):
+    """Content-Length do pedido, ou None se não veio (ou não é válido)"""
+    for nome, valor in scope.get('headers', []):
+        if nome.lower() == b'content-length':
+            try:
+                return int(valor)
+            except ValueError:
+                return None
+    return None
+
+
+async def _responder_json(send, status, dados, cabecalhos=()):
+    corpo = json.dumps(dados).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(corpo)).encode())] + list(cabecalhos),
+    })
+    await send({'type': 'http.response.body', 'body': corpo})
+
+
+def _executar_wsgi(environ, loop, fila, cancelado):
+    """Roda a aplicação Flask numa thread do pool e envia a resposta em pedaços para a fila"""
+    def enviar(item):
+        # A fila é limitada: se o cliente estiver lento, a thread espera aqui
+        asyncio.run_coroutine_threadsafe(fila.put(item), loop).result()
+
+    def start_response(status, headers, exc_info=None):
+        enviar(('inicio', int(status.split(' ', 1)[0]), headers))
+        return lambda dados: enviar(('corpo', dados, None))
+
+    try:
+        resultado = flask_app(environ, start_response)
+        try:
+            for pedaco in resultado:
+                if cancelado.is_set():
+                    break
+                if pedaco:
+                    enviar(('corpo', pedaco, None))
+        finally:
+            if hasattr(resultado, 'close'):
+                resultado.close()
+    except Exception as e:
+        enviar(('erro', e, None))
+    finally:
+        enviar(('fim', None, None))
+        environ['wsgi.input'].close()
+
+
+async def _receber(receive, fila_corpo, cancelado):
+    """Repassa o corpo para a aplicação pela fila limitada (None marca o fim) e depois vigia a desconexão"""
+    corpo_aberto = True
+    while True:
+        mensagem = await receive()
+        if mensagem['type'] == 'http.disconnect':
+            cancelado.set()
+            if corpo_aberto:
+                await fila_corpo.put(None)
+            return
+        if corpo_aberto:
+            pedaco = mensagem.get('body', b'')
+            if pedaco:
+                await fila_corpo.put(pedaco)
+            if not mensagem.get('more_body'):
+                corpo_aberto = False
+                await fila_corpo.put(None)
+
+
+async def _http(scope, receive, send):
+    limite = flask_app.config.get('MAX_CONTENT_LENGTH')
+    declarado = _tamanho_declarado(scope)
+    if limite is not None and declarado is not None and declarado > limite:
+        # Recusa sem ler o corpo nem ocupar uma thread; sem Content-Length o Werkzeug para na leitura
+        await _responder_json(send, 413, {'erro': f'Pedido maior que o limite de {limite} bytes.'})
+        return
+
+    nome_pool = _pool_para(scope['path'])
+    with _pendentes_lock:
+        if _pendentes[nome_pool] >= LIMITES[nome_pool] + ASGI_FILA_MAXIMA:
+            lotado = True
+        else:
+            lotado = False
+            _pendentes[nome_pool] += 1
+    if lotado:
+        await _responder_json(send, 503, {'erro': 'Servidor ocupado, tente novamente em instantes.'},
+                              [(b'retry-after', b'1')])
+        return
+
+    try:
+        loop = asyncio.get_running_loop()
+        fila = asyncio.Queue(maxsize=8)
+        fila_corpo = asyncio.Queue(maxsize=FILA_CORPO)
+        cancelado = threading.Event()
+        vigia = asyncio.ensure_future(_receber(receive, fila_corpo, cancelado))
+        corpo = io.BufferedReader(_Entrada(fila_corpo, loop))
+        tarefa = loop.run_in_executor(_executor(nome_pool), _executar_wsgi,
+                                      _montar_environ(scope, corpo, cancelado), loop, fila, cancelado)
+        iniciado = False
+        try:
+            while True:
+                tipo, valor, cabecalhos = await fila.get()
+                if tipo == 'inicio':
+                    if not iniciado:
+                        iniciado = True
+                        await send({
+                            'type': 'http.response.start',
+                            'status': valor,
+                            'headers': [(k.lower().encode('latin1'), v.encode('latin1')) for k, v in cabecalhos],
+                        })
+                elif tipo == 'corpo':
+                    if not cancelado.is_set():
+                        await send({'type': 'http.response.body', 'body': valor, 'more_body': True})
+                elif tipo == 'erro':
+                    flask_app.logger.error(f'Erro na aplicação WSGI: {str(valor)}')
+                    if not iniciado:
+                        iniciado = True
+                        await _responder_json(send, 500, {'erro': 'Erro interno do servidor.'})
+                        cancelado.set()
+                elif tipo == 'fim':
+                    break
+            if not cancelado.is_set():
+                await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        except Exception:
+            cancelado.set()
+            raise
+        finally:
+            vigia.cancel()
+            # Uma thread ainda lendo o corpo recebe o fim dele em vez de esperar para sempre
+            try:
+                fila_corpo.put_nowait(None)
+            except asyncio.QueueFull:
+                pass
+            # Continua consumindo a fila para a thread não ficar presa esperando
+            while not tarefa.done():
+                try:
+                    await asyncio.wait_for(fila.get(), timeout=0.1)
+                except asyncio.TimeoutError:
+                    pass
+    finally:
+        with _pendentes_lock:
+            _pendentes[nome_pool] -= 1
+
+
+async def _lifespan(receive, send):
+    while True:
+        mensagem = await receive()
+        if mensagem['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif mensagem['type'] == 'lifespan.shutdown':
+            for executor in _executores.values():
+                executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'http':
+        await _http(scope, receive, send)
+    elif scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
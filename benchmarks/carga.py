@@ -0,0 +1,414 @@
+"""
+Teste de carga do app com a Cohere e o Hugging Face simulados localmente
+
+Sobe o servidor falso de benchmarks/servidor_falso.py, inicia o app num
+processo separado apontando para ele (com dados e imagens num diretório
+temporário) e roda cada cenário com um número fixo de clientes simultâneos,
+cada um fazendo um pedido atrás do outro durante --duracao segundos:
+
+- perguntar: POST /api/perguntar, com perguntas sempre diferentes
+- perguntar-stream: POST /api/perguntar/stream, lendo o NDJSON até o fim
+- gerar-imagem: POST /api/gerar-imagem e consulta ao job até ele terminar
+  (a latência é a do pedido até a imagem pronta)
+- estaticos: GET / e GET /index.html
+
+Para cada cenário são medidos pedidos por segundo, latências p50/p95/p99,
+erros e a ocupação dos workers: o tempo somado das requisições no servidor
+(pelas métricas de /api/status/metricas) dividido pela duração, ou seja,
+quantas requisições estavam sendo atendidas em média, e essa média dividida
+pelas threads do pool que atende a rota (no modo ASGI). Nas rotas com
+streaming, as métricas só cobrem o tempo até a resposta começar, então a
+ocupação sai subestimada. Em gerar-imagem também a ocupação das threads de
+jobs. O uso de CPU dos processos do app
+vem de /proc (só no Linux).
+
+Com --offline o app usa só o provedor local (PROVEDORES_OFFLINE=1, veja
+funçoes/provedores.py): respostas prontas e imagens procedurais geradas na
+CPU, sem passar pelo servidor falso, para medir o próprio app sem nenhuma
+latência de API.
+
+O resultado é gravado em benchmarks/resultados/<data>_<commit>.json. Com
+--comparar, o resultado é comparado com um anterior, e o comando termina
+com código 1 se algum cenário piorou mais que --tolerancia (RPS menor ou
+p95 maior).
+
+Uso:
+    python benchmarks/carga.py [--cenarios perguntar,gerar-imagem] [--concorrencia 16] [--duracao 20]
+        [--servidor asgi|flask] [--workers 1] [--latencia-hf 0.5] [--latencia-cohere 0.3]
+        [--carregamento 0] [--taxa-erro 0] [--tamanho-imagem 512] [--offline] [--comparar resultados/anterior.json]
+"""
+
+import argparse
+import json
+import math
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import requests
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from servidor_falso import criar_servidor  # noqa: E402
+
+RESULTADOS_DIR = os.path.join(RAIZ, 'benchmarks', 'resultados')
+
+CENARIOS = ['perguntar', 'perguntar-stream', 'gerar-imagem', 'estaticos']
+
+# Rotas de cada cenário (como aparecem nas métricas) e o pool do asgi.py que as atende
+ROTAS_CENARIO = {
+    'perguntar': (['/api/perguntar'], 'cohere'),
+    'perguntar-stream': (['/api/perguntar/stream'], 'cohere'),
+    'gerar-imagem': (['/api/gerar-imagem', '/api/jobs/<job_id>'], 'huggingface'),
+    'estaticos': (['/', '/<path:path>'], 'geral'),
+}
+
+# Threads dos pools do asgi.py (mesmos padrões e variáveis de ambiente)
+POOLS_ASGI = {
+    'huggingface': int(os.environ.get('ASGI_LIMITE_HUGGINGFACE', 8)),
+    'cohere': int(os.environ.get('ASGI_LIMITE_COHERE', 16)),
+    'eventos': int(os.environ.get('ASGI_LIMITE_EVENTOS', 32)),
+    'geral': int(os.environ.get('ASGI_LIMITE_GERAL', 8)),
+}
+JOBS_WORKERS = int(os.environ.get('JOBS_WORKERS', 2))
+
+_AMOSTRA = re.compile(r'^(\w+)(?:\{(.*)\})? (\S+)$')
+_ROTULO = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def percentil(valores, fracao):
+    """Percentil pelo método do posto mais próximo"""
+    if not valores:
+        return None
+    ordenados = sorted(valores)
+    return ordenados[max(0, math.ceil(fracao * len(ordenados)) - 1)]
+
+
+def ler_metricas(texto):
+    """Lê o formato de texto do Prometheus em {(nome, rótulos): valor}"""
+    amostras = {}
+    for linha in texto.splitlines():
+        encontrado = _AMOSTRA.match(linha)
+        if encontrado:
+            nome, rotulos, valor = encontrado.groups()
+            amostras[(nome, frozenset(_ROTULO.findall(rotulos or '')))] = float(valor)
+    return amostras
+
+
+def _somar(amostras, nome, **filtros):
+    return sum(valor for (n, rotulos), valor in amostras.items()
+               if n == nome and all((chave, str(alvo)) in rotulos for chave, alvo in filtros.items()))
+
+
+def _somar_rotas(amostras, rotas):
+    return sum(_somar(amostras, 'atomai_rota_segundos_sum', rota=rota) for rota in rotas)
+
+
+def cpu_processos(pid):
+    """Segundos de CPU do processo e dos filhos diretos (workers), lidos de /proc; None fora do Linux"""
+    if not os.path.isdir('/proc'):
+        return None
+    ticks = os.sysconf('SC_CLK_TCK')
+    total = 0.0
+    for entrada in os.listdir('/proc'):
+        if not entrada.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entrada}/stat') as f:
+                campos = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        # Depois do nome: estado, ppid, ... utime é o 12º e stime o 13º campo
+        if int(entrada) == pid or int(campos[1]) == pid:
+            total += (int(campos[11]) + int(campos[12])) / ticks
+    return total
+
+
+class App:
+    """O app rodando num processo separado, apontado para o servidor falso"""
+
+    def __init__(self, servidor, workers, url_falso, porta=None, offline=False):
+        self.porta = porta or _porta_livre()
+        self.url = f'http://127.0.0.1:{self.porta}'
+        self.servidor = servidor
+        self.workers = workers
+        self.temporario = tempfile.mkdtemp(prefix='carga_atomai_')
+        self.ambiente = dict(
+            os.environ,
+            HUGGINGFACE_API_URL=f'{url_falso}/models/',
+            COHERE_API_URL=f'{url_falso}/v1/chat',
+            HUGGINGFACE_API_TOKEN='falso',
+            COHERE_API_KEY='falso',
+            DADOS_DIR=os.path.join(self.temporario, 'dados'),
+            IMAGENS_DIR=os.path.join(self.temporario, 'imagens_geradas'),
+            AQUECIMENTO_ATIVO='0',
+            ADMISSAO_ATIVA=os.environ.get('ADMISSAO_ATIVA', '0'),
+            METRICAS_INTERVALO='0.5',
+            PROVEDORES_OFFLINE='1' if offline else os.environ.get('PROVEDORES_OFFLINE', '0'),
+            PORT=str(self.porta),
+        )
+        self.processo = None
+
+    def iniciar(self):
+        if self.servidor == 'asgi':
+            comando = [sys.executable, '-m', 'uvicorn', 'asgi:app', '--host', '127.0.0.1', '--port', str(self.porta),
+                       '--workers', str(self.workers), '--log-level', 'warning']
+        else:
+            comando = [sys.executable, 'app.py']
+        self.processo = subprocess.Popen(comando, cwd=RAIZ, env=self.ambiente,
+                                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        prazo = time.monotonic() + 30
+        while time.monotonic() < prazo:
+            if self.processo.poll() is not None:
+                raise RuntimeError(f'O app terminou ao iniciar (código {self.processo.returncode})')
+            try:
+                if requests.get(f'{self.url}/api/status/jobs', timeout=1).status_code == 200:
+                    return
+            except requests.RequestException:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError('O app não respondeu em 30s')
+
+    def metricas(self):
+        return ler_metricas(requests.get(f'{self.url}/api/status/metricas', timeout=10).text)
+
+    def parar(self):
+        if self.processo is not None:
+            self.processo.terminate()
+            try:
+                self.processo.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.processo.kill()
+        shutil.rmtree(self.temporario, ignore_errors=True)
+
+
+def _porta_livre():
+    import socket
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+# -- cenários: cada função faz um pedido completo e retorna (ok, status) ------
+
+def _perguntar(sessao, url, n):
+    response = sessao.post(f'{url}/api/perguntar', json={'pergunta': f'Pergunta {n} {uuid.uuid4().hex}'}, timeout=60)
+    return response.status_code == 200, response.status_code
+
+
+def _perguntar_stream(sessao, url, n):
+    with sessao.post(f'{url}/api/perguntar/stream', json={'pergunta': f'Pergunta {n} {uuid.uuid4().hex}'},
+                     stream=True, timeout=60) as response:
+        if response.status_code != 200:
+            return False, response.status_code
+        fim = False
+        for linha in response.iter_lines():
+            if linha:
+                evento = json.loads(linha)
+                if evento.get('erro'):
+                    return False, 'erro_stream'
+                fim = fim or evento.get('fim', False)
+        return fim, response.status_code
+
+
+def _gerar_imagem(sessao, url, n):
+    response = sessao.post(f'{url}/api/gerar-imagem', json={'prompt': f'paisagem {n} {uuid.uuid4().hex}'}, timeout=60)
+    if response.status_code == 200:
+        return not response.json().get('fallback'), 200
+    if response.status_code != 202:
+        return False, response.status_code
+    status_url = url + response.json()['status_url']
+    prazo = time.monotonic() + 120
+    while time.monotonic() < prazo:
+        time.sleep(0.1)
+        estado = sessao.get(status_url, timeout=30).json()
+        if estado['estado'] == 'concluido':
+            return not estado['resultado'].get('fallback'), 'fallback' if estado['resultado'].get('fallback') else 200
+        if estado['estado'] == 'erro':
+            return False, 'erro_job'
+    return False, 'timeout_job'
+
+
+def _estaticos(sessao, url, n):
+    response = sessao.get(f'{url}/' if n % 2 else f'{url}/index.html', timeout=30)
+    return response.status_code == 200, response.status_code
+
+
+PEDIDOS = {
+    'perguntar': _perguntar,
+    'perguntar-stream': _perguntar_stream,
+    'gerar-imagem': _gerar_imagem,
+    'estaticos': _estaticos,
+}
+
+
+def rodar_cenario(app, cenario, concorrencia, duracao):
+    pedido = PEDIDOS[cenario]
+    latencias = []
+    status = {}
+    erros = 0
+    lock = threading.Lock()
+    contador = iter(range(10 ** 9))
+    fim = time.monotonic() + duracao
+
+    def cliente(numero):
+        nonlocal erros
+        with requests.Session() as sessao:
+            # Cada cliente simulado com o próprio IP: os limites por cliente do app valem para cada um
+            sessao.headers['X-Forwarded-For'] = f'10.0.{numero // 250}.{numero % 250 + 1}'
+            while time.monotonic() < fim:
+                inicio = time.monotonic()
+                try:
+                    ok, codigo = pedido(sessao, app.url, next(contador))
+                except requests.RequestException as erro:
+                    ok, codigo = False, type(erro).__name__
+                latencia = time.monotonic() - inicio
+                with lock:
+                    status[str(codigo)] = status.get(str(codigo), 0) + 1
+                    if ok:
+                        latencias.append(latencia)
+                    else:
+                        erros += 1
+
+    antes = app.metricas()
+    cpu_antes = cpu_processos(app.processo.pid)
+    inicio = time.monotonic()
+    clientes = [threading.Thread(target=cliente, args=(i,)) for i in range(concorrencia)]
+    for thread in clientes:
+        thread.start()
+    for thread in clientes:
+        thread.join()
+    decorrido = time.monotonic() - inicio
+    cpu_depois = cpu_processos(app.processo.pid)
+    # Espera as cópias das métricas dos outros workers serem gravadas
+    time.sleep(1.5 if app.workers > 1 else 0)
+    depois = app.metricas()
+
+    rotas, pool = ROTAS_CENARIO[cenario]
+    ocupados = (_somar_rotas(depois, rotas) - _somar_rotas(antes, rotas)) / decorrido
+    resultado = {
+        'concorrencia': concorrencia,
+        'segundos': round(decorrido, 2),
+        'pedidos': len(latencias) + erros,
+        'erros': erros,
+        'status': status,
+        'rps': round(len(latencias) / decorrido, 2),
+        'latencia_p50': _arredondar(percentil(latencias, 0.50)),
+        'latencia_p95': _arredondar(percentil(latencias, 0.95)),
+        'latencia_p99': _arredondar(percentil(latencias, 0.99)),
+        'workers_ocupados_em_media': round(ocupados, 2),
+        'utilizacao_workers': round(ocupados / (POOLS_ASGI[pool] * app.workers), 3) if app.servidor == 'asgi' else None,
+        'cpu': round((cpu_depois - cpu_antes) / decorrido, 3) if cpu_antes is not None else None,
+    }
+    if cenario == 'gerar-imagem':
+        jobs = (_somar(depois, 'atomai_etapa_segundos_sum', etapa='job_gerar-imagem')
+                - _somar(antes, 'atomai_etapa_segundos_sum', etapa='job_gerar-imagem'))
+        resultado['utilizacao_jobs'] = round(jobs / decorrido / (JOBS_WORKERS * app.workers), 3)
+    return resultado
+
+
+def _arredondar(valor):
+    return None if valor is None else round(valor, 4)
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=RAIZ, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'desconhecido'
+
+
+def comparar(atual, anterior, tolerancia):
+    """Imprime a comparação por cenário e retorna os cenários que pioraram além da tolerância"""
+    piores = []
+    for cenario, medidas in atual['cenarios'].items():
+        antes = anterior.get('cenarios', {}).get(cenario)
+        if not antes:
+            continue
+        variacao_rps = (medidas['rps'] - antes['rps']) / antes['rps'] if antes['rps'] else 0.0
+        variacao_p95 = ((medidas['latencia_p95'] - antes['latencia_p95']) / antes['latencia_p95']
+                        if antes.get('latencia_p95') and medidas.get('latencia_p95') else 0.0)
+        piorou = variacao_rps < -tolerancia or variacao_p95 > tolerancia
+        print(f"{cenario}: RPS {antes['rps']} -> {medidas['rps']} ({variacao_rps:+.1%}), "
+              f"p95 {antes.get('latencia_p95')} -> {medidas.get('latencia_p95')} ({variacao_p95:+.1%})"
+              f"{'  PIOROU' if piorou else ''}")
+        if piorou:
+            piores.append(cenario)
+    return piores
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Teste de carga do app com APIs externas simuladas')
+    parser.add_argument('--cenarios', default=','.join(CENARIOS), help=f'separados por vírgula: {", ".join(CENARIOS)}')
+    parser.add_argument('--concorrencia', type=int, default=16, help='clientes simultâneos')
+    parser.add_argument('--duracao', type=float, default=20, help='segundos de cada cenário')
+    parser.add_argument('--servidor', choices=['asgi', 'flask'], default='asgi')
+    parser.add_argument('--workers', type=int, default=1, help='processos do uvicorn (modo asgi)')
+    parser.add_argument('--latencia-hf', type=float, default=0.5, help='segundos para o Hugging Face gerar uma imagem')
+    parser.add_argument('--latencia-cohere', type=float, default=0.3, help='segundos para a Cohere responder')
+    parser.add_argument('--carregamento', type=float, default=0, help='segundos de cold start dos modelos')
+    parser.add_argument('--taxa-erro', type=float, default=0.0, help='fração dos pedidos às APIs que recebe 500')
+    parser.add_argument('--tamanho-imagem', type=int, default=512, help='lado da imagem gerada, em pixels')
+    parser.add_argument('--offline', action='store_true', help='usa só o provedor local, sem chamar o servidor falso')
+    parser.add_argument('--comparar', help='resultado anterior (JSON) para comparar')
+    parser.add_argument('--tolerancia', type=float, default=0.15, help='piora relativa aceita na comparação')
+    parser.add_argument('--saida', help='arquivo do resultado (padrão: benchmarks/resultados/<data>_<commit>.json)')
+    args = parser.parse_args()
+
+    cenarios = [c.strip() for c in args.cenarios.split(',') if c.strip()]
+    desconhecidos = set(cenarios) - set(CENARIOS)
+    if desconhecidos:
+        parser.error(f'cenários desconhecidos: {", ".join(sorted(desconhecidos))}')
+
+    falso = criar_servidor(carregamento=args.carregamento, latencia=args.latencia_hf,
+                           latencia_cohere=args.latencia_cohere, taxa_erro=args.taxa_erro,
+                           tamanho_imagem=args.tamanho_imagem)
+    threading.Thread(target=falso.serve_forever, daemon=True).start()
+    app = App(args.servidor, args.workers if args.servidor == 'asgi' else 1,
+              f'http://127.0.0.1:{falso.server_port}', offline=args.offline)
+
+    resultado = {
+        'commit': _commit(),
+        'data': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'parametros': {chave: valor for chave, valor in vars(args).items() if chave not in ('comparar', 'saida')},
+        'cenarios': {},
+    }
+    try:
+        app.iniciar()
+        for cenario in cenarios:
+            print(f'Cenário {cenario}: {args.concorrencia} clientes por {args.duracao:g}s...', flush=True)
+            medidas = rodar_cenario(app, cenario, args.concorrencia, args.duracao)
+            resultado['cenarios'][cenario] = medidas
+            print(f"  {medidas['rps']} pedidos/s, p50 {medidas['latencia_p50']}s, p95 {medidas['latencia_p95']}s, "
+                  f"p99 {medidas['latencia_p99']}s, {medidas['erros']} erros, "
+                  f"{medidas['workers_ocupados_em_media']} workers ocupados em média", flush=True)
+    finally:
+        app.parar()
+        falso.shutdown()
+    resultado['servidor_falso'] = falso.estado.resumo()
+
+    saida = args.saida or os.path.join(RESULTADOS_DIR, f"{time.strftime('%Y%m%d_%H%M%S')}_{resultado['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(saida)), exist_ok=True)
+    with open(saida, 'w', encoding='utf-8') as f:
+        json.dump(resultado, f, indent=2, ensure_ascii=False)
+    print(f'Resultado gravado em {saida}')
+
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as f:
+            anterior = json.load(f)
+        print(f"Comparação com {args.comparar} (commit {anterior.get('commit')}):")
+        if comparar(resultado, anterior, args.tolerancia):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Mede o custo de importar o gerador de imagens como biblioteca
+
+Cada módulo é importado num processo Python novo, executado num diretório
+temporário vazio. São medidos o tempo de importação e a memória residente
+(RSS máxima) do processo, comparados com um processo que não importa nada,
+e verificado que a importação não tem efeitos colaterais: nada impresso,
+nenhum arquivo criado e nenhuma biblioteca pesada carregada.
+
+Uso:
+    python benchmarks/importacao.py [--repeticoes 5] [--orcamento-ms 100] [--orcamento-mb 15]
+
+Termina com código 1 se algum módulo passar do orçamento.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULOS = ['funçoes.gerador', 'gerador_imagens_huggingface_v2_corrigido']
+
+# Bibliotecas que só devem ser carregadas quando usadas
+PESADAS = ['matplotlib', 'PIL', 'requests', 'dotenv']
+
+_MEDIR = '''
+import io, json, resource, sys, time, contextlib
+saida = io.StringIO()
+inicio = time.perf_counter()
+with contextlib.redirect_stdout(saida):
+    if sys.argv[1]:
+        __import__(sys.argv[1])
+duracao = time.perf_counter() - inicio
+print(json.dumps({
+    'segundos': duracao,
+    'rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'impresso': saida.getvalue(),
+    'carregadas': [nome for nome in sys.argv[2:] if nome in sys.modules],
+}))
+'''
+
+
+def medir(modulo):
+    with tempfile.TemporaryDirectory() as vazio:
+        ambiente = dict(os.environ, PYTHONPATH=RAIZ, PYTHONDONTWRITEBYTECODE='1')
+        saida = subprocess.run([sys.executable, '-c', _MEDIR, modulo] + PESADAS, cwd=vazio, env=ambiente,
+                               capture_output=True, text=True, check=True)
+        resultado = json.loads(saida.stdout)
+        resultado['arquivos_criados'] = os.listdir(vazio)
+    return resultado
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeticoes', type=int, default=5)
+    parser.add_argument('--orcamento-ms', type=float, default=float(os.environ.get('ORCAMENTO_IMPORTACAO_MS', 100)))
+    parser.add_argument('--orcamento-mb', type=float, default=float(os.environ.get('ORCAMENTO_IMPORTACAO_MB', 15)))
+    args = parser.parse_args()
+
+    base = [medir('') for _ in range(args.repeticoes)]
+    rss_base = min(r['rss_kb'] for r in base)
+
+    aprovado = True
+    for modulo in MODULOS:
+        medidas = [medir(modulo) for _ in range(args.repeticoes)]
+        # A mediana é menos sensível a um processo que foi atrasado pelo sistema
+        tempo_ms = sorted(r['segundos'] for r in medidas)[len(medidas) // 2] * 1000
+        rss_mb = (min(r['rss_kb'] for r in medidas) - rss_base) / 1024
+        problemas = []
+        if tempo_ms > args.orcamento_ms:
+            problemas.append(f'tempo acima de {args.orcamento_ms:.0f} ms')
+        if rss_mb > args.orcamento_mb:
+            problemas.append(f'memória acima de {args.orcamento_mb:.0f} MB')
+        if medidas[0]['impresso']:
+            problemas.append('imprime ao ser importado')
+        if medidas[0]['arquivos_criados']:
+            problemas.append(f"cria arquivos: {', '.join(medidas[0]['arquivos_criados'])}")
+        if medidas[0]['carregadas']:
+            problemas.append(f"carrega {', '.join(medidas[0]['carregadas'])}")
+        aprovado = aprovado and not problemas
+        print(f"{modulo}: {tempo_ms:.1f} ms, +{rss_mb:.1f} MB RSS"
+              f"{' -> ' + '; '.join(problemas) if problemas else ' (ok)'}")
+
+    sys.exit(0 if aprovado else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+"""
+Servidor local que imita a Inference API do Hugging Face e o chat da Cohere, para testes
+
+Hugging Face (POST /models/<modelo>): cada modelo começa frio. O primeiro
+pedido a um modelo frio recebe 503 com {"error": "Model ... is currently
+loading", "estimated_time": N}, como a API de verdade, e o modelo fica
+carregando por N segundos (--carregamento 0 deixa todos já carregados);
+depois disso os pedidos recebem uma imagem PNG de --tamanho-imagem pixels
+de lado. Um modelo sem pedidos por --ocioso segundos volta a ficar frio.
+
+Cohere (POST /v1/chat): responde {"text": ...} depois de --latencia-cohere
+segundos, ou, com "stream": true no corpo, um evento JSON por linha
+(text-generation palavra a palavra, espalhadas pela mesma latência, e
+stream-end no fim).
+
+Uma fração --taxa-erro dos pedidos às duas APIs recebe 500.
+
+Uso:
+    python benchmarks/servidor_falso.py [--porta 8765] [--carregamento 5] [--ocioso 60] [--latencia 0.5]
+    HUGGINGFACE_API_URL=http://127.0.0.1:8765/models/ COHERE_API_URL=http://127.0.0.1:8765/v1/chat python app.py
+
+GET /estado mostra o estado de cada modelo e quantos pedidos cada API recebeu.
+"""
+
+import argparse
+import json
+import os
+import random
+import struct
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def png(largura, altura, cor=(200, 80, 40), ruido=False):
+    """
+    PNG RGB montado sem o Pillow: de uma cor só, ou com ruído (que não
+    comprime, para o arquivo ter o tamanho de uma imagem de verdade)
+    """
+    def bloco(tipo, dados):
+        return struct.pack('>I', len(dados)) + tipo + dados + struct.pack('>I', zlib.crc32(tipo + dados))
+    if ruido:
+        pixels = b''.join(b'\x00' + os.urandom(3 * largura) for _ in range(altura))
+    else:
+        pixels = (b'\x00' + bytes(cor) * largura) * altura
+    return (b'\x89PNG\r\n\x1a\n'
+            + bloco(b'IHDR', struct.pack('>IIBBBBB', largura, altura, 8, 2, 0, 0, 0))
+            + bloco(b'IDAT', zlib.compress(pixels, 1))
+            + bloco(b'IEND', b''))
+
+
+class EstadoModelos:
+    """Estado frio/carregando/quente de cada modelo simulado"""
+
+    def __init__(self, carregamento, ocioso):
+        self.carregamento = carregamento
+        self.ocioso = ocioso
+        self.modelos = {}
+        self.pedidos_cohere = 0
+        self.erros_simulados = 0
+        self.lock = threading.Lock()
+
+    def pedir(self, modelo):
+        """
+        Retorna:
+        - None se o modelo está pronto, ou os segundos que faltam para ele carregar
+        """
+        agora = time.monotonic()
+        with self.lock:
+            estado = self.modelos.setdefault(modelo, {'pronto_em': None, 'ultimo_pedido': 0, 'pedidos': 0,
+                                                      'respostas_loading': 0})
+            estado['pedidos'] += 1
+            if estado['pronto_em'] is not None and agora - estado['ultimo_pedido'] > self.ocioso:
+                # Ficou ocioso demais: foi descarregado
+                estado['pronto_em'] = None
+            estado['ultimo_pedido'] = agora
+            if estado['pronto_em'] is None:
+                estado['pronto_em'] = agora + self.carregamento if self.carregamento > 0 else agora
+            if agora < estado['pronto_em']:
+                estado['respostas_loading'] += 1
+                return estado['pronto_em'] - agora
+            return None
+
+    def resumo(self):
+        agora = time.monotonic()
+        with self.lock:
+            modelos = {
+                modelo: {
+                    'estado': ('frio' if estado['pronto_em'] is None or agora - estado['ultimo_pedido'] > self.ocioso
+                               else 'carregando' if agora < estado['pronto_em'] else 'quente'),
+                    'pedidos': estado['pedidos'],
+                    'respostas_loading': estado['respostas_loading'],
+                }
+                for modelo, estado in self.modelos.items()
+            }
+            return {'modelos': modelos, 'pedidos_cohere': self.pedidos_cohere,
+                    'erros_simulados': self.erros_simulados}
+
+
+def criar_servidor(porta=0, carregamento=5.0, ocioso=60.0, latencia=0.5, imagem=None, latencia_cohere=0.5,
+                   taxa_erro=0.0, tamanho_imagem=512):
+    """
+    Cria o servidor (sem iniciá-lo); use servidor.serve_forever() numa thread
+
+    Parâmetros:
+    - porta (int): porta local (0 escolhe uma livre; veja servidor.server_port)
+    - carregamento (float): segundos que um modelo frio leva para carregar (0: sem cold start)
+    - ocioso (float): segundos sem pedidos até o modelo ser descarregado
+    - latencia (float): segundos para "gerar" uma imagem com 30 passos (proporcional aos
+      num_inference_steps pedidos, como num modelo de verdade)
+    - imagem (bytes): imagem devolvida (padrão: PNG com ruído de tamanho_imagem pixels de lado)
+    - latencia_cohere (float): segundos para a Cohere responder
+    - taxa_erro (float): fração dos pedidos que recebe 500
+    - tamanho_imagem (int): lado, em pixels, da imagem padrão
+    """
+    estado = EstadoModelos(carregamento, ocioso)
+    conteudo = imagem or png(tamanho_imagem, tamanho_imagem, ruido=True)
+
+    def erro_simulado():
+        if taxa_erro and random.random() < taxa_erro:
+            with estado.lock:
+                estado.erros_simulados += 1
+            return True
+        return False
+
+    class Manipulador(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _responder(self, status, corpo, tipo):
+            self.send_response(status)
+            self.send_header('Content-Type', tipo)
+            self.send_header('Content-Length', str(len(corpo)))
+            self.end_headers()
+            self.wfile.write(corpo)
+
+        def _json(self, status, dados):
+            self._responder(status, json.dumps(dados).encode('utf-8'), 'application/json')
+
+        def do_GET(self):
+            if self.path == '/estado':
+                return self._json(200, estado.resumo())
+            self._json(404, {'error': 'not found'})
+
+        def _cohere(self, corpo):
+            with estado.lock:
+                estado.pedidos_cohere += 1
+            if erro_simulado():
+                return self._json(500, {'message': 'internal server error'})
+            pergunta = str(corpo.get('message', ''))
+            palavras = f'Resposta simulada para: {pergunta}'.split()
+            if not corpo.get('stream'):
+                time.sleep(latencia_cohere)
+                return self._json(200, {'text': ' '.join(palavras)})
+
+            # Um evento JSON por linha, em chunked encoding, como o stream da API de verdade
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/stream+json')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+
+            def enviar(evento):
+                dados = json.dumps(evento).encode('utf-8') + b'\n'
+                self.wfile.write(f'{len(dados):x}\r\n'.encode() + dados + b'\r\n')
+                self.wfile.flush()
+
+            enviar({'event_type': 'stream-start', 'is_finished': False})
+            for i, palavra in enumerate(palavras):
+                time.sleep(latencia_cohere / len(palavras))
+                enviar({'event_type': 'text-generation', 'is_finished': False,
+                        'text': palavra if i == 0 else f' {palavra}'})
+            enviar({'event_type': 'stream-end', 'is_finished': True, 'finish_reason': 'COMPLETE'})
+            self.wfile.write(b'0\r\n\r\n')
+
+        def do_POST(self):
+            corpo = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if self.path == '/v1/chat':
+                try:
+                    return self._cohere(json.loads(corpo or b'{}'))
+                except ValueError:
+                    return self._json(400, {'message': 'invalid json'})
+            if not self.path.startswith('/models/'):
+                return self._json(404, {'error': 'not found'})
+            modelo = self.path[len('/models/'):]
+            restante = estado.pedir(modelo)
+            if restante is not None:
+                return self._json(503, {'error': f'Model {modelo} is currently loading',
+                                        'estimated_time': round(restante, 1)})
+            if erro_simulado():
+                return self._json(500, {'error': 'Internal Server Error'})
+            try:
+                passos = float(json.loads(corpo)['parameters']['num_inference_steps'])
+            except (ValueError, KeyError, TypeError):
+                passos = 30
+            time.sleep(latencia * passos / 30)
+            self._responder(200, conteudo, 'image/png')
+
+        def log_message(self, *args):
+            pass
+
+    servidor = ThreadingHTTPServer(('127.0.0.1', porta), Manipulador)
+    servidor.daemon_threads = True
+    servidor.estado = estado
+    return servidor
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Servidor local que imita a Inference API do Hugging Face e a Cohere')
+    parser.add_argument('--porta', type=int, default=8765)
+    parser.add_argument('--carregamento', type=float, default=5.0, help='segundos para um modelo frio carregar')
+    parser.add_argument('--ocioso', type=float, default=60.0, help='segundos sem pedidos até descarregar o modelo')
+    parser.add_argument('--latencia', type=float, default=0.5, help='segundos para gerar uma imagem')
+    parser.add_argument('--latencia-cohere', type=float, default=0.5, help='segundos para a Cohere responder')
+    parser.add_argument('--taxa-erro', type=float, default=0.0, help='fração dos pedidos que recebe 500')
+    parser.add_argument('--tamanho-imagem', type=int, default=512, help='lado da imagem gerada, em pixels')
+    args = parser.parse_args()
+    servidor = criar_servidor(args.porta, args.carregamento, args.ocioso, args.latencia,
+                              latencia_cohere=args.latencia_cohere, taxa_erro=args.taxa_erro,
+                              tamanho_imagem=args.tamanho_imagem)
+    print(f'Hugging Face falso em http://127.0.0.1:{servidor.server_port}/models/')
+    print(f'Cohere falsa em http://127.0.0.1:{servidor.server_port}/v1/chat')
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
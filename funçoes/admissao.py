@@ -0,0 +1,247 @@
+"""
+Controle de admissão das rotas /api/*: limite de taxa por cliente e descarte de carga
+
+Limite de taxa: cada par (grupo de rotas, cliente) tem um balde de fichas
+(token bucket). O balde enche a TAXA pedidos por minuto até a RAJADA, e
+cada pedido gasta uma ficha; sem ficha, o pedido recebe 429 com
+Retry-After igual ao tempo até a próxima ficha.
+
+Os baldes ficam num arquivo mapeado em memória (mmap), compartilhado pelos
+workers do gunicorn, numa tabela de tamanho fixo (ADMISSAO_BALDES posições,
+24 bytes cada) endereçada pelo hash do par. A atualização de um balde é
+protegida por um flock no arquivo, e o custo por pedido fica na casa dos
+microssegundos, sem SQLite nem rede. Um balde que já teria enchido de novo
+equivale a um balde vazio, então sua posição pode ser reaproveitada por
+outro cliente sem perda de informação.
+
+Descarte de carga: cada grupo pode ter uma verificação de sobrecarga (por
+exemplo, a fila de jobs grande demais ou os modelos lentos demais). Com
+sobrecarga, os pedidos do grupo recebem 429 com Retry-After até ela passar.
+A verificação é feita no máximo uma vez por segundo em cada processo, e o
+pedido que a faz é atendido, para que as medidas continuem sendo atualizadas.
+
+Configuração (variáveis de ambiente):
+- ADMISSAO_ATIVA: 0 desliga o controle de admissão (padrão: 1)
+- TAXA_GERAR_IMAGEM / RAJADA_GERAR_IMAGEM: pedidos de imagem por minuto e rajada, por cliente (padrão: 6 / 3)
+- TAXA_PERGUNTAR / RAJADA_PERGUNTAR: perguntas por minuto e rajada, por cliente (padrão: 20 / 5)
+- TAXA_PERGUNTAR_LOTE / RAJADA_PERGUNTAR_LOTE: lotes de perguntas por minuto e rajada, por cliente (padrão: 2 / 2)
+- TAXA_API / RAJADA_API: demais rotas /api/* por minuto e rajada, por cliente (padrão: 240 / 60)
+- ADMISSAO_BALDES: posições da tabela de baldes (padrão: 65536)
+- ADMISSAO_FILA_MAXIMA: jobs pendentes a partir dos quais pedidos de imagem são descartados (padrão: 50)
+- ADMISSAO_LATENCIA_MAXIMA: latência esperada, em segundos, a partir da qual pedidos de imagem são descartados (padrão: 90)
+"""
+
+import hashlib
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # Sem fcntl (Windows) os baldes continuam funcionando, mas só dentro de cada processo
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+ADMISSAO_ATIVA = os.environ.get('ADMISSAO_ATIVA', '1') != '0'
+ADMISSAO_BALDES = int(os.environ.get('ADMISSAO_BALDES', 65536))
+ADMISSAO_FILA_MAXIMA = int(os.environ.get('ADMISSAO_FILA_MAXIMA', 50))
+ADMISSAO_LATENCIA_MAXIMA = float(os.environ.get('ADMISSAO_LATENCIA_MAXIMA', 90))
+
+# Grupo de rotas -> (pedidos por minuto, rajada), por cliente
+LIMITES = {
+    'gerar-imagem': (float(os.environ.get('TAXA_GERAR_IMAGEM', 6)), int(os.environ.get('RAJADA_GERAR_IMAGEM', 3))),
+    'perguntar': (float(os.environ.get('TAXA_PERGUNTAR', 20)), int(os.environ.get('RAJADA_PERGUNTAR', 5))),
+    'perguntar-lote': (float(os.environ.get('TAXA_PERGUNTAR_LOTE', 2)),
+                       int(os.environ.get('RAJADA_PERGUNTAR_LOTE', 2))),
+    'api': (float(os.environ.get('TAXA_API', 240)), int(os.environ.get('RAJADA_API', 60))),
+}
+
+# Prefixos de rota e o grupo que os limita (o primeiro que casar vence)
+ROTAS = [
+    ('/api/gerar-imagem', 'gerar-imagem'),
+    # A edição usa os mesmos modelos e a mesma fila da geração
+    ('/api/editar-imagem', 'gerar-imagem'),
+    # Um lote vale até LOTE_MAXIMO perguntas: tem balde próprio, antes do prefixo das perguntas
+    ('/api/perguntar/lote', 'perguntar-lote'),
+    ('/api/perguntar', 'perguntar'),
+    ('/api/', 'api'),
+]
+
+# Posição de um balde: hash do par (0 = livre), fichas e momento da última atualização
+_BALDE = struct.Struct('<Qdd')
+# Posições vizinhas examinadas quando a posição do hash está ocupada por outro par
+SONDAGENS = 4
+# Intervalo mínimo entre duas verificações de sobrecarga do mesmo grupo, em segundos
+INTERVALO_SOBRECARGA = 1.0
+
+
+def grupo_da_rota(caminho):
+    for prefixo, grupo in ROTAS:
+        if caminho.startswith(prefixo):
+            return grupo
+    return None
+
+
+class Admissao:
+    """
+    Decide se um pedido às rotas /api/* é atendido
+
+    Parâmetros:
+    - caminho (str): arquivo com os baldes, compartilhado pelos processos
+    - limites (dict): grupo -> (pedidos por minuto, rajada)
+    - baldes (int): posições da tabela de baldes
+    """
+
+    def __init__(self, caminho, limites=None, baldes=None):
+        self.caminho = caminho
+        self.limites = LIMITES if limites is None else limites
+        self.baldes = ADMISSAO_BALDES if baldes is None else baldes
+        # Depois disso sem pedidos, qualquer balde já encheu de novo
+        self._tempo_para_encher = max(rajada / (taxa / 60) for taxa, rajada in self.limites.values())
+        self._sobrecargas = {}
+        self._estado_sobrecarga = {}
+        self._arquivo = None
+        self._mapa = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.admitidos = {grupo: 0 for grupo in self.limites}
+        self.limitados = {grupo: 0 for grupo in self.limites}
+        self.descartados = {grupo: 0 for grupo in self.limites}
+
+    def registrar_sobrecarga(self, grupo, verificar):
+        """
+        Registra a verificação de sobrecarga de um grupo
+
+        Parâmetros:
+        - verificar (callable): sem argumentos; retorna None quando está tudo bem,
+          ou os segundos sugeridos para o cliente tentar de novo
+        """
+        self._sobrecargas[grupo] = verificar
+
+    def _abrir(self):
+        # Cada processo abre o arquivo de novo: o flock vale por descritor aberto,
+        # e um descritor herdado pelo fork não excluiria o processo pai
+        if self._pid == os.getpid():
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.caminho)), exist_ok=True)
+        tamanho = self.baldes * _BALDE.size
+        arquivo = open(self.caminho, 'a+b')
+        if os.fstat(arquivo.fileno()).st_size < tamanho:
+            arquivo.truncate(tamanho)
+        self._arquivo = arquivo
+        self._mapa = mmap.mmap(arquivo.fileno(), tamanho)
+        self._pid = os.getpid()
+
+    def _gastar_ficha(self, grupo, cliente, agora):
+        """
+        Retorna:
+        - 0 se havia ficha, ou os segundos até a próxima ficha
+        """
+        taxa, rajada = self.limites[grupo]
+        por_segundo = taxa / 60
+        chave = int.from_bytes(hashlib.blake2b(f'{grupo}\0{cliente}'.encode('utf-8'), digest_size=8).digest(),
+                               'little') or 1
+        inicio = chave % self.baldes
+
+        with self._lock:
+            self._abrir()
+            if fcntl:
+                fcntl.flock(self._arquivo.fileno(), fcntl.LOCK_EX)
+            try:
+                livre = None
+                mais_antiga = None
+                for i in range(SONDAGENS):
+                    posicao = (inicio + i) % self.baldes * _BALDE.size
+                    dono, fichas, atualizado = _BALDE.unpack_from(self._mapa, posicao)
+                    if dono == chave:
+                        break
+                    if livre is None and (dono == 0 or agora - atualizado > self._tempo_para_encher):
+                        livre = posicao
+                    if mais_antiga is None or atualizado < mais_antiga[1]:
+                        mais_antiga = (posicao, atualizado)
+                else:
+                    # Cliente novo: balde cheio numa posição livre ou, se todas as
+                    # vizinhas estão em uso, na usada há mais tempo
+                    posicao = livre if livre is not None else mais_antiga[0]
+                    fichas, atualizado = rajada, agora
+
+                fichas = min(rajada, fichas + max(0.0, agora - atualizado) * por_segundo)
+                if fichas >= 1:
+                    _BALDE.pack_into(self._mapa, posicao, chave, fichas - 1, agora)
+                    return 0
+                _BALDE.pack_into(self._mapa, posicao, chave, fichas, agora)
+                return (1 - fichas) / por_segundo
+            finally:
+                if fcntl:
+                    fcntl.flock(self._arquivo.fileno(), fcntl.LOCK_UN)
+
+    def _sobrecarregado(self, grupo, agora):
+        verificar = self._sobrecargas.get(grupo)
+        if verificar is None:
+            return None
+        verificado, espera = self._estado_sobrecarga.get(grupo, (0.0, None))
+        if agora - verificado < INTERVALO_SOBRECARGA:
+            return espera
+        try:
+            espera = verificar()
+        except Exception as e:
+            logger.error(f'Erro ao verificar sobrecarga de {grupo}: {str(e)}')
+            espera = None
+        self._estado_sobrecarga[grupo] = (agora, espera)
+        # O pedido que fez a verificação sempre passa: sem nenhum pedido, as
+        # medidas (ex.: a latência dos modelos) nunca mostrariam o fim da sobrecarga
+        return None
+
+    def admitir(self, caminho, cliente):
+        """
+        Decide se o pedido é atendido
+
+        Parâmetros:
+        - caminho (str): caminho da rota
+        - cliente (str): identificação do cliente (ex.: IP)
+
+        Retorna:
+        - None se o pedido pode seguir, ou tupla (segundos para tentar de novo,
+          motivo) com motivo 'limite' ou 'sobrecarga'
+        """
+        grupo = grupo_da_rota(caminho)
+        if not ADMISSAO_ATIVA or grupo not in self.limites:
+            return None
+        agora = time.time()
+
+        espera = self._sobrecarregado(grupo, agora)
+        if espera is not None:
+            self.descartados[grupo] += 1
+            return espera, 'sobrecarga'
+
+        espera = self._gastar_ficha(grupo, cliente, agora)
+        if espera:
+            self.limitados[grupo] += 1
+            return espera, 'limite'
+        self.admitidos[grupo] += 1
+        return None
+
+    @staticmethod
+    def retry_after(espera):
+        """Valor do cabeçalho Retry-After (segundos inteiros, ao menos 1)"""
+        return str(max(1, math.ceil(espera)))
+
+    def estatisticas(self):
+        """Contadores deste processo, por grupo de rotas"""
+        return {
+            grupo: {
+                'pedidos_por_minuto': taxa,
+                'rajada': rajada,
+                'admitidos': self.admitidos[grupo],
+                'limitados': self.limitados[grupo],
+                'descartados': self.descartados[grupo],
+                'sobrecarga': self._estado_sobrecarga.get(grupo, (0.0, None))[1] is not None,
+            }
+            for grupo, (taxa, rajada) in self.limites.items()
+        }
@@ -0,0 +1,221 @@
+"""
+Aquecimento dos modelos do Hugging Face em segundo plano
+
+Um modelo que ficou um tempo sem uso é descarregado pela Inference API, e a
+próxima geração recebe "loading" (cold start). O aquecedor evita isso
+mandando de tempos em tempos uma geração mínima (1 passo de inferência) para
+cada modelo configurado, dentro de um orçamento de requisições por hora:
+
+- um modelo que respondeu (a uma geração de verdade ou a um aquecimento) há
+  menos de AQUECIMENTO_INTERVALO segundos é considerado quente
+- um modelo carregando só é chamado de novo quando passa o tempo estimado
+  pelo próprio Hugging Face (estimated_time), sem esperas fixas
+- só se aquece quando há tráfego: houve pedidos de imagem nos últimos
+  AQUECIMENTO_JANELA segundos, ou, pelo histórico dos últimos dias, a hora
+  que vem (daqui a AQUECIMENTO_ANTECEDENCIA segundos) costuma ter pedidos
+
+O estado dos modelos (carregando, último sucesso) é compartilhado com
+funçoes/saude_modelos.py. O aquecedor roda numa thread por processo, e o
+orçamento também é por processo.
+
+Configuração (variáveis de ambiente):
+- AQUECIMENTO_ATIVO: 0 desliga o aquecimento (padrão: 1)
+- AQUECIMENTO_INTERVALO: segundos sem resposta depois dos quais um modelo é aquecido (padrão: 300)
+- AQUECIMENTO_ORCAMENTO: aquecimentos por hora, somando todos os modelos (padrão: 30)
+- AQUECIMENTO_JANELA: segundos após um pedido em que os modelos continuam aquecidos (padrão: 1800)
+- AQUECIMENTO_ANTECEDENCIA: segundos de antecedência para aquecer antes de um horário movimentado (padrão: 600)
+- AQUECIMENTO_ESPERA_MAXIMA: maior espera, em segundos, por um modelo carregando (padrão: 60)
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+import requests
+
+from funçoes import http_cliente, imagens
+from funçoes.saude_modelos import saude_modelos
+
+logger = logging.getLogger(__name__)
+
+AQUECIMENTO_ATIVO = os.environ.get('AQUECIMENTO_ATIVO', '1') != '0'
+AQUECIMENTO_INTERVALO = float(os.environ.get('AQUECIMENTO_INTERVALO', 300))
+AQUECIMENTO_ORCAMENTO = int(os.environ.get('AQUECIMENTO_ORCAMENTO', 30))
+AQUECIMENTO_JANELA = float(os.environ.get('AQUECIMENTO_JANELA', 1800))
+AQUECIMENTO_ANTECEDENCIA = float(os.environ.get('AQUECIMENTO_ANTECEDENCIA', 600))
+AQUECIMENTO_ESPERA_MAXIMA = float(os.environ.get('AQUECIMENTO_ESPERA_MAXIMA', 60))
+
+# Dias de histórico usados para prever o tráfego de cada hora
+DIAS_HISTORICO = 7
+
+# Geração mais barata possível: só serve para o modelo ser carregado
+PAYLOAD_AQUECIMENTO = {
+    "inputs": "warm up",
+    "parameters": {"num_inference_steps": 1},
+    "options": {"use_cache": False, "wait_for_model": False},
+}
+
+
+def espera_carregamento(tempo_estimado, padrao=10):
+    """Segundos a esperar por um modelo carregando, pelo tempo estimado do Hugging Face e com limite"""
+    return min(tempo_estimado or padrao, AQUECIMENTO_ESPERA_MAXIMA)
+
+
+class AquecedorModelos:
+    """
+    Mantém os modelos aquecidos enquanto houver tráfego
+
+    Parâmetros:
+    - modelos (list): modelos a manter aquecidos
+    - token (str): token do Hugging Face
+    - intervalo (float): segundos sem resposta depois dos quais o modelo é aquecido
+    - orcamento (int): aquecimentos por hora, somando todos os modelos
+    - janela (float): segundos após um pedido em que os modelos continuam aquecidos
+    - url_base (str): URL base da Inference API (padrão: a de funçoes/imagens.py)
+    """
+
+    def __init__(self, modelos, token, intervalo=None, orcamento=None, janela=None, url_base=None):
+        self.modelos = list(modelos)
+        self.token = token
+        self.intervalo = AQUECIMENTO_INTERVALO if intervalo is None else intervalo
+        self.orcamento = AQUECIMENTO_ORCAMENTO if orcamento is None else orcamento
+        self.janela = AQUECIMENTO_JANELA if janela is None else janela
+        self.url_base = url_base
+        self._aquecimentos = deque()
+        # Hora desde a época (int(timestamp // 3600)) -> pedidos, para prever as horas movimentadas
+        self._trafego = {}
+        self._ultimo_pedido = 0.0
+        self._pid = None
+        self._lock = threading.Lock()
+        self._acordar = threading.Event()
+        self.enviados = 0
+        self.prontos = 0
+        self.carregando = 0
+        self.erros = 0
+
+    def iniciar(self):
+        """Inicia a thread do aquecedor neste processo (de novo, se o processo foi criado por fork)"""
+        if not AQUECIMENTO_ATIVO:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._executar_continuamente, name='aquecedor-modelos', daemon=True).start()
+
+    def registrar_pedido(self, agora=None):
+        """Anota um pedido de imagem, para saber quando há tráfego"""
+        agora = time.time() if agora is None else agora
+        # Índice que só cresce, ao contrário de (dia do ano, hora), que volta a 1 em janeiro
+        indice = int(agora // 3600)
+        with self._lock:
+            self._ultimo_pedido = agora
+            if indice not in self._trafego:
+                for antiga in [i for i in self._trafego if i <= indice - 24 * DIAS_HISTORICO]:
+                    del self._trafego[antiga]
+            self._trafego[indice] = self._trafego.get(indice, 0) + 1
+        self.iniciar()
+        # Um pedido pode encontrar modelos frios: reavalia já
+        self._acordar.set()
+
+    def _ha_trafego(self, agora):
+        if agora - self._ultimo_pedido < self.janela:
+            return True
+        # Horário movimentado nos dias anteriores?
+        hora = time.localtime(agora + AQUECIMENTO_ANTECEDENCIA).tm_hour
+        # Hora local de cada índice; os dias são contados pela data local
+        locais = {indice: time.localtime(indice * 3600) for indice in self._trafego}
+        dias = {(local.tm_year, local.tm_yday) for local in locais.values()}
+        if not dias:
+            return False
+        media = sum(quantidade for indice, quantidade in self._trafego.items()
+                    if locais[indice].tm_hour == hora) / len(dias)
+        return media >= 1
+
+    def _orcamento_disponivel(self, agora):
+        while self._aquecimentos and self._aquecimentos[0] < agora - 3600:
+            self._aquecimentos.popleft()
+        return len(self._aquecimentos) < self.orcamento
+
+    def _aquecer(self, modelo):
+        url = (self.url_base or imagens.HUGGINGFACE_API_URL) + modelo
+        self.enviados += 1
+        try:
+            response = http_cliente.post(url, headers={"Authorization": f"Bearer {self.token}"},
+                                         json=PAYLOAD_AQUECIMENTO, timeout=30, stream=True)
+        except requests.RequestException as erro:
+            self.erros += 1
+            logger.warning(f'Erro ao aquecer o modelo {modelo}: {str(erro)}')
+            return
+        with response:
+            if response.status_code == 200:
+                # O corpo (a imagem) não interessa: a conexão é fechada sem baixá-lo
+                self.prontos += 1
+                saude_modelos.marcar_pronto(modelo)
+            elif "loading" in response.text.lower():
+                self.carregando += 1
+                estimado = imagens.tempo_estimado(response)
+                saude_modelos.marcar_carregando(modelo, estimado)
+                logger.info(f'Modelo {modelo} carregando, previsão de {estimado or "?"}s')
+            else:
+                self.erros += 1
+                logger.warning(f'Aquecimento do modelo {modelo} falhou: {response.status_code}')
+
+    def executar_ciclo(self, agora=None):
+        """
+        Aquece os modelos que precisam, dentro do orçamento
+
+        Retorna:
+        - float: segundos até o próximo ciclo ser necessário
+        """
+        agora = time.time() if agora is None else agora
+        with self._lock:
+            if not self._ha_trafego(agora):
+                return min(self.intervalo, AQUECIMENTO_ANTECEDENCIA)
+        proximo = self.intervalo
+        for modelo in self.modelos:
+            carregando_ate, ultimo_pronto = saude_modelos.situacao(modelo)
+            if carregando_ate > agora:
+                # Respeita o tempo estimado de carregamento antes de chamar de novo
+                proximo = min(proximo, carregando_ate - agora)
+                continue
+            quente_ate = ultimo_pronto + self.intervalo
+            if quente_ate > agora:
+                proximo = min(proximo, quente_ate - agora)
+                continue
+            with self._lock:
+                if not self._orcamento_disponivel(agora):
+                    return max(1.0, self._aquecimentos[0] + 3600 - agora)
+                self._aquecimentos.append(agora)
+            self._aquecer(modelo)
+            carregando_ate, _ = saude_modelos.situacao(modelo)
+            if carregando_ate > agora:
+                proximo = min(proximo, carregando_ate - agora)
+        return max(1.0, proximo)
+
+    def _executar_continuamente(self):
+        while True:
+            try:
+                espera = self.executar_ciclo()
+            except Exception as e:
+                logger.error(f'Erro no aquecedor de modelos: {str(e)}')
+                espera = 60
+            self._acordar.wait(timeout=espera)
+            self._acordar.clear()
+
+    def estatisticas(self):
+        with self._lock:
+            agora = time.time()
+            self._orcamento_disponivel(agora)
+            return {
+                'ativo': AQUECIMENTO_ATIVO and self._pid == os.getpid(),
+                'ha_trafego': self._ha_trafego(agora),
+                'aquecimentos_ultima_hora': len(self._aquecimentos),
+                'orcamento_por_hora': self.orcamento,
+                'enviados': self.enviados,
+                'prontos': self.prontos,
+                'carregando': self.carregando,
+                'erros': self.erros,
+            }
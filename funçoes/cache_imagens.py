@@ -0,0 +1,463 @@
+"""
+Cache de imagens geradas, endereçado pelo conteúdo
+
+Cada combinação (prompt melhorado normalizado, modelo, passos, guidance,
+negative prompt) aponta para um arquivo nomeado pelo hash SHA-256 dos bytes
+da imagem. Prompts repetidos são respondidos direto do disco, sem chamar a
+API do Hugging Face. Imagens iguais ocupam um único arquivo.
+
+O índice fica em memória e é persistido como um log JSONL (uma linha por
+inserção, acesso ou remoção). Na inicialização o log é relido sem abrir
+nenhuma imagem, e cada processo acompanha o que os outros workers
+acrescentaram lendo apenas o final do log. Leitura, acréscimo e compactação
+do log acontecem com um flock em <indice>.lock (um arquivo à parte, porque a
+compactação troca o log por outro arquivo), então nenhum processo pula
+registros de outro nem lê um log pela metade. A entrada de um arquivo novo no
+cache e a remoção dos que ficaram sem referências também acontecem com o
+flock, então a coleta de um processo não apaga um arquivo que outro acabou de
+reaproveitar.
+
+Os arquivos ficam em subdiretórios pelos dois primeiros caracteres do hash
+(ex.: ab/img_ab12....png), para que nenhum diretório acumule milhares de
+arquivos. Cada entrada do índice guarda também o prompt, o modelo, o tamanho
+e a data de criação, então buscas e listagens (ver listar) usam só o índice,
+sem percorrer o disco. Arquivos gravados antes dos subdiretórios continuam
+válidos onde estão.
+
+A coleta de lixo roda numa thread em segundo plano: a cada
+CACHE_IMAGENS_INTERVALO_GC segundos, ou logo depois de uma inserção que
+passou do tamanho máximo, remove as entradas mais velhas que a idade máxima
+e, enquanto o total passar do tamanho máximo, as menos acessadas
+recentemente (LRU). Quando um arquivo deixa de ser usado, as cópias dele no
+mesmo subdiretório (miniaturas e reencodes, ex.: img_<hash>.w256.webp)
+também são apagadas.
+
+O horário do último acesso, usado pelo LRU, só é atualizado (e gravado no
+log) quando o registrado tem mais de CACHE_IMAGENS_PRECISAO_ACESSO segundos:
+acertos repetidos na mesma imagem não travam o log nem o fazem crescer. Sem
+nada novo no log, um acerto também não trava o log para sincronizar.
+
+Configuração (variáveis de ambiente):
+- CACHE_IMAGENS_MAX_MB: tamanho máximo das imagens no cache (padrão: 500)
+- CACHE_IMAGENS_MAX_DIAS: idade máxima de uma imagem, em dias (padrão: 30)
+- CACHE_IMAGENS_INTERVALO_GC: segundos entre duas coletas de lixo (padrão: 300)
+- CACHE_IMAGENS_PRECISAO_ACESSO: segundos de precisão do último acesso de uma imagem (padrão: 60)
+"""
+
+import hashlib
+import heapq
+import json
+import logging
+import os
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Sem fcntl (Windows) o log só fica consistente entre threads do mesmo processo
+    fcntl = None
+
+CACHE_IMAGENS_MAX_MB = float(os.environ.get('CACHE_IMAGENS_MAX_MB', 500))
+CACHE_IMAGENS_MAX_DIAS = float(os.environ.get('CACHE_IMAGENS_MAX_DIAS', 30))
+CACHE_IMAGENS_INTERVALO_GC = float(os.environ.get('CACHE_IMAGENS_INTERVALO_GC', 300))
+CACHE_IMAGENS_PRECISAO_ACESSO = float(os.environ.get('CACHE_IMAGENS_PRECISAO_ACESSO', 60))
+
+# Tamanho máximo, em caracteres, do prompt guardado no índice
+PROMPT_MAXIMO = 300
+
+logger = logging.getLogger(__name__)
+
+
+def normalizar_prompt(prompt):
+    """Normaliza caixa, espaços e forma Unicode do prompt"""
+    return " ".join(unicodedata.normalize('NFC', prompt).lower().split())
+
+
+def chave_cache(prompt_melhorado, modelo, num_inference_steps, guidance_scale, negative_prompt, entrada=None):
+    """
+    Parâmetros:
+    - entrada (str): o que mais muda a imagem além dos outros parâmetros, ex.: a
+      imagem de entrada em image-to-image ou o tamanho de um rascunho (None mantém
+      as chaves já gravadas)
+    """
+    partes = [normalizar_prompt(prompt_melhorado), modelo, int(num_inference_steps),
+              float(guidance_scale), normalizar_prompt(negative_prompt or '')]
+    if entrada is not None:
+        partes.append(entrada)
+    return hashlib.sha256(json.dumps(partes).encode('utf-8')).hexdigest()
+
+
+class CacheImagens:
+    """
+    Cache de imagens em disco com índice em memória
+
+    Parâmetros:
+    - diretorio (str): onde os arquivos de imagem são gravados
+    - arquivo_indice (str): caminho do log do índice (padrão: diretorio/.indice_cache.jsonl)
+    - tamanho_maximo (int): total de bytes mantidos no cache
+    - idade_maxima (float): idade máxima de uma entrada, em segundos
+    - prefixo (str): prefixo dos nomes de arquivo
+    - intervalo_gc (float): segundos entre duas coletas de lixo
+    """
+
+    def __init__(self, diretorio, arquivo_indice=None, tamanho_maximo=None, idade_maxima=None, prefixo='img_',
+                 intervalo_gc=None):
+        self.diretorio = diretorio
+        self.arquivo_indice = arquivo_indice or os.path.join(diretorio, '.indice_cache.jsonl')
+        self.tamanho_maximo = tamanho_maximo if tamanho_maximo is not None else int(CACHE_IMAGENS_MAX_MB * 1024 * 1024)
+        self.idade_maxima = idade_maxima if idade_maxima is not None else CACHE_IMAGENS_MAX_DIAS * 86400
+        self.prefixo = prefixo
+        self.intervalo_gc = CACHE_IMAGENS_INTERVALO_GC if intervalo_gc is None else intervalo_gc
+
+        # chave -> {'prompt', 'modelo', 'arquivo', 'tamanho', 'criado', 'acessado'}, da menos para a mais recente
+        self._entradas = OrderedDict()
+        # arquivo -> quantas chaves apontam para ele
+        self._referencias = {}
+        self._tamanho_total = 0
+        self._offset_log = 0
+        self._inode_log = None
+        self._linhas_log = 0
+        # Profundidade do flock no log: o flock não é reentrante entre descritores
+        self._travas_log = 0
+        self._lock = threading.Lock()
+        self._acordar_gc = threading.Event()
+        self._pid = None
+        self.acertos = 0
+        self.falhas = 0
+        self.coletas = 0
+        self.removidos_gc = 0
+
+        os.makedirs(diretorio, exist_ok=True)
+        os.makedirs(os.path.dirname(os.path.abspath(self.arquivo_indice)), exist_ok=True)
+        with self._lock:
+            self._sincronizar()
+
+    # -- índice ---------------------------------------------------------------
+
+    def _aplicar(self, registro):
+        """Aplica um registro do log no índice; devolve o arquivo que ficou sem referências"""
+        chave = registro['chave']
+        if registro['op'] == 'remover':
+            return self._descartar(chave)
+        if registro['op'] == 'inserir':
+            orfao = self._descartar(chave)
+            arquivo = registro['arquivo']
+            self._entradas[chave] = {
+                # Registros gravados antes do prompt entrar no índice não o têm
+                'prompt': registro.get('prompt', ''),
+                'modelo': registro['modelo'],
+                'arquivo': arquivo,
+                'tamanho': registro['tamanho'],
+                'criado': registro['criado'],
+                'acessado': registro['criado'],
+            }
+            if arquivo not in self._referencias:
+                self._referencias[arquivo] = 0
+                self._tamanho_total += registro['tamanho']
+            self._referencias[arquivo] += 1
+            return None if orfao == arquivo else orfao
+        if registro['op'] == 'acessar' and chave in self._entradas:
+            self._entradas[chave]['acessado'] = registro['acessado']
+            self._entradas.move_to_end(chave)
+        return None
+
+    def _descartar(self, chave):
+        """Remove a chave do índice em memória; devolve o arquivo se ninguém mais o usa"""
+        entrada = self._entradas.pop(chave, None)
+        if entrada is None:
+            return None
+        arquivo = entrada['arquivo']
+        self._referencias[arquivo] -= 1
+        if self._referencias[arquivo] <= 0:
+            del self._referencias[arquivo]
+            self._tamanho_total -= entrada['tamanho']
+            return arquivo
+        return None
+
+    @contextmanager
+    def _travar_log(self):
+        """Segura o flock do log entre processos (chamado sempre com self._lock)"""
+        if fcntl is None or self._travas_log:
+            self._travas_log += 1
+            try:
+                yield
+            finally:
+                self._travas_log -= 1
+            return
+        with open(self.arquivo_indice + '.lock', 'ab') as trava:
+            fcntl.flock(trava.fileno(), fcntl.LOCK_EX)
+            self._travas_log += 1
+            try:
+                yield
+            finally:
+                self._travas_log -= 1
+                fcntl.flock(trava.fileno(), fcntl.LOCK_UN)
+
+    def _sincronizar(self):
+        """Lê do log apenas o que foi acrescentado desde a última leitura (por este ou outro processo)"""
+        if not self._travas_log:
+            # O log só muda de tamanho ou de inode com acréscimos ou compactações: sem
+            # nenhum dos dois, não há o que ler e o flock não é necessário
+            try:
+                estado = os.stat(self.arquivo_indice)
+            except OSError:
+                return
+            if estado.st_size == self._offset_log and estado.st_ino == self._inode_log:
+                return
+        with self._travar_log():
+            try:
+                estado = os.stat(self.arquivo_indice)
+            except OSError:
+                return
+            if estado.st_size < self._offset_log or (self._inode_log is not None and estado.st_ino != self._inode_log):
+                # O log foi compactado por outro processo: relê do início
+                self._entradas.clear()
+                self._referencias.clear()
+                self._tamanho_total = 0
+                self._offset_log = 0
+                self._linhas_log = 0
+            self._inode_log = estado.st_ino
+            if estado.st_size == self._offset_log:
+                return
+            with open(self.arquivo_indice, 'rb') as f:
+                f.seek(self._offset_log)
+                dados = f.read()
+            # Ignora uma última linha incompleta (ainda sendo escrita)
+            completo = dados[:dados.rfind(b'\n') + 1]
+            for linha in completo.splitlines():
+                try:
+                    self._aplicar(json.loads(linha))
+                except (ValueError, KeyError):
+                    continue
+                self._linhas_log += 1
+            self._offset_log += len(completo)
+
+    def _registrar(self, registro):
+        """Acrescenta o registro ao log e remove do disco o arquivo que ficar sem referências"""
+        linha = json.dumps(registro).encode('utf-8') + b'\n'
+        with self._travar_log():
+            # Com o log travado, lê antes o que outros processos acrescentaram: o que
+            # fica entre o offset e o fim do log é então exatamente esta linha
+            self._sincronizar()
+            with open(self.arquivo_indice, 'ab') as f:
+                f.write(linha)
+            self._offset_log += len(linha)
+            self._inode_log = os.stat(self.arquivo_indice).st_ino
+            self._linhas_log += 1
+            orfao = self._aplicar(registro)
+            # Ainda com o log travado: guardar_arquivo de outro processo não vê o órfão
+            # existindo e o registra pouco antes de ele ser apagado
+            if orfao:
+                self._apagar_arquivo(orfao)
+
+    def _apagar_arquivo(self, arquivo):
+        """Apaga o arquivo e, se ele está num subdiretório, as variantes geradas a partir dele"""
+        caminho = os.path.join(self.diretorio, arquivo)
+        apagar = [caminho]
+        if os.path.dirname(arquivo):
+            # Subdiretórios têm poucos arquivos, então listá-los é barato (a raiz não é listada)
+            base = os.path.splitext(os.path.basename(arquivo))[0] + '.'
+            try:
+                apagar += [entrada.path for entrada in os.scandir(os.path.dirname(caminho))
+                           if entrada.name.startswith(base) and entrada.path != caminho]
+            except OSError:
+                pass
+        for caminho in apagar:
+            try:
+                os.remove(caminho)
+            except OSError:
+                pass
+
+    def _compactar(self):
+        """Reescreve o log só com as entradas vivas quando ele cresce demais"""
+        if self._linhas_log < 1000 or self._linhas_log < 4 * len(self._entradas):
+            return
+        with self._travar_log():
+            # Registros acrescentados por outros processos entram na versão compactada
+            self._sincronizar()
+            temporario = f'{self.arquivo_indice}.{os.getpid()}.tmp'
+            with open(temporario, 'wb') as f:
+                for chave, entrada in self._entradas.items():
+                    registro = {'op': 'inserir', 'chave': chave, 'prompt': entrada['prompt'], 'modelo': entrada['modelo'],
+                                'arquivo': entrada['arquivo'], 'tamanho': entrada['tamanho'], 'criado': entrada['criado']}
+                    f.write(json.dumps(registro).encode('utf-8') + b'\n')
+                    if entrada['acessado'] != entrada['criado']:
+                        f.write(json.dumps({'op': 'acessar', 'chave': chave, 'acessado': entrada['acessado']}).encode('utf-8') + b'\n')
+            os.replace(temporario, self.arquivo_indice)
+            estado = os.stat(self.arquivo_indice)
+            self._offset_log = estado.st_size
+            self._inode_log = estado.st_ino
+            self._linhas_log = len(self._entradas)
+
+    def _expulsar(self):
+        """
+        Aplica a idade máxima e o tamanho máximo, removendo os menos acessados
+
+        Retorna:
+        - int: quantidade de entradas removidas
+        """
+        limite = time.time() - self.idade_maxima
+        expiradas = [c for c, e in self._entradas.items() if e['criado'] < limite]
+        for chave in expiradas:
+            self._registrar({'op': 'remover', 'chave': chave})
+        removidas = len(expiradas)
+        while self._tamanho_total > self.tamanho_maximo and self._entradas:
+            self._registrar({'op': 'remover', 'chave': next(iter(self._entradas))})
+            removidas += 1
+        self._compactar()
+        return removidas
+
+    # -- coleta de lixo -------------------------------------------------------
+
+    def iniciar(self):
+        """Inicia a thread de coleta de lixo deste processo (de novo, se o processo foi criado por fork)"""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        threading.Thread(target=self._coletar_continuamente, name='cache-imagens-gc', daemon=True).start()
+
+    def _coletar_continuamente(self):
+        while True:
+            self._acordar_gc.wait(self.intervalo_gc)
+            self._acordar_gc.clear()
+            try:
+                self.coletar()
+            except Exception as e:
+                logger.error(f'Erro na coleta de lixo do cache de imagens: {str(e)}')
+
+    def coletar(self):
+        """
+        Remove as entradas expiradas e as menos acessadas acima do tamanho máximo
+
+        Retorna:
+        - int: quantidade de entradas removidas
+        """
+        with self._lock:
+            self._sincronizar()
+            removidas = self._expulsar()
+            self.coletas += 1
+            self.removidos_gc += removidas
+        return removidas
+
+    # -- API ------------------------------------------------------------------
+
+    def buscar(self, prompt_melhorado, modelos, num_inference_steps, guidance_scale, negative_prompt, entrada=None):
+        """
+        Procura uma imagem já gerada para o prompt com algum dos modelos
+
+        Parâmetros:
+        - modelos (list): modelos aceitos, em ordem de preferência
+        - entrada (str): imagem de entrada, em image-to-image (veja chave_cache)
+
+        Retorna:
+        - tupla (modelo, caminho do arquivo), ou None se não houver imagem no cache
+        """
+        agora = time.time()
+        with self._lock:
+            self._sincronizar()
+            for modelo in modelos:
+                chave = chave_cache(prompt_melhorado, modelo, num_inference_steps, guidance_scale, negative_prompt,
+                                    entrada)
+                registro = self._entradas.get(chave)
+                if registro is None:
+                    continue
+                caminho = os.path.join(self.diretorio, registro['arquivo'])
+                if registro['criado'] < agora - self.idade_maxima or not os.path.exists(caminho):
+                    # Expirada, ou o arquivo foi removido por outro processo
+                    self._registrar({'op': 'remover', 'chave': chave})
+                    continue
+                if agora - registro['acessado'] >= CACHE_IMAGENS_PRECISAO_ACESSO:
+                    self._registrar({'op': 'acessar', 'chave': chave, 'acessado': agora})
+                self.acertos += 1
+                return registro['modelo'], caminho
+            self.falhas += 1
+            return None
+
+    def guardar(self, prompt_melhorado, modelo, num_inference_steps, guidance_scale, negative_prompt,
+                conteudo, extensao='png', entrada=None):
+        """
+        Grava a imagem no disco (se ainda não existir) e a registra no índice
+
+        Retorna:
+        - str: caminho do arquivo nomeado pelo hash do conteúdo
+        """
+        temporario = os.path.join(self.diretorio, f'.guardando_{os.getpid()}_{threading.get_ident()}.tmp')
+        with open(temporario, 'wb') as f:
+            f.write(conteudo)
+        return self.guardar_arquivo(prompt_melhorado, modelo, num_inference_steps, guidance_scale, negative_prompt,
+                                    temporario, hashlib.sha256(conteudo).hexdigest(), len(conteudo), extensao, entrada)
+
+    def guardar_arquivo(self, prompt_melhorado, modelo, num_inference_steps, guidance_scale, negative_prompt,
+                        caminho_temporario, sha256, tamanho, extensao='png', entrada=None):
+        """
+        Move para o cache um arquivo já gravado no disco (no mesmo sistema de
+        arquivos), sem lê-lo de novo, e o registra no índice
+
+        Parâmetros:
+        - caminho_temporario (str): arquivo com a imagem; deixa de existir após a chamada
+        - sha256 (str): hash do conteúdo, calculado por quem gravou o arquivo
+        - tamanho (int): tamanho do arquivo em bytes
+
+        Retorna:
+        - str: caminho do arquivo nomeado pelo hash do conteúdo
+        """
+        arquivo = f"{sha256[:2]}/{self.prefixo}{sha256[:32]}.{extensao}"
+        caminho = os.path.join(self.diretorio, arquivo)
+
+        self.iniciar()
+        chave = chave_cache(prompt_melhorado, modelo, num_inference_steps, guidance_scale, negative_prompt, entrada)
+        # A conferência, a troca e o registro ficam sob o mesmo flock com que a coleta apaga
+        # os órfãos: um arquivo visto aqui não some antes de a nova entrada apontar para ele
+        with self._lock, self._travar_log():
+            self._sincronizar()
+            if os.path.exists(caminho):
+                # Mesma imagem já está no cache: o arquivo novo é descartado
+                os.remove(caminho_temporario)
+            else:
+                os.makedirs(os.path.dirname(caminho), exist_ok=True)
+                os.replace(caminho_temporario, caminho)
+            self._registrar({'op': 'inserir', 'chave': chave, 'prompt': normalizar_prompt(prompt_melhorado)[:PROMPT_MAXIMO],
+                             'modelo': modelo, 'arquivo': arquivo, 'tamanho': tamanho, 'criado': time.time()})
+            if self._tamanho_total > self.tamanho_maximo:
+                # A remoção fica com a thread de coleta, fora do caminho do pedido
+                self._acordar_gc.set()
+        return caminho
+
+    def listar(self, limite=50, antes=None, modelo=None):
+        """
+        Lista as imagens do cache pelo índice, sem abrir nenhum arquivo
+
+        Parâmetros:
+        - limite (int): quantidade máxima de imagens
+        - antes (float): só imagens criadas antes deste timestamp (para paginar)
+        - modelo (str): só imagens geradas por este modelo
+
+        Retorna:
+        - list de dicts {'arquivo', 'prompt', 'modelo', 'tamanho', 'criado', 'acessado'},
+          da mais nova para a mais antiga
+        """
+        with self._lock:
+            self._sincronizar()
+            entradas = (e for e in self._entradas.values()
+                        if (antes is None or e['criado'] < antes) and (modelo is None or e['modelo'] == modelo))
+            return [dict(e) for e in heapq.nlargest(limite, entradas, key=lambda e: e['criado'])]
+
+    def estatisticas(self):
+        with self._lock:
+            total = self.acertos + self.falhas
+            return {
+                'entradas': len(self._entradas),
+                'arquivos': len(self._referencias),
+                'bytes': self._tamanho_total,
+                'bytes_maximo': self.tamanho_maximo,
+                'acertos': self.acertos,
+                'falhas': self.falhas,
+                'taxa_acerto': round(self.acertos / total, 4) if total else 0.0,
+                'coletas': self.coletas,
+                'removidos_gc': self.removidos_gc,
+            }
@@ -0,0 +1,175 @@
+"""
+Cache de respostas da IA para perguntas repetidas
+
+As perguntas são normalizadas (caixa, acentos, espaços e pontuação final)
+antes da busca exata. Opcionalmente, perguntas parecidas também podem ser
+reaproveitadas: cada pergunta vira um vetor de trigramas de caracteres, e
+a resposta de uma pergunta guardada é usada se a similaridade de cosseno
+passar do limite configurado.
+
+As entradas expiram após o TTL e são removidas por LRU quando o número de
+entradas ou a memória estimada passam dos limites.
+
+Configuração (variáveis de ambiente):
+- CACHE_RESPOSTAS_TTL: validade de uma resposta, em segundos (padrão: 86400)
+- CACHE_RESPOSTAS_MAX_ENTRADAS: quantidade máxima de respostas (padrão: 5000)
+- CACHE_RESPOSTAS_MAX_MB: memória máxima estimada, em MB (padrão: 32)
+- CACHE_RESPOSTAS_SIMILARIDADE: similaridade mínima para a busca aproximada,
+  entre 0 e 1; 0 desliga a busca aproximada (padrão: 0)
+"""
+
+import math
+import os
+import sys
+import threading
+import time
+import unicodedata
+from collections import Counter, OrderedDict
+
+CACHE_RESPOSTAS_TTL = float(os.environ.get('CACHE_RESPOSTAS_TTL', 86400))
+CACHE_RESPOSTAS_MAX_ENTRADAS = int(os.environ.get('CACHE_RESPOSTAS_MAX_ENTRADAS', 5000))
+CACHE_RESPOSTAS_MAX_MB = float(os.environ.get('CACHE_RESPOSTAS_MAX_MB', 32))
+CACHE_RESPOSTAS_SIMILARIDADE = float(os.environ.get('CACHE_RESPOSTAS_SIMILARIDADE', 0))
+
+# Quantas perguntas candidatas (as que mais compartilham trigramas) são comparadas na busca aproximada
+CANDIDATOS_APROXIMADOS = 20
+
+# Só a pontuação nas pontas é removida: a de dentro muda o sentido ("C++" e "C", "2+2" e "22")
+PONTUACAO_FINAL = '?!.'
+PONTUACAO_INICIAL = '¿¡'
+
+
+def normalizar_pergunta(pergunta):
+    """Remove acentos, a pontuação do início e do fim e diferenças de caixa e espaços"""
+    sem_acentos = ''.join(c for c in unicodedata.normalize('NFKD', pergunta) if not unicodedata.combining(c))
+    texto = sem_acentos.lower().strip().lstrip(PONTUACAO_INICIAL).rstrip(PONTUACAO_FINAL + ' \t\n')
+    return ' '.join(texto.split())
+
+
+def trigramas(texto):
+    texto = f' {texto} '
+    return Counter(texto[i:i + 3] for i in range(len(texto) - 2))
+
+
+def _norma(vetor):
+    return math.sqrt(sum(v * v for v in vetor.values()))
+
+
+class CacheRespostas:
+    """
+    Cache em memória de respostas, com TTL, LRU e busca aproximada opcional
+
+    Parâmetros:
+    - ttl (float): validade de uma resposta, em segundos
+    - max_entradas (int): quantidade máxima de respostas guardadas
+    - max_bytes (int): memória máxima estimada
+    - similaridade (float): limite da busca aproximada (0 desliga)
+    """
+
+    def __init__(self, ttl=None, max_entradas=None, max_bytes=None, similaridade=None):
+        self.ttl = CACHE_RESPOSTAS_TTL if ttl is None else ttl
+        self.max_entradas = CACHE_RESPOSTAS_MAX_ENTRADAS if max_entradas is None else max_entradas
+        self.max_bytes = int(CACHE_RESPOSTAS_MAX_MB * 1024 * 1024) if max_bytes is None else max_bytes
+        self.similaridade = CACHE_RESPOSTAS_SIMILARIDADE if similaridade is None else similaridade
+
+        # chave normalizada -> {'resposta', 'expira', 'vetor', 'norma', 'bytes'}, da menos para a mais recente
+        self._entradas = OrderedDict()
+        # trigrama -> chaves que o contêm (só usado na busca aproximada)
+        self._indice = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.acertos_exatos = 0
+        self.acertos_aproximados = 0
+        self.falhas = 0
+
+    def _remover(self, chave):
+        entrada = self._entradas.pop(chave)
+        self._bytes -= entrada['bytes']
+        for trigrama in entrada['vetor'] or ():
+            chaves = self._indice.get(trigrama)
+            if chaves is not None:
+                chaves.discard(chave)
+                if not chaves:
+                    del self._indice[trigrama]
+
+    def _buscar_aproximado(self, chave, agora):
+        vetor = trigramas(chave)
+        norma = _norma(vetor)
+        if not norma:
+            return None
+        candidatos = Counter()
+        for trigrama in vetor:
+            for outra in self._indice.get(trigrama, ()):
+                candidatos[outra] += 1
+
+        melhor, melhor_similaridade = None, self.similaridade
+        for outra, _ in candidatos.most_common(CANDIDATOS_APROXIMADOS):
+            entrada = self._entradas[outra]
+            if entrada['expira'] < agora:
+                continue
+            produto = sum(quantidade * entrada['vetor'].get(trigrama, 0) for trigrama, quantidade in vetor.items())
+            similaridade = produto / (norma * entrada['norma'])
+            if similaridade >= melhor_similaridade:
+                melhor, melhor_similaridade = outra, similaridade
+        return melhor
+
+    def buscar(self, pergunta):
+        """
+        Retorna a resposta guardada para a pergunta, ou None se não houver
+        """
+        chave = normalizar_pergunta(pergunta)
+        agora = time.time()
+        with self._lock:
+            entrada = self._entradas.get(chave)
+            if entrada is not None and entrada['expira'] < agora:
+                self._remover(chave)
+                entrada = None
+            if entrada is not None:
+                self.acertos_exatos += 1
+            elif self.similaridade > 0:
+                parecida = self._buscar_aproximado(chave, agora)
+                if parecida is not None:
+                    chave, entrada = parecida, self._entradas[parecida]
+                    self.acertos_aproximados += 1
+            if entrada is None:
+                self.falhas += 1
+                return None
+            self._entradas.move_to_end(chave)
+            return entrada['resposta']
+
+    def guardar(self, pergunta, resposta):
+        chave = normalizar_pergunta(pergunta)
+        vetor = trigramas(chave) if self.similaridade > 0 else None
+        # Estimativa da memória ocupada pela entrada (textos, vetor e estrutura)
+        tamanho = sys.getsizeof(chave) + sys.getsizeof(resposta) + 200
+        if vetor:
+            tamanho += len(vetor) * 150
+        with self._lock:
+            if chave in self._entradas:
+                self._remover(chave)
+            self._entradas[chave] = {
+                'resposta': resposta,
+                'expira': time.time() + self.ttl,
+                'vetor': vetor,
+                'norma': _norma(vetor) if vetor else 0,
+                'bytes': tamanho,
+            }
+            self._bytes += tamanho
+            for trigrama in vetor or ():
+                self._indice.setdefault(trigrama, set()).add(chave)
+            while self._entradas and (len(self._entradas) > self.max_entradas or self._bytes > self.max_bytes):
+                self._remover(next(iter(self._entradas)))
+
+    def estatisticas(self):
+        with self._lock:
+            acertos = self.acertos_exatos + self.acertos_aproximados
+            total = acertos + self.falhas
+            return {
+                'entradas': len(self._entradas),
+                'bytes_estimados': self._bytes,
+                'bytes_maximo': self.max_bytes,
+                'acertos_exatos': self.acertos_exatos,
+                'acertos_aproximados': self.acertos_aproximados,
+                'falhas': self.falhas,
+                'taxa_acerto': round(acertos / total, 4) if total else 0.0,
+            }
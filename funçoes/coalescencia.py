@@ -0,0 +1,244 @@
+"""
+Coalescência de chamadas idênticas simultâneas (single-flight)
+
+Quando vários pedidos iguais chegam ao mesmo tempo, só o primeiro (o líder)
+chama a API externa; os outros esperam e recebem o mesmo resultado.
+
+- Dentro de um processo, os pedidos seguidores esperam um evento da thread líder.
+- Entre os workers do gunicorn, a coordenação passa por uma tabela SQLite. O
+  líder reserva a chave, e os outros processos consultam a tabela até o
+  resultado aparecer. O resultado fica disponível por COALESCENCIA_RETENCAO
+  segundos, para quem chegar logo depois.
+
+Se o líder morrer, a reserva expira depois de COALESCENCIA_ESPERA segundos e
+outro pedido assume. Um seguidor que espera além desse prazo faz a própria
+chamada.
+
+A chamada compartilhada roda numa thread à parte, com o prazo que a própria
+funcao trouxer (o máximo da rota, não o de um pedido), e cada pedido, o
+líder inclusive, só a espera até o seu prazo (veja funçoes/prazos.py):
+recebe PrazoEsgotado sem derrubar os outros. Se a chamada compartilhada
+esgotar o prazo dela, o erro não é repassado: a reserva é liberada e os
+seguidores tentam de novo.
+
+Os resultados precisam ser serializáveis em JSON.
+
+Configuração (variáveis de ambiente):
+- COALESCENCIA_ESPERA: segundos máximos esperando o líder (padrão: 60)
+- COALESCENCIA_RETENCAO: segundos que um resultado continua disponível (padrão: 5)
+- COALESCENCIA_INTERVALO: intervalo entre consultas de outro processo, em segundos (padrão: 0.1)
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+
+from funçoes.prazos import PrazoEsgotado
+
+logger = logging.getLogger(__name__)
+
+COALESCENCIA_ESPERA = float(os.environ.get('COALESCENCIA_ESPERA', 60))
+COALESCENCIA_RETENCAO = float(os.environ.get('COALESCENCIA_RETENCAO', 5))
+COALESCENCIA_INTERVALO = float(os.environ.get('COALESCENCIA_INTERVALO', 0.1))
+
+# Estados de uma chamada
+EXECUTANDO = 'executando'
+CONCLUIDO = 'concluido'
+ERRO = 'erro'
+
+CONTADORES = ('lideres', 'coalescidas_no_processo', 'coalescidas_entre_processos', 'esperas_esgotadas')
+
+
+class FalhaCoalescida(Exception):
+    """A chamada do líder falhou; os seguidores recebem a mesma falha"""
+
+
+class _Voo:
+    """Chamada em andamento dentro deste processo"""
+
+    def __init__(self):
+        self.pronto = threading.Event()
+        self.resultado = None
+        self.erro = None
+
+
+class Coalescedor:
+    """
+    Executa no máximo uma chamada por chave de cada vez, entre threads e processos
+
+    Parâmetros:
+    - caminho_db (str): arquivo SQLite compartilhado pelos processos
+    - espera (float): segundos máximos esperando o líder
+    - retencao (float): segundos que um resultado continua disponível
+    """
+
+    def __init__(self, caminho_db, espera=None, retencao=None):
+        self.caminho_db = caminho_db
+        self.espera = COALESCENCIA_ESPERA if espera is None else espera
+        self.retencao = COALESCENCIA_RETENCAO if retencao is None else retencao
+        self._voos = {}
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(caminho_db)), exist_ok=True)
+        with self._conectar() as conexao:
+            conexao.execute('PRAGMA journal_mode=WAL')
+            conexao.execute('''
+                CREATE TABLE IF NOT EXISTS chamadas (
+                    chave TEXT PRIMARY KEY,
+                    estado TEXT NOT NULL,
+                    resultado TEXT,
+                    erro TEXT,
+                    expira REAL NOT NULL
+                )
+            ''')
+            conexao.execute('CREATE TABLE IF NOT EXISTS contadores (nome TEXT PRIMARY KEY, valor INTEGER NOT NULL)')
+            conexao.executemany('INSERT OR IGNORE INTO contadores (nome, valor) VALUES (?, 0)',
+                                [(nome,) for nome in CONTADORES])
+
+    def _conectar(self):
+        # Uma conexão por operação: conexões SQLite não devem ser compartilhadas entre threads
+        conexao = sqlite3.connect(self.caminho_db, timeout=10, isolation_level=None)
+        conexao.row_factory = sqlite3.Row
+        return closing(conexao)
+
+    def _contar(self, nome, conexao=None):
+        if conexao is None:
+            with self._conectar() as conexao:
+                conexao.execute('UPDATE contadores SET valor = valor + 1 WHERE nome = ?', (nome,))
+        else:
+            conexao.execute('UPDATE contadores SET valor = valor + 1 WHERE nome = ?', (nome,))
+
+    def _reservar(self, chave):
+        """
+        Tenta ser o líder da chave
+
+        Retorna:
+        - linha da chamada existente (concluída, com erro ou em andamento em
+          outro processo), ou None se este pedido virou o líder
+        """
+        agora = time.time()
+        with self._conectar() as conexao:
+            conexao.execute('BEGIN IMMEDIATE')
+            linha = conexao.execute('SELECT * FROM chamadas WHERE chave = ?', (chave,)).fetchone()
+            if linha is not None and linha['expira'] >= agora:
+                conexao.execute('COMMIT')
+                return linha
+            # Ninguém chamando (ou o resultado/a reserva expirou): este pedido vira o líder
+            conexao.execute('DELETE FROM chamadas WHERE expira < ?', (agora,))
+            conexao.execute('INSERT INTO chamadas (chave, estado, expira) VALUES (?, ?, ?)',
+                            (chave, EXECUTANDO, agora + self.espera))
+            self._contar('lideres', conexao)
+            conexao.execute('COMMIT')
+            return None
+
+    def _finalizar(self, chave, resultado=None, erro=None):
+        with self._conectar() as conexao:
+            conexao.execute('UPDATE chamadas SET estado = ?, resultado = ?, erro = ?, expira = ? WHERE chave = ?',
+                            (ERRO if erro is not None else CONCLUIDO, json.dumps(resultado), erro,
+                             time.time() + self.retencao, chave))
+
+    def _liberar(self, chave):
+        with self._conectar() as conexao:
+            conexao.execute('DELETE FROM chamadas WHERE chave = ? AND estado = ?', (chave, EXECUTANDO))
+
+    def _executar_entre_processos(self, chave, funcao):
+        limite = time.monotonic() + self.espera
+        while True:
+            linha = self._reservar(chave)
+            if linha is None:
+                try:
+                    resultado = funcao()
+                except PrazoEsgotado:
+                    # Não vira o erro compartilhado: quem esperava tenta de novo
+                    self._liberar(chave)
+                    raise
+                except Exception as e:
+                    self._finalizar(chave, erro=str(e))
+                    raise
+                self._finalizar(chave, resultado=resultado)
+                return resultado
+            if linha['estado'] == CONCLUIDO:
+                self._contar('coalescidas_entre_processos')
+                return json.loads(linha['resultado'])
+            if linha['estado'] == ERRO:
+                self._contar('coalescidas_entre_processos')
+                raise FalhaCoalescida(linha['erro'])
+            if time.monotonic() >= limite:
+                # O líder está demorando demais: chama por conta própria
+                self._contar('esperas_esgotadas')
+                return funcao()
+            time.sleep(COALESCENCIA_INTERVALO)
+
+    def _voar(self, chave, voo, funcao):
+        """Faz a chamada compartilhada (numa thread à parte) e acorda quem a espera"""
+        try:
+            voo.resultado = self._executar_entre_processos(chave, funcao)
+        except Exception as e:
+            voo.erro = e
+        finally:
+            with self._lock:
+                self._voos.pop(chave, None)
+            voo.pronto.set()
+
+    def executar(self, chave, funcao, prazo=None):
+        """
+        Executa funcao() uma única vez para pedidos simultâneos com a mesma chave
+
+        Parâmetros:
+        - chave (str): identifica pedidos equivalentes
+        - funcao (callable): faz a chamada e retorna um valor serializável em JSON; roda
+          fora deste pedido, então deve trazer o próprio prazo (ex.: o máximo da rota)
+        - prazo (Prazo): prazo deste pedido; ele não espera a chamada além dele
+
+        Retorna:
+        - o resultado da chamada (a deste pedido ou a do líder)
+
+        Lança:
+        - a exceção de funcao() no líder, ou FalhaCoalescida nos seguidores
+        - PrazoEsgotado: se o prazo acabou enquanto este pedido esperava a chamada
+        """
+        chave_hash = hashlib.sha256(chave.encode('utf-8')).hexdigest()
+        with self._lock:
+            voo = self._voos.get(chave_hash)
+            lider = voo is None
+            if lider:
+                voo = self._voos[chave_hash] = _Voo()
+        if lider:
+            threading.Thread(target=self._voar, args=(chave_hash, voo, funcao), name='coalescencia',
+                             daemon=True).start()
+            # A chamada é deste pedido: espera só pelo prazo dele
+            if not voo.pronto.wait(timeout=None if prazo is None else prazo.restante()):
+                raise PrazoEsgotado()
+        else:
+            espera = self.espera if prazo is None else min(self.espera, prazo.restante())
+            if not voo.pronto.wait(timeout=espera):
+                if prazo is not None:
+                    prazo.verificar()
+                self._contar('esperas_esgotadas')
+                return funcao()
+            self._contar('coalescidas_no_processo')
+
+        if voo.erro is None:
+            return voo.resultado
+        if lider:
+            raise voo.erro
+        if isinstance(voo.erro, PrazoEsgotado):
+            # A chamada compartilhada esgotou o prazo dela: tenta de novo, se este pedido ainda tem tempo
+            if prazo is not None:
+                prazo.verificar()
+            return self.executar(chave, funcao, prazo)
+        raise FalhaCoalescida(str(voo.erro))
+
+    def estatisticas(self):
+        """Contadores somados de todos os processos"""
+        with self._conectar() as conexao:
+            contagem = dict(conexao.execute('SELECT nome, valor FROM contadores').fetchall())
+        coalescidas = contagem.get('coalescidas_no_processo', 0) + contagem.get('coalescidas_entre_processos', 0)
+        total = contagem.get('lideres', 0) + coalescidas
+        return dict({nome: contagem.get(nome, 0) for nome in CONTADORES},
+                    taxa_coalescencia=round(coalescidas / total, 4) if total else 0.0)
@@ -0,0 +1,224 @@
+"""
+Sessões de conversa com a IA, guardadas no servidor
+
+Cada sessão guarda os últimos turnos (pergunta e resposta) num banco SQLite
+compartilhado pelos workers do gunicorn, com o texto comprimido (zlib). O
+histórico enviado à API é montado dentro de um orçamento de tokens: entram
+os turnos mais recentes que cabem, e os mais antigos são trocados por um
+resumo curto (a primeira frase de cada um). Assim o tamanho da requisição
+não cresce com a conversa.
+
+Limites:
+- por sessão: acima de CONVERSAS_MAX_KB_SESSAO, os turnos mais antigos
+  viram parte do resumo guardado e são apagados
+- no total: acima de CONVERSAS_MAX_SESSOES sessões ou CONVERSAS_MAX_MB, as
+  sessões usadas há mais tempo são apagadas; sessões paradas há mais de
+  CONVERSAS_TTL segundos também são apagadas
+
+Configuração (variáveis de ambiente):
+- CONVERSAS_ORCAMENTO_TOKENS: tokens do histórico enviado à API (padrão: 1500)
+- CONVERSAS_MAX_KB_SESSAO: tamanho máximo de uma sessão, comprimida (padrão: 32)
+- CONVERSAS_MAX_SESSOES: quantidade máxima de sessões (padrão: 10000)
+- CONVERSAS_MAX_MB: tamanho máximo de todas as sessões, comprimidas (padrão: 64)
+- CONVERSAS_TTL: segundos sem uso até a sessão ser apagada (padrão: 86400)
+"""
+
+import json
+import os
+import re
+import sqlite3
+import time
+import uuid
+import zlib
+from contextlib import closing
+
+CONVERSAS_ORCAMENTO_TOKENS = int(os.environ.get('CONVERSAS_ORCAMENTO_TOKENS', 1500))
+CONVERSAS_MAX_KB_SESSAO = float(os.environ.get('CONVERSAS_MAX_KB_SESSAO', 32))
+CONVERSAS_MAX_SESSOES = int(os.environ.get('CONVERSAS_MAX_SESSOES', 10000))
+CONVERSAS_MAX_MB = float(os.environ.get('CONVERSAS_MAX_MB', 64))
+CONVERSAS_TTL = float(os.environ.get('CONVERSAS_TTL', 86400))
+
+# Parte do orçamento que o resumo dos turnos antigos pode ocupar
+FRACAO_RESUMO = 0.25
+# Tamanho máximo, em caracteres, do resumo guardado de uma sessão
+RESUMO_MAXIMO = 2000
+
+# Papéis da API de chat da Cohere
+USUARIO = 'USER'
+IA = 'CHATBOT'
+SISTEMA = 'SYSTEM'
+
+_sessao_valida = re.compile(r'^[0-9a-f]{32}$')
+_fim_de_frase = re.compile(r'(?<=[.!?])\s')
+
+
+def estimar_tokens(texto):
+    """Estimativa de tokens sem tokenizador: ~4 caracteres por token"""
+    return len(texto) // 4 + 1
+
+
+def primeira_frase(texto, limite=200):
+    frase = _fim_de_frase.split(' '.join(texto.split()), maxsplit=1)[0]
+    return frase if len(frase) <= limite else frase[:limite - 1] + '…'
+
+
+def _cortar_inicio(texto, tokens):
+    """Mantém o final do texto dentro do número de tokens"""
+    caracteres = max(0, tokens * 4)
+    if len(texto) <= caracteres:
+        return texto
+    # texto[-0:] seria o texto inteiro
+    return '…' + texto[-caracteres:] if caracteres else '…'
+
+
+def _resumir(turnos):
+    nomes = {USUARIO: 'Usuário', IA: 'IA'}
+    return ' '.join(f"{nomes.get(papel, papel)}: {primeira_frase(texto)}" for papel, texto in turnos)
+
+
+class Conversas:
+    """
+    Sessões de conversa em SQLite com histórico limitado por tokens
+
+    Parâmetros:
+    - caminho_db (str): arquivo SQLite com as sessões
+    - orcamento_tokens (int): tokens do histórico enviado à API
+    - max_bytes_sessao (int): tamanho máximo de uma sessão, comprimida
+    - max_sessoes (int): quantidade máxima de sessões
+    - max_bytes (int): tamanho máximo de todas as sessões
+    - ttl (float): segundos sem uso até a sessão ser apagada
+    """
+
+    def __init__(self, caminho_db, orcamento_tokens=None, max_bytes_sessao=None, max_sessoes=None,
+                 max_bytes=None, ttl=None):
+        self.caminho_db = caminho_db
+        self.orcamento_tokens = CONVERSAS_ORCAMENTO_TOKENS if orcamento_tokens is None else orcamento_tokens
+        self.max_bytes_sessao = int(CONVERSAS_MAX_KB_SESSAO * 1024) if max_bytes_sessao is None else max_bytes_sessao
+        self.max_sessoes = CONVERSAS_MAX_SESSOES if max_sessoes is None else max_sessoes
+        self.max_bytes = int(CONVERSAS_MAX_MB * 1024 * 1024) if max_bytes is None else max_bytes
+        self.ttl = CONVERSAS_TTL if ttl is None else ttl
+
+        os.makedirs(os.path.dirname(os.path.abspath(caminho_db)), exist_ok=True)
+        with self._conectar() as conexao:
+            conexao.execute('PRAGMA journal_mode=WAL')
+            conexao.execute('''
+                CREATE TABLE IF NOT EXISTS sessoes (
+                    id TEXT PRIMARY KEY,
+                    dados BLOB NOT NULL,
+                    bytes INTEGER NOT NULL,
+                    turnos INTEGER NOT NULL,
+                    acessado REAL NOT NULL
+                )
+            ''')
+            conexao.execute('CREATE INDEX IF NOT EXISTS sessoes_acessado ON sessoes (acessado)')
+
+    def _conectar(self):
+        # Uma conexão por operação: conexões SQLite não devem ser compartilhadas entre threads
+        return closing(sqlite3.connect(self.caminho_db, timeout=10, isolation_level=None))
+
+    @staticmethod
+    def nova_sessao():
+        return uuid.uuid4().hex
+
+    @staticmethod
+    def sessao_valida(sessao_id):
+        return isinstance(sessao_id, str) and _sessao_valida.match(sessao_id) is not None
+
+    @staticmethod
+    def _comprimir(sessao):
+        return zlib.compress(json.dumps(sessao, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+
+    def _ler(self, conexao, sessao_id):
+        linha = conexao.execute('SELECT dados, acessado FROM sessoes WHERE id = ?', (sessao_id,)).fetchone()
+        if linha is None or linha[1] < time.time() - self.ttl:
+            return {'resumo': '', 'turnos': []}
+        return json.loads(zlib.decompress(linha[0]))
+
+    def historico(self, sessao_id, orcamento_tokens=None):
+        """
+        Monta o chat_history da sessão dentro do orçamento de tokens
+
+        Os turnos mais recentes entram inteiros enquanto couberem; os anteriores
+        (e o resumo guardado) viram uma mensagem de sistema com um resumo curto.
+
+        Retorna:
+        - list no formato chat_history da API da Cohere (vazia para sessão nova)
+        """
+        orcamento = self.orcamento_tokens if orcamento_tokens is None else orcamento_tokens
+        with self._conectar() as conexao:
+            sessao = self._ler(conexao, sessao_id)
+        turnos = sessao['turnos']
+
+        incluidos = []
+        usados = 0
+        # Se nem tudo cabe, parte do orçamento fica reservada para o resumo
+        cabe_tudo = not sessao['resumo'] and sum(estimar_tokens(texto) for _, texto in turnos) <= orcamento
+        limite_turnos = orcamento if cabe_tudo else int(orcamento * (1 - FRACAO_RESUMO))
+        # Os turnos vêm em pares (pergunta, resposta), e entram ou saem juntos
+        for i in range(len(turnos) - 2, -1, -2):
+            (_, pergunta), (_, resposta) = turnos[i], turnos[i + 1]
+            custo = estimar_tokens(pergunta) + estimar_tokens(resposta)
+            if usados + custo > limite_turnos:
+                if not incluidos:
+                    # Nem o último par cabe inteiro: vão os finais da pergunta e da resposta
+                    pergunta = _cortar_inicio(pergunta, limite_turnos // 4)
+                    resposta = _cortar_inicio(resposta, limite_turnos - estimar_tokens(pergunta) - 1)
+                    incluidos.append((pergunta, resposta))
+                    usados += estimar_tokens(pergunta) + estimar_tokens(resposta)
+                break
+            incluidos.append((pergunta, resposta))
+            usados += custo
+        incluidos.reverse()
+
+        mensagens = []
+        for pergunta, resposta in incluidos:
+            mensagens += [{'role': USUARIO, 'message': pergunta}, {'role': IA, 'message': resposta}]
+        antigos = turnos[:len(turnos) - 2 * len(incluidos)]
+        resumo = ' '.join(parte for parte in (sessao['resumo'], _resumir(antigos)) if parte)
+        if resumo and orcamento - usados > 10:
+            resumo = _cortar_inicio(resumo, orcamento - usados - 10)
+            mensagens.insert(0, {'role': SISTEMA, 'message': f'Resumo da conversa anterior: {resumo}'})
+        return mensagens
+
+    def registrar(self, sessao_id, pergunta, resposta):
+        """Acrescenta um turno (pergunta e resposta) à sessão, aplicando os limites de tamanho"""
+        agora = time.time()
+        with self._conectar() as conexao:
+            conexao.execute('BEGIN IMMEDIATE')
+            sessao = self._ler(conexao, sessao_id)
+            sessao['turnos'] += [[USUARIO, pergunta], [IA, resposta]]
+            dados = self._comprimir(sessao)
+            # Sessão grande demais: os turnos mais antigos viram parte do resumo
+            while len(dados) > self.max_bytes_sessao and len(sessao['turnos']) > 2:
+                antigos, sessao['turnos'] = sessao['turnos'][:2], sessao['turnos'][2:]
+                sessao['resumo'] = (sessao['resumo'] + ' ' + _resumir(antigos)).strip()[-RESUMO_MAXIMO:]
+                dados = self._comprimir(sessao)
+            conexao.execute('INSERT OR REPLACE INTO sessoes (id, dados, bytes, turnos, acessado) VALUES (?, ?, ?, ?, ?)',
+                            (sessao_id, dados, len(dados), len(sessao['turnos']), agora))
+            self._expulsar(conexao, agora)
+            conexao.execute('COMMIT')
+
+    def _expulsar(self, conexao, agora):
+        conexao.execute('DELETE FROM sessoes WHERE acessado < ?', (agora - self.ttl,))
+        quantidade, total = conexao.execute('SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM sessoes').fetchone()
+        if quantidade <= self.max_sessoes and total <= self.max_bytes:
+            return
+        # Remove as sessões usadas há mais tempo até voltar aos limites
+        for sessao_id, tamanho in conexao.execute('SELECT id, bytes FROM sessoes ORDER BY acessado').fetchall():
+            if quantidade <= self.max_sessoes and total <= self.max_bytes:
+                break
+            conexao.execute('DELETE FROM sessoes WHERE id = ?', (sessao_id,))
+            quantidade -= 1
+            total -= tamanho
+
+    def estatisticas(self):
+        with self._conectar() as conexao:
+            quantidade, total, turnos = conexao.execute(
+                'SELECT COUNT(*), COALESCE(SUM(bytes), 0), COALESCE(SUM(turnos), 0) FROM sessoes').fetchone()
+        return {
+            'sessoes': quantidade,
+            'bytes': total,
+            'bytes_maximo': self.max_bytes,
+            'mensagens': turnos,
+            'orcamento_tokens': self.orcamento_tokens,
+        }
@@ -0,0 +1,176 @@
+"""
+Entrega de arquivos estáticos e imagens geradas com cache HTTP
+
+- ETag forte, calculado pelo hash do conteúdo (ou tirado do próprio nome,
+  nas imagens geradas, que já são nomeadas pelo hash)
+- Cache-Control: imagens nomeadas pelo hash nunca mudam e são marcadas como
+  imutáveis; o HTML é sempre revalidado; os demais arquivos ficam em cache
+  por ESTATICOS_MAX_AGE segundos
+- GET condicional (If-None-Match/If-Modified-Since → 304) e Range (206),
+  tratados pelo send_file do Flask
+- Versões pré-comprimidas .br/.gz dos arquivos de texto, criadas na primeira
+  requisição (ou de antemão com `python -m funçoes.estaticos pag`) e
+  escolhidas pelo Accept-Encoding do cliente
+
+O Brotli é opcional: sem o pacote `brotli`, só o gzip é usado.
+"""
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import sys
+import threading
+from collections import OrderedDict
+
+from flask import abort, request, send_file
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ESTATICOS_MAX_AGE = int(os.environ.get('ESTATICOS_MAX_AGE', 3600))
+IMUTAVEL_MAX_AGE = 31536000
+
+# Arquivos que valem a pena comprimir (imagens já são comprimidas)
+EXTENSOES_TEXTO = {'.html', '.css', '.js', '.svg', '.json', '.txt', '.xml'}
+# Arquivos menores que isso não compensam a compressão
+TAMANHO_MINIMO_COMPRESSAO = 1024
+
+# Nomes de arquivo que contêm o hash do conteúdo (ex.: img_<32 hex>.png e
+# as variantes derivadas dele, como img_<32 hex>.w256.webp)
+_NOME_COM_HASH = re.compile(r'(?:^|/)[a-z0-9]+_([0-9a-f]{32})(?:\.[a-z0-9]+)+$')
+
+# ETags calculados, por (caminho, mtime, tamanho)
+_etags = OrderedDict()
+_etags_lock = threading.Lock()
+_ETAGS_MAXIMO = 4096
+
+_compressao_lock = threading.Lock()
+
+
+def _etag(caminho, estado):
+    if _NOME_COM_HASH.search(caminho):
+        # O nome já identifica o conteúdo (o sufixo distingue as variantes)
+        return os.path.basename(caminho).split('_', 1)[1]
+    chave = (caminho, estado.st_mtime_ns, estado.st_size)
+    with _etags_lock:
+        if chave in _etags:
+            _etags.move_to_end(chave)
+            return _etags[chave]
+    resumo = hashlib.sha256()
+    with open(caminho, 'rb') as f:
+        for pedaco in iter(lambda: f.read(64 * 1024), b''):
+            resumo.update(pedaco)
+    etag = resumo.hexdigest()[:32]
+    with _etags_lock:
+        _etags[chave] = etag
+        while len(_etags) > _ETAGS_MAXIMO:
+            _etags.popitem(last=False)
+    return etag
+
+
+def _comprimir(caminho, codificacao):
+    """
+    Garante a versão comprimida do arquivo (.br ou .gz) ao lado do original
+
+    Retorna:
+    - caminho da versão comprimida, ou None se ela não pôde ser criada
+    """
+    destino = f'{caminho}.{codificacao}'
+    try:
+        if os.path.getmtime(destino) >= os.path.getmtime(caminho):
+            return destino
+    except OSError:
+        pass
+    if codificacao == 'br' and brotli is None:
+        return None
+    with _compressao_lock:
+        with open(caminho, 'rb') as f:
+            dados = f.read()
+        if codificacao == 'br':
+            comprimido = brotli.compress(dados, quality=11)
+        else:
+            comprimido = gzip.compress(dados, compresslevel=9, mtime=0)
+        temporario = f'{destino}.{os.getpid()}.tmp'
+        try:
+            with open(temporario, 'wb') as f:
+                f.write(comprimido)
+            os.replace(temporario, destino)
+        except OSError:
+            return None
+    return destino
+
+
+def _escolher_codificacao(caminho, estado):
+    if os.path.splitext(caminho)[1].lower() not in EXTENSOES_TEXTO or estado.st_size < TAMANHO_MINIMO_COMPRESSAO:
+        return None, caminho
+    aceitas = request.headers.get('Accept-Encoding', '').lower()
+    for codificacao, nome in (('br', 'br'), ('gzip', 'gz')):
+        if codificacao in aceitas:
+            comprimido = _comprimir(caminho, nome)
+            if comprimido:
+                return codificacao, comprimido
+    return None, caminho
+
+
+def servir_arquivo(diretorio, nome):
+    """
+    Responde com um arquivo do diretório, aplicando a política de cache HTTP
+
+    Parâmetros:
+    - diretorio (str): diretório base
+    - nome (str): caminho relativo pedido pelo cliente
+    """
+    caminho = safe_join(os.path.abspath(diretorio), nome)
+    if caminho is None or not os.path.isfile(caminho):
+        abort(404)
+    estado = os.stat(caminho)
+    mimetype = mimetypes.guess_type(caminho)[0] or 'application/octet-stream'
+    codificacao, arquivo = _escolher_codificacao(caminho, estado)
+
+    etag = _etag(caminho, estado)
+    if codificacao:
+        # Cada codificação é uma representação diferente e precisa de um ETag próprio
+        etag = f'{etag}-{codificacao}'
+
+    imutavel = _NOME_COM_HASH.search(caminho) is not None
+    if imutavel:
+        max_age, cache_control = IMUTAVEL_MAX_AGE, f'public, max-age={IMUTAVEL_MAX_AGE}, immutable'
+    elif mimetype == 'text/html':
+        max_age, cache_control = None, 'no-cache'
+    else:
+        max_age, cache_control = ESTATICOS_MAX_AGE, f'public, max-age={ESTATICOS_MAX_AGE}'
+
+    resposta = send_file(arquivo, mimetype=mimetype, download_name=os.path.basename(caminho), etag=etag,
+                         conditional=True, max_age=max_age, last_modified=estado.st_mtime)
+    resposta.headers['Cache-Control'] = cache_control
+    if codificacao:
+        resposta.headers['Content-Encoding'] = codificacao
+    if os.path.splitext(caminho)[1].lower() in EXTENSOES_TEXTO:
+        resposta.headers['Vary'] = 'Accept-Encoding'
+    return resposta
+
+
+def precomprimir_diretorio(diretorio):
+    """Cria de antemão as versões .gz e .br de todos os arquivos de texto do diretório"""
+    total = 0
+    for raiz, _, arquivos in os.walk(diretorio):
+        for nome in arquivos:
+            caminho = os.path.join(raiz, nome)
+            if os.path.splitext(nome)[1].lower() not in EXTENSOES_TEXTO:
+                continue
+            if os.path.getsize(caminho) < TAMANHO_MINIMO_COMPRESSAO:
+                continue
+            for codificacao in ('gz', 'br'):
+                if _comprimir(caminho, codificacao):
+                    total += 1
+    return total
+
+
+if __name__ == '__main__':
+    for diretorio in sys.argv[1:] or ['pag']:
+        print(f'{diretorio}: {precomprimir_diretorio(diretorio)} arquivos comprimidos')
@@ -0,0 +1,495 @@
+"""
+Núcleo do gerador de imagens em linha de comando
+
+Geração por texto e por imagem, com nova tentativa quando o modelo está
+carregando, troca para o próximo modelo da lista em caso de falha e o modo
+em lote. Importar este módulo não tem efeitos colaterais: nada é exibido,
+nenhum diretório é criado e o Pillow e o requests só são carregados quando
+alguma função precisa deles. A exibição das imagens (matplotlib) fica a
+cargo de quem chama (veja gerador_imagens_huggingface_v2_corrigido.py).
+
+As mensagens de andamento vão para o logger deste módulo.
+"""
+
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+from funçoes.cache_imagens import CacheImagens
+from funçoes.limite_taxa import LimiteTaxa
+from funçoes.prazos import Prazo, PrazoEsgotado, PRAZO_GERADOR
+from funçoes.saude_modelos import saude_modelos
+
+logger = logging.getLogger(__name__)
+
+# Configuração dos modelos - você pode alternar entre diferentes modelos disponíveis
+MODELOS = {
+    "text2image": [
+        "runwayml/stable-diffusion-v1-5",      # Modelo popular e bem estabelecido
+        "stabilityai/stable-diffusion-xl-base-1.0",  # SDXL Base
+        "prompthero/openjourney"               # Estilo Midjourney
+    ],
+    "image2image": [
+        "runwayml/stable-diffusion-v1-5",      # Também funciona bem para image-to-image
+        "timbrooks/instruct-pix2pix",          # Bom para edição de imagens com instruções
+    ]
+}
+
+OUTPUT_DIR = "imagens_geradas"
+
+# Caches de imagens por diretório de saída, criados no primeiro uso
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def _aguardar_vez(limite, modelo, prazo):
+    """Espera o horário livre do modelo, se houver limite de taxa (LimiteTaxa; None = sem limite)"""
+    if limite is not None:
+        limite.aguardar(modelo, prazo)
+
+
+def sequencia_modelos(tipo, modelo=None):
+    """
+    Modelos a tentar, em ordem: o pedido e depois os demais do tipo, dos mais
+    saudáveis e rápidos para os piores (veja funçoes/saude_modelos.py)
+
+    Parâmetros:
+    - tipo (str): "text2image" ou "image2image"
+    - modelo (str): primeiro modelo; None deixa a ordem toda pela saúde dos modelos
+
+    Com PROVEDORES_OFFLINE=1 só o modelo do provedor local é usado (veja funçoes/provedores.py).
+    """
+    from funçoes import provedores
+    if provedores.registro.offline:
+        return provedores.local.modelos(provedores.TEXTO_IMAGEM)
+    if modelo is None:
+        return saude_modelos.ordenar(MODELOS[tipo])
+    return [modelo] + saude_modelos.ordenar([m for m in MODELOS[tipo] if m != modelo])
+
+
+def _cache(diretorio):
+    with _caches_lock:
+        if diretorio not in _caches:
+            _caches[diretorio] = CacheImagens(os.path.join(diretorio, "cache"))
+        return _caches[diretorio]
+
+
+def _cache_entradas(diretorio):
+    """Cache das imagens de entrada já preparadas para image-to-image"""
+    from funçoes import preparo_imagens
+    chave = os.path.join(diretorio, "cache", "entradas")
+    with _caches_lock:
+        if chave not in _caches:
+            _caches[chave] = CacheImagens(chave, tamanho_maximo=int(preparo_imagens.EDICAO_CACHE_MB * 1024 * 1024),
+                                          prefixo='entrada_')
+        return _caches[chave]
+
+
+def _extensao(conteudo):
+    """Extensão do arquivo de acordo com o formato da imagem, lido só do cabeçalho"""
+    from funçoes import imagens
+    dimensoes = imagens.ler_dimensoes(conteudo[:imagens.CABECALHO_MAXIMO])
+    return imagens.EXTENSOES[dimensoes[0]] if dimensoes else "png"
+
+
+def _imagem_valida(modelo, conteudo):
+    """
+    Confere pelo cabeçalho se a resposta do modelo é uma imagem PNG/JPEG/WebP de
+    dimensões aceitáveis; se não for, registra a tentativa como falha do modelo
+    """
+    from funçoes import imagens
+    dimensoes = imagens.ler_dimensoes(conteudo[:imagens.CABECALHO_MAXIMO])
+    if dimensoes and 0 < dimensoes[1] <= imagens.DIMENSAO_MAXIMA and 0 < dimensoes[2] <= imagens.DIMENSAO_MAXIMA:
+        return True
+    logger.info(f"Resposta do modelo {modelo} não é uma imagem válida")
+    saude_modelos.registrar_falha(modelo, 'imagem inválida')
+    return False
+
+
+def _slug(texto, tamanho):
+    # Limitar o tamanho do nome do arquivo e remover caracteres especiais
+    return "".join(c for c in texto if c.isalnum() or c in " ")[:tamanho].strip().replace(" ", "_")
+
+
+def _registrar_falha(modelo, response):
+    from funçoes import imagens
+    if "loading" in response.text.lower():
+        saude_modelos.registrar_carregando(modelo, imagens.tempo_estimado(response))
+    else:
+        saude_modelos.registrar_falha(modelo, f'HTTP {response.status_code}')
+
+
+def _token(token):
+    return os.environ.get('HUGGINGFACE_API_TOKEN', '') if token is None else token
+
+
+def gerar_texto(prompt, num_inference_steps=30, guidance_scale=7.5, salvar=True, modelo=None, token=None,
+                diretorio=OUTPUT_DIR, abrir=True, prazo=None, limite=None):
+    """
+    Gera uma imagem a partir de um prompt de texto, trocando de modelo em caso de falha
+
+    Parâmetros:
+    - prompt (str): Descrição textual da imagem
+    - num_inference_steps (int): Número de etapas de inferência
+    - guidance_scale (float): Quão fielmente o modelo deve seguir o prompt
+    - salvar (bool): Se True, salva a imagem em diretorio
+    - modelo (str): Primeiro modelo a tentar; None usa o primeiro da lista
+    - token (str): Token da Hugging Face (padrão: HUGGINGFACE_API_TOKEN)
+    - diretorio (str): Onde salvar as imagens e o cache
+    - abrir (bool): Se False, não abre a imagem com o Pillow ('imagem' fica None)
+    - prazo (Prazo): prazo de todas as tentativas e esperas (padrão: PRAZO_GERADOR a partir de agora)
+    - limite (LimiteTaxa): limite de requisições por modelo (ex.: o do modo em lote; None = sem limite)
+
+    Retorna:
+    - dict com 'imagem' (PIL), 'arquivo' (caminho salvo ou None) e 'modelo', ou None se falhar
+      (inclusive com o prazo esgotado)
+    """
+    from funçoes import http_cliente, imagens, provedores
+    from funçoes.aquecimento import espera_carregamento
+
+    prompt_melhorado = imagens.melhorar_prompt(prompt)
+    headers = provedores.huggingface.headers(_token(token))
+    payload = imagens.montar_payload(prompt_melhorado, num_inference_steps, guidance_scale)
+    negative_prompt = payload["parameters"]["negative_prompt"]
+    prazo = prazo or Prazo(PRAZO_GERADOR)
+
+    modelos = sequencia_modelos("text2image", modelo)
+    for modelo_atual in modelos:
+        if modelo_atual != modelos[0]:
+            logger.info(f"Tentando com modelo alternativo: {modelo_atual}")
+        try:
+            api_url = provedores.huggingface.url(modelo_atual)
+
+            # Verificar se a mesma imagem já foi gerada antes (sem custo de API)
+            em_cache = _cache(diretorio).buscar(prompt_melhorado, [modelo_atual], num_inference_steps,
+                                                guidance_scale, negative_prompt)
+            if em_cache:
+                logger.info(f"Imagem encontrada no cache: {em_cache[1]}")
+                with open(em_cache[1], "rb") as f:
+                    conteudo = f.read()
+            elif modelo_atual in provedores.local.modelos(provedores.TEXTO_IMAGEM):
+                # Offline: imagem procedural, gerada na hora
+                conteudo = provedores.local.imagem(payload)[0]
+            else:
+                if modelo_atual != modelo and not saude_modelos.permitir(modelo_atual):
+                    logger.info(f"Modelo {modelo_atual} com muitas falhas recentes, pulando")
+                    continue
+                logger.info(f"Gerando imagem para o prompt: '{prompt}'...")
+                if prompt_melhorado != prompt:
+                    logger.info(f"Prompt melhorado: '{prompt_melhorado}'")
+                logger.info(f"Usando modelo: {modelo_atual}")
+                logger.info(f"Passos de inferência: {num_inference_steps} | Guidance scale: {guidance_scale}")
+                logger.info("Isso pode levar alguns minutos. Por favor, aguarde...")
+
+                _aguardar_vez(limite, modelo_atual, prazo)
+                inicio = time.monotonic()
+                response = http_cliente.post(api_url, headers=headers, json=payload, prazo=prazo)
+                if response.status_code != 200:
+                    logger.info(f"Erro na requisição: {response.status_code}")
+                    logger.info(f"Mensagem: {response.text}")
+
+                    # Verificar se o erro é devido ao modelo estar carregando
+                    if "loading" in response.text.lower():
+                        # Espera o tempo estimado pelo Hugging Face (com limite) em vez de um tempo fixo
+                        espera = espera_carregamento(imagens.tempo_estimado(response))
+                        logger.info(f"O modelo está sendo carregado. Tentando novamente em {espera:.0f} segundos...")
+                        prazo.dormir(espera)
+                        _aguardar_vez(limite, modelo_atual, prazo)
+                        inicio = time.monotonic()
+                        response = http_cliente.post(api_url, headers=headers, json=payload, prazo=prazo)
+                        if response.status_code == 200:
+                            logger.info("Segunda tentativa bem-sucedida!")
+                        else:
+                            logger.info(f"Segunda tentativa falhou: {response.status_code}")
+                            logger.info(f"Mensagem: {response.text}")
+
+                if response.status_code != 200:
+                    _registrar_falha(modelo_atual, response)
+                    continue  # Tenta o próximo modelo da lista
+                conteudo = response.content
+                # Um 200 que não é imagem (ex.: JSON de erro) conta como falha e não vai para o cache
+                if not _imagem_valida(modelo_atual, conteudo):
+                    continue
+                saude_modelos.registrar_sucesso(modelo_atual, time.monotonic() - inicio)
+                _cache(diretorio).guardar(prompt_melhorado, modelo_atual, num_inference_steps, guidance_scale,
+                                          negative_prompt, conteudo, _extensao(conteudo))
+
+            filename = None
+            if salvar:
+                # Criar um nome de arquivo baseado no prompt e timestamp
+                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+                os.makedirs(diretorio, exist_ok=True)
+                filename = f"{diretorio}/text_{_slug(prompt, 30)}_{timestamp}.{_extensao(conteudo)}"
+                # Gravar os bytes recebidos da API, sem recodificar a imagem
+                with open(filename, "wb") as f:
+                    f.write(conteudo)
+                logger.info(f"Imagem salva como: {filename}")
+
+            image = None
+            if abrir:
+                from PIL import Image
+                image = Image.open(io.BytesIO(conteudo))
+            return {'imagem': image, 'arquivo': filename, 'modelo': modelo_atual}
+
+        except PrazoEsgotado:
+            logger.error(f"Tempo limite esgotado ({prazo.segundos:.0f} s) sem gerar a imagem.")
+            saude_modelos.liberar(modelo_atual)
+            return None
+        except Exception as e:
+            logger.error(f"Ocorreu um erro: {str(e)}")
+            saude_modelos.registrar_falha(modelo_atual, type(e).__name__)
+            return None
+
+    return None
+
+
+def gerar_imagem(prompt, caminho_imagem, strength=0.8, num_inference_steps=30, guidance_scale=7.5, salvar=True,
+                 modelo=None, token=None, diretorio=OUTPUT_DIR, abrir=True, prazo=None, limite=None):
+    """
+    Modifica uma imagem existente com base em um prompt, trocando de modelo em caso de falha
+
+    Parâmetros:
+    - prompt (str): Descrição textual das modificações desejadas
+    - caminho_imagem (str): Caminho para a imagem de entrada
+    - strength (float): Intensidade da transformação (0.0 a 1.0)
+    - demais parâmetros: como em gerar_texto
+
+    Retorna:
+    - dict com 'imagem' (PIL), 'original' (PIL, já redimensionada), 'arquivo'
+      (caminho salvo ou None) e 'modelo', ou None se falhar
+    """
+    from PIL import Image
+    from funçoes import http_cliente, imagens, preparo_imagens, provedores
+
+    try:
+        # 1. Verificar se o arquivo existe
+        if not os.path.exists(caminho_imagem):
+            logger.error(f"Erro: O arquivo '{caminho_imagem}' não existe.")
+            return None
+
+        # 2. Reduzir para a resolução dos modelos e codificar em JPEG (ou reaproveitar o preparo anterior)
+        entrada = preparo_imagens.preparar(caminho_imagem, _cache_entradas(diretorio))
+        if not entrada['cache']:
+            logger.info(f"Imagem preparada em {entrada['largura']}x{entrada['altura']} "
+                        f"({len(entrada['conteudo']) // 1024} KB)")
+        image = Image.open(io.BytesIO(entrada['conteudo']))
+    except Exception as e:
+        logger.error(f"Ocorreu um erro: {str(e)}")
+        return None
+
+    headers = provedores.huggingface.headers(_token(token))
+    payload = imagens.montar_payload_edicao(prompt, entrada['conteudo'], strength, num_inference_steps, guidance_scale)
+    prazo = prazo or Prazo(PRAZO_GERADOR)
+
+    modelos = sequencia_modelos("image2image", modelo)
+    for modelo_atual in modelos:
+        if modelo_atual != modelos[0]:
+            logger.info(f"Tentando com modelo alternativo: {modelo_atual}")
+        if modelo_atual != modelo and not saude_modelos.permitir(modelo_atual):
+            logger.info(f"Modelo {modelo_atual} com muitas falhas recentes, pulando")
+            continue
+        try:
+            logger.info(f"Modificando imagem com o prompt: '{prompt}'...")
+            logger.info(f"Usando modelo: {modelo_atual}")
+            logger.info(f"Intensidade da transformação: {strength * 100}%")
+            logger.info(f"Passos de inferência: {num_inference_steps} | Guidance scale: {guidance_scale}")
+            logger.info("Isso pode levar alguns minutos. Por favor, aguarde...")
+
+            if modelo_atual in provedores.local.modelos(provedores.IMAGEM_IMAGEM):
+                # Offline: a imagem de entrada misturada a um padrão procedural
+                conteudo = provedores.local.imagem(payload)[0]
+            else:
+                _aguardar_vez(limite, modelo_atual, prazo)
+                inicio = time.monotonic()
+                response = http_cliente.post(provedores.huggingface.url(modelo_atual), headers=headers, json=payload,
+                                             prazo=prazo)
+                if response.status_code != 200:
+                    logger.info(f"Erro na requisição: {response.status_code}")
+                    logger.info(f"Mensagem: {response.text}")
+                    _registrar_falha(modelo_atual, response)
+                    continue  # Tenta o próximo modelo da lista
+                conteudo = response.content
+                if not _imagem_valida(modelo_atual, conteudo):
+                    continue
+                saude_modelos.registrar_sucesso(modelo_atual, time.monotonic() - inicio)
+
+            filename = None
+            if salvar:
+                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+                # Criar um nome de arquivo baseado no prompt e nome do arquivo original
+                base_filename = os.path.basename(caminho_imagem).split(".")[0]
+                os.makedirs(diretorio, exist_ok=True)
+                filename = (f"{diretorio}/img2img_{base_filename}_{_slug(prompt, 20)}_{timestamp}."
+                            f"{_extensao(conteudo)}")
+                # Gravar os bytes recebidos da API, sem recodificar a imagem
+                with open(filename, "wb") as f:
+                    f.write(conteudo)
+                logger.info(f"Imagem salva como: {filename}")
+
+            result_image = Image.open(io.BytesIO(conteudo)) if abrir else None
+            return {'imagem': result_image, 'original': image, 'arquivo': filename, 'modelo': modelo_atual}
+
+        except PrazoEsgotado:
+            logger.error(f"Tempo limite esgotado ({prazo.segundos:.0f} s) sem gerar a imagem.")
+            saude_modelos.liberar(modelo_atual)
+            return None
+        except Exception as e:
+            logger.error(f"Ocorreu um erro: {str(e)}")
+            saude_modelos.registrar_falha(modelo_atual, type(e).__name__)
+            return None
+
+    return None
+
+
+# -- modo em lote ---------------------------------------------------------------
+
+def ler_lote(caminho):
+    """
+    Lê os itens de um arquivo de lote
+
+    Aceita um .txt (um prompt por linha; linhas vazias ou começando com # são
+    ignoradas) ou um .jsonl com um objeto por linha, com os campos:
+    - prompt (obrigatório)
+    - imagem: caminho de uma imagem de entrada (usa Image-to-Image)
+    - passos, guidance, strength, modelo: parâmetros opcionais da geração
+    - id: identificador do item (padrão: hash dos campos do item)
+
+    Retorna:
+    - list de dicts, um por item
+    """
+    itens = []
+    with open(caminho, encoding="utf-8") as f:
+        for numero, linha in enumerate(f, 1):
+            linha = linha.strip()
+            if not linha or linha.startswith("#"):
+                continue
+            if caminho.endswith(".jsonl"):
+                try:
+                    item = json.loads(linha)
+                except ValueError:
+                    logger.warning(f"Linha {numero} ignorada: JSON inválido")
+                    continue
+                if not isinstance(item, dict) or not item.get("prompt"):
+                    logger.warning(f"Linha {numero} ignorada: campo 'prompt' ausente")
+                    continue
+            else:
+                item = {"prompt": linha}
+            if "id" not in item:
+                # O id vem do conteúdo, para a retomada reconhecer o item mesmo que o arquivo mude de ordem
+                item["id"] = hashlib.sha256(json.dumps(item, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+            itens.append(item)
+    return itens
+
+
+def _ja_concluidos(manifesto):
+    """Ids dos itens que já têm resultado com sucesso no manifesto"""
+    concluidos = set()
+    if not os.path.exists(manifesto):
+        return concluidos
+    with open(manifesto, encoding="utf-8") as f:
+        for linha in f:
+            try:
+                registro = json.loads(linha)
+            except ValueError:
+                continue  # Última linha incompleta de uma execução interrompida
+            if registro.get("status") == "ok":
+                concluidos.add(registro["id"])
+    return concluidos
+
+
+def _executar_item(item, token, diretorio, limite):
+    inicio = time.monotonic()
+    if item.get("imagem"):
+        resultado = gerar_imagem(item["prompt"], item["imagem"], float(item.get("strength", 0.8)),
+                                 int(item.get("passos", 30)), float(item.get("guidance", 7.5)),
+                                 True, item.get("modelo"), token, diretorio, abrir=False, limite=limite)
+    else:
+        resultado = gerar_texto(item["prompt"], int(item.get("passos", 30)), float(item.get("guidance", 7.5)),
+                                True, item.get("modelo"), token, diretorio, abrir=False, limite=limite)
+    registro = {
+        "id": item["id"],
+        "prompt": item["prompt"],
+        "status": "ok" if resultado else "erro",
+        "modelo": resultado["modelo"] if resultado else None,
+        "arquivo": resultado["arquivo"] if resultado else None,
+        "segundos": round(time.monotonic() - inicio, 3),
+        "data": datetime.now().isoformat(timespec="seconds"),
+    }
+    if item.get("imagem"):
+        registro["imagem"] = item["imagem"]
+    return registro
+
+
+def executar_lote(caminho_lote, manifesto=None, workers=4, taxa_por_modelo=None, token=None, diretorio=OUTPUT_DIR):
+    """
+    Gera as imagens de um arquivo de lote, sem exibi-las, em paralelo
+
+    Cada resultado é acrescentado ao manifesto (JSONL) assim que termina. Se o
+    manifesto já existir, os itens concluídos com sucesso são pulados, então
+    uma execução interrompida continua de onde parou.
+
+    Parâmetros:
+    - caminho_lote (str): arquivo .txt ou .jsonl com os prompts (veja ler_lote)
+    - manifesto (str): arquivo JSONL de resultados (padrão: diretorio/manifesto_<lote>.jsonl)
+    - workers (int): gerações simultâneas
+    - taxa_por_modelo (float): requisições por minuto para cada modelo (None = sem limite)
+    - token (str): Token da Hugging Face (padrão: HUGGINGFACE_API_TOKEN)
+    - diretorio (str): Onde salvar as imagens
+
+    Retorna:
+    - dict com o resumo da execução
+    """
+    if manifesto is None:
+        nome_lote = os.path.splitext(os.path.basename(caminho_lote))[0]
+        manifesto = os.path.join(diretorio, f"manifesto_{nome_lote}.jsonl")
+    os.makedirs(os.path.dirname(os.path.abspath(manifesto)), exist_ok=True)
+    # Só desta execução: é passado a cada item, sem ficar para as chamadas seguintes
+    limite = LimiteTaxa(taxa_por_modelo) if taxa_por_modelo else None
+
+    itens = ler_lote(caminho_lote)
+    concluidos = _ja_concluidos(manifesto)
+    pendentes = [item for item in itens if item["id"] not in concluidos]
+    logger.info(f"{len(itens)} itens no lote, {len(itens) - len(pendentes)} já concluídos, {len(pendentes)} a gerar")
+    logger.info(f"Workers: {workers} | Limite por modelo: {f'{taxa_por_modelo}/min' if taxa_por_modelo else 'nenhum'}")
+    logger.info(f"Manifesto: {manifesto}")
+
+    inicio = time.monotonic()
+    sucesso, falhas, tempos = 0, 0, []
+    with open(manifesto, "a", encoding="utf-8") as saida, ThreadPoolExecutor(max_workers=workers) as executor:
+        futuros = {executor.submit(_executar_item, item, token, diretorio, limite): item for item in pendentes}
+        for futuro in as_completed(futuros):
+            item = futuros[futuro]
+            try:
+                registro = futuro.result()
+            except Exception as e:
+                registro = {"id": item["id"], "prompt": item["prompt"], "status": "erro", "erro": str(e),
+                            "data": datetime.now().isoformat(timespec="seconds")}
+            saida.write(json.dumps(registro, ensure_ascii=False) + "\n")
+            saida.flush()
+            if registro["status"] == "ok":
+                sucesso += 1
+                tempos.append(registro["segundos"])
+            else:
+                falhas += 1
+            logger.info(f"[{sucesso + falhas}/{len(pendentes)}] {registro['status']}: {item['prompt'][:60]}")
+
+    duracao = time.monotonic() - inicio
+    resumo = {
+        "itens": len(itens),
+        "pulados": len(itens) - len(pendentes),
+        "sucesso": sucesso,
+        "falhas": falhas,
+        "segundos": round(duracao, 2),
+        "imagens_por_minuto": round(sucesso * 60 / duracao, 2) if duracao else 0.0,
+        "latencia_media": round(sum(tempos) / len(tempos), 2) if tempos else 0.0,
+    }
+    logger.info(f"Lote concluído em {resumo['segundos']}s: {sucesso} imagens geradas, {falhas} falhas, "
+                f"{resumo['pulados']} puladas")
+    logger.info(f"Vazão: {resumo['imagens_por_minuto']} imagens/min | Latência média: {resumo['latencia_media']}s")
+    return resumo
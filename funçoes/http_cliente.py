@@ -0,0 +1,297 @@
+"""
+Cliente HTTP compartilhado para as APIs externas (Cohere e Hugging Face)
+
+Todas as chamadas para as APIs passam por uma única sessão do requests por
+processo, com pools de conexões por host e keep-alive. Assim cada requisição
+reaproveita conexões TCP/TLS já abertas em vez de refazer DNS, conexão e
+handshake a cada chamada.
+
+Uma chamada pode receber um prazo (veja funçoes/prazos.py): o timeout passa
+a ser o que resta dele, recalculado a cada tentativa automática (uma
+tentativa tardia não passa do prazo), as novas tentativas só começam se
+ainda houver tempo e a espera entre elas não passa do prazo. Um timeout com o
+prazo esgotado vira PrazoEsgotado.
+
+Uma chamada também pode receber uma Interrupcao, que permite a outra thread
+abandoná-la enquanto ela espera a resposta: o socket em uso é fechado, a
+thread que espera os headers acorda com um erro de conexão e nenhuma nova
+tentativa é feita. Serve às corridas entre modelos (funçoes/imagens.py), em
+que os perdedores ficariam presos até o modelo responder.
+
+Configuração (variáveis de ambiente):
+- HTTP_POOL_HOSTS: quantidade de hosts com pool mantido (padrão: 10)
+- HTTP_POOL_TAMANHO: conexões mantidas por host em cada worker (padrão: 10)
+- HTTP_TENTATIVAS: tentativas extras em falhas de conexão/status temporário (padrão: 2)
+- HTTP_BACKOFF: fator de espera exponencial entre tentativas, em segundos (padrão: 0.5)
+"""
+
+import os
+import socket
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+from funçoes.prazos import PrazoEsgotado
+
+POOL_HOSTS = int(os.environ.get('HTTP_POOL_HOSTS', 10))
+POOL_TAMANHO = int(os.environ.get('HTTP_POOL_TAMANHO', 10))
+HTTP_TENTATIVAS = int(os.environ.get('HTTP_TENTATIVAS', 2))
+HTTP_BACKOFF = float(os.environ.get('HTTP_BACKOFF', 0.5))
+
+COHERE_URL_BASE = 'https://api.cohere.ai/'
+HUGGINGFACE_URL_BASE = 'https://api-inference.huggingface.co/'
+
+# Contadores de reaproveitamento de conexões por host
+_estatisticas = {}
+_estatisticas_lock = threading.Lock()
+
+# Prazo (e timeout próprio) e interrupção da chamada em andamento em cada thread, consultados pelo urllib3
+_local = threading.local()
+
+_sessao = None
+_sessao_pid = None
+_sessao_lock = threading.Lock()
+
+
+class Interrupcao:
+    """
+    Permite abandonar, de outra thread, uma chamada à espera da resposta
+
+    Só a conexão que a chamada está usando é fechada, e só até a resposta
+    chegar: depois disso quem chama lê o corpo e confere se foi interrompido.
+    Uma conexão ainda sendo aberta no momento da interrupção segue até os
+    headers chegarem.
+    """
+
+    def __init__(self):
+        self.interrompida = False
+        self._conexao = None
+        self._lock = threading.Lock()
+
+    def _registrar(self, conexao):
+        with self._lock:
+            if self.interrompida:
+                raise ConnectionAbortedError('chamada interrompida')
+            self._conexao = conexao
+
+    def _soltar(self, conexao=None):
+        # Antes da conexão voltar para o pool, onde outra chamada pode pegá-la
+        with self._lock:
+            if conexao is None or conexao is self._conexao:
+                self._conexao = None
+
+    def interromper(self):
+        with self._lock:
+            self.interrompida = True
+            sock = getattr(self._conexao, 'sock', None)
+            self._conexao = None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+def _registrar_conexao(host, reutilizada):
+    with _estatisticas_lock:
+        contadores = _estatisticas.setdefault(host, {'reutilizadas': 0, 'novas': 0})
+        contadores['reutilizadas' if reutilizada else 'novas'] += 1
+
+
+class _ContadorMixin:
+    """Conta quantas conexões saem do pool já abertas (hit) ou precisam conectar (miss)"""
+
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(timeout=timeout)
+        # Conexões novas (ou descartadas por terem caído) ainda não têm socket
+        _registrar_conexao(self.host, getattr(conn, 'sock', None) is not None)
+        return conn
+
+
+class _PrazoMixin:
+    """Recalcula o timeout pelo prazo da chamada a cada tentativa (o urllib3 repete o da primeira)"""
+
+    def urlopen(self, *args, **kwargs):
+        prazo = getattr(_local, 'prazo', None)
+        if prazo is not None:
+            kwargs['timeout'] = prazo.timeout(getattr(_local, 'timeout', None))
+        return super().urlopen(*args, **kwargs)
+
+
+class _InterrupcaoMixin:
+    """Registra na Interrupcao da chamada a conexão em uso enquanto a resposta não chega"""
+
+    def _make_request(self, conn, *args, **kwargs):
+        interrupcao = getattr(_local, 'interrupcao', None)
+        if interrupcao is not None:
+            interrupcao._registrar(conn)
+        return super()._make_request(conn, *args, **kwargs)
+
+    def _put_conn(self, conn):
+        interrupcao = getattr(_local, 'interrupcao', None)
+        if interrupcao is not None:
+            interrupcao._soltar(conn)
+        super()._put_conn(conn)
+
+
+class _HTTPPoolContador(_InterrupcaoMixin, _PrazoMixin, _ContadorMixin, HTTPConnectionPool):
+    pass
+
+
+class _HTTPSPoolContador(_InterrupcaoMixin, _PrazoMixin, _ContadorMixin, HTTPSConnectionPool):
+    pass
+
+
+class _AdapterContador(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _HTTPPoolContador,
+            'https': _HTTPSPoolContador,
+        }
+
+
+class _RetryComPrazo(Retry):
+    """Retry que não tenta de novo (nem espera) além do prazo da chamada, nem depois de uma interrupção"""
+
+    def is_exhausted(self):
+        prazo = getattr(_local, 'prazo', None)
+        interrupcao = getattr(_local, 'interrupcao', None)
+        return (super().is_exhausted() or (prazo is not None and prazo.esgotado())
+                or (interrupcao is not None and interrupcao.interrompida))
+
+    def sleep(self, response=None):
+        prazo = getattr(_local, 'prazo', None)
+        if prazo is not None:
+            espera = self.get_retry_after(response) if response is not None else None
+            prazo.dormir(self.get_backoff_time() if espera is None else espera)
+            return
+        super().sleep(response)
+
+
+def _politica_cohere():
+    # A Cohere responde 429 quando o limite de taxa é atingido; respeitamos o Retry-After.
+    # read=0: um POST que já foi enviado e estourou o timeout de leitura pode estar sendo
+    # processado (e cobrado) do outro lado, então só repetimos falhas de conexão e os status
+    return _RetryComPrazo(
+        total=HTTP_TENTATIVAS,
+        read=0,
+        backoff_factor=HTTP_BACKOFF,
+        status_forcelist=(429, 502, 503, 504),
+        allowed_methods=frozenset(['GET', 'POST']),
+        raise_on_status=False,
+    )
+
+
+def _politica_huggingface():
+    # O 503 do Hugging Face significa "modelo carregando": quem chama decide
+    # se espera ou troca de modelo, então não repetimos esse status aqui. Como na
+    # Cohere, timeouts de leitura de um POST (uma geração cara) não são repetidos
+    return _RetryComPrazo(
+        total=HTTP_TENTATIVAS,
+        read=0,
+        backoff_factor=HTTP_BACKOFF,
+        status_forcelist=(502, 504),
+        allowed_methods=frozenset(['GET', 'POST']),
+        raise_on_status=False,
+    )
+
+
+def _politica_padrao():
+    return _RetryComPrazo(total=HTTP_TENTATIVAS, backoff_factor=HTTP_BACKOFF, raise_on_status=False)
+
+
+def _criar_adapter(politica):
+    return _AdapterContador(pool_connections=POOL_HOSTS, pool_maxsize=POOL_TAMANHO, max_retries=politica)
+
+
+def _criar_sessao():
+    sessao = requests.Session()
+    sessao.mount('https://', _criar_adapter(_politica_padrao()))
+    sessao.mount('http://', _criar_adapter(_politica_padrao()))
+    sessao.mount(COHERE_URL_BASE, _criar_adapter(_politica_cohere()))
+    sessao.mount(HUGGINGFACE_URL_BASE, _criar_adapter(_politica_huggingface()))
+    return sessao
+
+
+def obter_sessao():
+    """
+    Retorna a sessão HTTP do processo atual
+
+    A sessão é criada de forma preguiçosa e recriada após um fork, para que
+    cada worker do gunicorn tenha seus próprios pools de conexões.
+    """
+    global _sessao, _sessao_pid
+    pid = os.getpid()
+    if _sessao is None or _sessao_pid != pid:
+        with _sessao_lock:
+            if _sessao is None or _sessao_pid != pid:
+                _sessao = _criar_sessao()
+                _sessao_pid = pid
+                with _estatisticas_lock:
+                    _estatisticas.clear()
+    return _sessao
+
+
+def _requisitar(metodo, url, prazo=None, interrupcao=None, **kwargs):
+    _local.interrupcao = interrupcao
+    try:
+        if prazo is None:
+            return obter_sessao().request(metodo, url, **kwargs)
+        _local.timeout = kwargs.get('timeout')
+        kwargs['timeout'] = prazo.timeout(_local.timeout)
+        _local.prazo = prazo
+        try:
+            return obter_sessao().request(metodo, url, **kwargs)
+        except (requests.Timeout, requests.ConnectionError) as erro:
+            # Um timeout na última tentativa repetida chega como ConnectionError (MaxRetryError)
+            if prazo.esgotado():
+                raise PrazoEsgotado() from erro
+            raise
+    finally:
+        _local.prazo = None
+        _local.timeout = None
+        _local.interrupcao = None
+        if interrupcao is not None:
+            interrupcao._soltar()
+
+
+def post(url, prazo=None, interrupcao=None, **kwargs):
+    """
+    Parâmetros:
+    - prazo (Prazo): prazo da chamada; o timeout passa a ser o que resta dele
+      (limitado pelo timeout recebido, se houver)
+    - interrupcao (Interrupcao): permite a outra thread abandonar a chamada
+      enquanto a resposta não chega (vira requests.ConnectionError)
+
+    Lança:
+    - PrazoEsgotado: se o prazo acabou antes ou durante a chamada
+    """
+    return _requisitar('POST', url, prazo, interrupcao, **kwargs)
+
+
+def get(url, prazo=None, interrupcao=None, **kwargs):
+    return _requisitar('GET', url, prazo, interrupcao, **kwargs)
+
+
+def estatisticas_pool():
+    """
+    Retorna os contadores de reaproveitamento de conexões por host
+
+    Retorna:
+    - dict: {host: {'reutilizadas', 'novas', 'taxa_reuso'}} mais a configuração do pool
+    """
+    with _estatisticas_lock:
+        hosts = {}
+        for host, contadores in _estatisticas.items():
+            total = contadores['reutilizadas'] + contadores['novas']
+            hosts[host] = dict(contadores, taxa_reuso=round(contadores['reutilizadas'] / total, 4) if total else 0.0)
+    return {
+        'pid': os.getpid(),
+        'pool_hosts': POOL_HOSTS,
+        'pool_tamanho': POOL_TAMANHO,
+        'hosts': hosts,
+    }
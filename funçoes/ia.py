@@ -1,19 +1,140 @@
-import requests
-
-def responder_cohere(pergunta, api_key):
-    url = 'https://api.cohere.ai/v1/chat'
-    headers = {
-        'Authorization': f'Bearer {api_key}',
-        'Content-Type': 'application/json'
-    }
-    payload = {
-        'message': pergunta,
-        'model': 'command-r-plus',
-        'chat_history': []
-    }
-    response = requests.post(url, headers=headers, json=payload)
-    if response.status_code == 200:
-        data = response.json()
-        return data.get('text', 'Sem resposta da IA.')
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from funçoes import metricas, provedores
+from funçoes.cache_respostas import CacheRespostas, normalizar_pergunta
+from funçoes.limite_taxa import LimiteTaxa
+from funçoes.prazos import Prazo, PrazoEsgotado, PRAZO_PERGUNTAR, PRAZO_PERGUNTAR_STREAM, PRAZO_PERGUNTAR_LOTE
+
+# Cache de respostas compartilhado por todo o processo (também usado pelo app.py)
+cache_respostas = CacheRespostas()
+
+# Perguntas em lote: chamadas simultâneas por lote, chamadas por minuto à Cohere
+# somando todos os lotes do processo, e perguntas aceitas num lote
+LOTE_CONCORRENCIA = int(os.environ.get('LOTE_CONCORRENCIA', 4))
+LOTE_TAXA_POR_MINUTO = float(os.environ.get('LOTE_TAXA_POR_MINUTO', 120))
+LOTE_MAXIMO = int(os.environ.get('LOTE_MAXIMO', 100))
+
+_limite_lote = LimiteTaxa(LOTE_TAXA_POR_MINUTO)
+
+def responder_cohere(pergunta, api_key, historico=None, prazo=None):
+    """
+    Parâmetros:
+    - prazo (Prazo): prazo da resposta (padrão: PRAZO_PERGUNTAR a partir de agora)
+
+    Lança:
+    - PrazoEsgotado: se a Cohere não respondeu dentro do prazo
+    """
+    # Pergunta repetida: responder sem chamar a API (só fora de uma conversa,
+    # já que com histórico a resposta depende do que foi dito antes)
+    if not historico:
+        resposta = cache_respostas.buscar(pergunta)
+        if resposta is not None:
+            return resposta
+    # O provedor de chat principal (a Cohere; o local com PROVEDORES_OFFLINE=1)
+    resultado = provedores.responder(pergunta, api_key, historico, prazo or Prazo(PRAZO_PERGUNTAR))
+    if resultado['status'] == 200:
+        resposta = resultado['texto']
+        if resposta and not historico and not resultado['reserva']:
+            cache_respostas.guardar(pergunta, resposta)
+        return resposta or 'Sem resposta da IA.'
     else:
-        return f'Erro: {response.status_code} - {response.text}'
+        return f'Erro: {resultado["status"]} - {resultado.get("erro", "")}'
+
+def responder_cohere_stream(pergunta, api_key, historico=None, prazo=None):
+    """
+    Versão de responder_cohere que devolve um gerador com os pedaços da
+    resposta à medida que a IA os produz (modo stream da API de chat)
+
+    Parâmetros:
+    - prazo (Prazo): prazo da resposta inteira (padrão: PRAZO_PERGUNTAR_STREAM a partir de agora)
+
+    Lança:
+    - PrazoEsgotado: se a resposta não terminou dentro do prazo (os pedaços
+      já enviados continuam valendo)
+    """
+    prazo = prazo or Prazo(PRAZO_PERGUNTAR_STREAM)
+    if not historico:
+        resposta = cache_respostas.buscar(pergunta)
+        if resposta is not None:
+            yield resposta
+            return
+    provedor = provedores.provedor_chat()
+    if provedor is None:
+        yield 'Erro: nenhum provedor de chat disponível'
+        return
+    partes = []
+    for texto in provedor.responder_stream(pergunta, api_key, historico, prazo):
+        partes.append(texto)
+        yield texto
+    resposta = ''.join(partes)
+    if resposta and not historico and not resposta.startswith('Erro: '):
+        cache_respostas.guardar(pergunta, resposta)
+
+def _responder_item_lote(pergunta, api_key, prazo):
+    """Uma pergunta do lote: do cache ou da API; erros viram parte do resultado"""
+    inicio = time.monotonic()
+    resposta = cache_respostas.buscar(pergunta)
+    if resposta is not None:
+        return {'resposta': resposta, 'cache': True, 'segundos': round(time.monotonic() - inicio, 3)}
+    try:
+        prazo.verificar()
+        # O limite de taxa é para a API externa; offline as respostas saem na hora
+        provedor = provedores.provedor_chat()
+        if provedor is not None and not provedor.local:
+            _limite_lote.aguardar(provedor.nome, prazo)
+        resultado = provedores.responder(pergunta, api_key, prazo=prazo)
+    except PrazoEsgotado as e:
+        return {'erro': str(e), 'prazo_esgotado': True, 'segundos': round(time.monotonic() - inicio, 3)}
+    except Exception as e:
+        return {'erro': f'{type(e).__name__}: {str(e)}', 'segundos': round(time.monotonic() - inicio, 3)}
+    segundos = round(time.monotonic() - inicio, 3)
+    if resultado['status'] != 200:
+        return {'erro': f'{resultado["status"]} - {resultado.get("erro", "")[:200]}', 'status': resultado['status'],
+                'segundos': segundos}
+    resposta = resultado['texto']
+    if not resposta:
+        return {'erro': 'Sem resposta da IA.', 'segundos': segundos}
+    if not resultado['reserva']:
+        cache_respostas.guardar(pergunta, resposta)
+    return {'resposta': resposta, 'segundos': segundos}
+
+def responder_cohere_lote(perguntas, api_key, concorrencia=None, prazo=None):
+    """
+    Responde uma lista de perguntas em paralelo, devolvendo cada resultado assim que fica pronto
+
+    Perguntas iguais (depois de normalizadas, como no cache de respostas) são
+    feitas uma única vez. As chamadas à API respeitam LOTE_TAXA_POR_MINUTO,
+    compartilhado por todos os lotes do processo. Uma pergunta que falha não
+    interrompe as outras.
+
+    Parâmetros:
+    - perguntas (list): perguntas (str), na ordem recebida
+    - concorrencia (int): chamadas simultâneas (padrão: LOTE_CONCORRENCIA)
+    - prazo (Prazo): prazo do lote inteiro (padrão: PRAZO_PERGUNTAR_LOTE a partir de agora)
+
+    Retorna:
+    - gerador de dicts {'indices', 'pergunta', 'resposta' ou 'erro', 'segundos'}, na
+      ordem em que ficam prontos; 'indices' são as posições da pergunta na lista
+      (mais de uma quando ela se repete) e 'cache' aparece quando a resposta veio do cache
+    """
+    prazo = prazo or Prazo(PRAZO_PERGUNTAR_LOTE)
+    unicas = {}
+    for indice, pergunta in enumerate(perguntas):
+        unicas.setdefault(normalizar_pergunta(pergunta), (pergunta, []))[1].append(indice)
+
+    executor = ThreadPoolExecutor(max_workers=max(1, concorrencia or LOTE_CONCORRENCIA),
+                                  thread_name_prefix='lote')
+    try:
+        futuros = {executor.submit(_responder_item_lote, pergunta, api_key, prazo): (pergunta, indices)
+                   for pergunta, indices in unicas.values()}
+        for futuro in as_completed(futuros):
+            pergunta, indices = futuros[futuro]
+            resultado = futuro.result()
+            metricas.contar('atomai_lote_perguntas_total',
+                            resultado='erro' if 'erro' in resultado else 'cache' if resultado.get('cache') else 'api')
+            yield dict({'indices': indices, 'pergunta': pergunta}, **resultado)
+    finally:
+        # Cliente desconectou no meio do lote: as perguntas que ainda não começaram são descartadas
+        executor.shutdown(wait=False, cancel_futures=True)
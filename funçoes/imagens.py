@@ -0,0 +1,463 @@
+"""
+Geração de imagens no Hugging Face com corrida entre modelos
+
+Em vez de tentar os modelos um depois do outro (esperando até o timeout de
+cada um), os modelos são disparados em paralelo de forma escalonada: alguns
+começam imediatamente, outro é disparado a cada HEDGE_ATRASO segundos sem
+resposta, e uma falha (ex.: modelo "loading") dispara o próximo na hora. A
+primeira imagem válida vence e as tentativas restantes são canceladas.
+
+A imagem não é decodificada: só o cabeçalho é lido para conferir o formato e
+as dimensões, e o corpo da resposta é gravado direto no disco em pedaços.
+
+Configuração (variáveis de ambiente):
+- HEDGE_PARALELOS: modelos disparados imediatamente (padrão: 1)
+- HEDGE_ATRASO: segundos sem resposta antes de disparar o próximo modelo (padrão: 4)
+- HEDGE_THREADS: tentativas simultâneas no processo inteiro (padrão: 16)
+- HUGGINGFACE_API_URL: URL base da Inference API (padrão: a do Hugging Face)
+- IMAGENS_REENCODAR: formato de uma cópia de cada imagem gerada, ex.: webp (padrão: desligado)
+- RASCUNHO_ATIVO: 0 desliga o rascunho mostrado enquanto a imagem final é gerada (padrão: 1)
+- RASCUNHO_PASSOS: passos de inferência do rascunho (padrão: 8)
+- RASCUNHO_LADO: largura e altura do rascunho, em pixels; 0 usa o tamanho padrão do modelo (padrão: 0)
+- RASCUNHO_TIMEOUT: segundos para o rascunho ficar pronto antes de ser abandonado (padrão: 15)
+
+Com HEDGE_PARALELOS igual ao número de modelos, todos correm ao mesmo tempo.
+
+Geração em duas etapas: enquanto a imagem final (30 passos) é gerada, um
+rascunho com poucos passos é pedido ao modelo mais rápido e saudável e
+mostrado ao usuário assim que fica pronto. O rascunho não entra nas medidas
+de latência dos modelos (seria rápido demais para representar uma geração
+completa) e é abandonado se a imagem final chegar antes.
+"""
+
+import base64
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import requests
+
+from funçoes import http_cliente, metricas
+from funçoes.prazos import PrazoEsgotado
+from funçoes.saude_modelos import saude_modelos
+
+logger = logging.getLogger(__name__)
+
+# Pode apontar para um servidor local de testes
+HUGGINGFACE_API_URL = os.environ.get('HUGGINGFACE_API_URL', 'https://api-inference.huggingface.co/models/')
+
+# Modelos tentados para text-to-image, em ordem de preferência
+MODELOS = [
+    "runwayml/stable-diffusion-v1-5",
+    "stabilityai/stable-diffusion-xl-base-1.0",
+    "prompthero/openjourney"
+]
+
+# Modelos tentados para image-to-image (edição de uma imagem enviada), em ordem de preferência
+MODELOS_EDICAO = [
+    "runwayml/stable-diffusion-v1-5",
+    "timbrooks/instruct-pix2pix",
+]
+
+NEGATIVE_PROMPT = "blurry, bad anatomy, bad hands, cropped, worst quality, low quality, text, watermark"
+
+HEDGE_PARALELOS = int(os.environ.get('HEDGE_PARALELOS', 1))
+HEDGE_ATRASO = float(os.environ.get('HEDGE_ATRASO', 4))
+HEDGE_THREADS = int(os.environ.get('HEDGE_THREADS', 16))
+
+# Formato de uma cópia opcional de cada imagem gerada, ex.: "webp" (vazio desliga)
+IMAGENS_REENCODAR = os.environ.get('IMAGENS_REENCODAR', '')
+
+_executor = ThreadPoolExecutor(max_workers=HEDGE_THREADS, thread_name_prefix='hedge')
+_executor_reencode = ThreadPoolExecutor(max_workers=1, thread_name_prefix='reencode')
+
+RASCUNHO_ATIVO = os.environ.get('RASCUNHO_ATIVO', '1') != '0'
+RASCUNHO_PASSOS = int(os.environ.get('RASCUNHO_PASSOS', 8))
+RASCUNHO_LADO = int(os.environ.get('RASCUNHO_LADO', 0))
+RASCUNHO_TIMEOUT = float(os.environ.get('RASCUNHO_TIMEOUT', 15))
+
+
+def melhorar_prompt(prompt):
+    """Acrescenta ao prompt os termos que costumam melhorar o resultado"""
+    prompt = prompt.strip()
+    if not prompt.lower().startswith(("a photo of", "an image of")):
+        return f"A detailed high quality image of {prompt}, 4k resolution, detailed"
+    return prompt
+
+
+def montar_payload(prompt_melhorado, num_inference_steps=30, guidance_scale=7.5, negative_prompt=NEGATIVE_PROMPT,
+                   lado=None):
+    """
+    Parâmetros:
+    - lado (int): largura e altura pedidas, em pixels; None usa o tamanho padrão do modelo
+    """
+    payload = {
+        "inputs": prompt_melhorado,
+        "parameters": {
+            "num_inference_steps": num_inference_steps,
+            "guidance_scale": guidance_scale,
+            "negative_prompt": negative_prompt
+        }
+    }
+    if lado:
+        payload["parameters"].update(width=lado, height=lado)
+    return payload
+
+
+def montar_payload_rascunho(prompt_melhorado):
+    """Payload do rascunho: poucos passos e, se configurado, resolução menor"""
+    return montar_payload(prompt_melhorado, RASCUNHO_PASSOS, lado=RASCUNHO_LADO or None)
+
+
+def montar_payload_edicao(prompt_melhorado, imagem, strength=0.8, num_inference_steps=30, guidance_scale=7.5):
+    """
+    Parâmetros:
+    - imagem (bytes): imagem de entrada já preparada (veja funçoes/preparo_imagens.py)
+    """
+    return {
+        "inputs": {
+            "prompt": prompt_melhorado,
+            "image": base64.b64encode(imagem).decode('ascii'),
+            "strength": strength,
+            "num_inference_steps": num_inference_steps,
+            "guidance_scale": guidance_scale
+        }
+    }
+
+
+# Tamanho dos pedaços lidos da resposta e limite de bytes lidos procurando as dimensões
+TAMANHO_PEDACO = 64 * 1024
+CABECALHO_MAXIMO = 256 * 1024
+# Maior largura/altura aceita de uma imagem gerada
+DIMENSAO_MAXIMA = 8192
+
+EXTENSOES = {'PNG': 'png', 'JPEG': 'jpg', 'WEBP': 'webp'}
+
+
+def ler_dimensoes(cabecalho):
+    """
+    Identifica o formato e as dimensões da imagem só pelos primeiros bytes,
+    sem decodificar os pixels
+
+    Retorna:
+    - tupla (formato, largura, altura), ou None se os bytes não bastam ou não são PNG/JPEG/WebP
+    """
+    if cabecalho[:8] == b'\x89PNG\r\n\x1a\n':
+        if len(cabecalho) < 24 or cabecalho[12:16] != b'IHDR':
+            return None
+        return 'PNG', int.from_bytes(cabecalho[16:20], 'big'), int.from_bytes(cabecalho[20:24], 'big')
+
+    if cabecalho[:2] == b'\xff\xd8':
+        # Percorre os segmentos do JPEG até o SOF, que tem as dimensões
+        i = 2
+        while i + 9 <= len(cabecalho):
+            if cabecalho[i] != 0xFF:
+                return None
+            marcador = cabecalho[i + 1]
+            if marcador == 0xFF:
+                i += 1
+                continue
+            if 0xC0 <= marcador <= 0xCF and marcador not in (0xC4, 0xC8, 0xCC):
+                return 'JPEG', int.from_bytes(cabecalho[i + 7:i + 9], 'big'), int.from_bytes(cabecalho[i + 5:i + 7], 'big')
+            i += 2 + int.from_bytes(cabecalho[i + 2:i + 4], 'big')
+        return None
+
+    if cabecalho[:4] == b'RIFF' and cabecalho[8:12] == b'WEBP' and len(cabecalho) >= 30:
+        bloco = cabecalho[12:16]
+        if bloco == b'VP8 ' and cabecalho[23:26] == b'\x9d\x01\x2a':
+            return ('WEBP', int.from_bytes(cabecalho[26:28], 'little') & 0x3FFF,
+                    int.from_bytes(cabecalho[28:30], 'little') & 0x3FFF)
+        if bloco == b'VP8L' and cabecalho[20] == 0x2F:
+            bits = int.from_bytes(cabecalho[21:25], 'little')
+            return 'WEBP', (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        if bloco == b'VP8X':
+            return ('WEBP', int.from_bytes(cabecalho[24:27], 'little') + 1,
+                    int.from_bytes(cabecalho[27:30], 'little') + 1)
+    return None
+
+
+def _remover_temporario(arquivo):
+    if arquivo:
+        try:
+            os.remove(arquivo['caminho'])
+        except OSError:
+            pass
+
+
+def _baixar_imagem(modelo, response, diretorio, cancelado):
+    """
+    Valida o cabeçalho da imagem e grava o corpo da resposta direto no disco, em pedaços
+
+    Retorna:
+    - dict com 'caminho' (arquivo temporário em diretorio), 'sha256', 'tamanho',
+      'formato', 'extensao', 'largura' e 'altura'; ou None se a imagem é inválida
+    """
+    pedacos = response.iter_content(chunk_size=TAMANHO_PEDACO)
+    cabecalho = b''
+    dimensoes = None
+    with metricas.etapa('validar_imagem'):
+        for pedaco in pedacos:
+            cabecalho += pedaco
+            dimensoes = ler_dimensoes(cabecalho)
+            if dimensoes or len(cabecalho) >= CABECALHO_MAXIMO:
+                break
+    if not dimensoes:
+        logger.error(f'Resposta do modelo {modelo} não é uma imagem PNG/JPEG/WebP válida')
+        return None
+    formato, largura, altura = dimensoes
+    if not (0 < largura <= DIMENSAO_MAXIMA and 0 < altura <= DIMENSAO_MAXIMA):
+        logger.error(f'Imagem do modelo {modelo} com dimensões inválidas: {largura}x{altura}')
+        return None
+
+    # O hash do conteúdo é calculado enquanto a imagem é gravada
+    resumo = hashlib.sha256(cabecalho)
+    tamanho = len(cabecalho)
+    descritor, caminho = tempfile.mkstemp(prefix='.baixando_', suffix='.tmp', dir=diretorio)
+    try:
+        with metricas.etapa('gravar_imagem'), os.fdopen(descritor, 'wb') as f:
+            f.write(cabecalho)
+            for pedaco in pedacos:
+                if cancelado.is_set():
+                    raise InterruptedError('outro modelo já venceu a corrida')
+                f.write(pedaco)
+                resumo.update(pedaco)
+                tamanho += len(pedaco)
+    except BaseException:
+        os.remove(caminho)
+        raise
+    metricas.contar('atomai_bytes_gravados_total', tamanho, origem='download')
+
+    return {
+        'caminho': caminho,
+        'sha256': resumo.hexdigest(),
+        'tamanho': tamanho,
+        'formato': formato,
+        'extensao': EXTENSOES[formato],
+        'largura': largura,
+        'altura': altura,
+    }
+
+
+def tempo_estimado(response):
+    """Segundos que o Hugging Face estima para o modelo terminar de carregar, se informados"""
+    try:
+        return float(response.json().get('estimated_time'))
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+
+def _medir_modelo(modelo, inicio, resultado):
+    metricas.observar('atomai_modelo_segundos', time.monotonic() - inicio, modelo=modelo, resultado=resultado)
+
+
+def _tentar_modelo(modelo, payload, headers, timeout, cancelado, diretorio, prazo=None, medir=True, url_base=None,
+                   interrupcao=None):
+    """
+    Faz uma tentativa de geração com um modelo e registra o resultado na saúde do modelo
+
+    Com medir=False (rascunhos), um sucesso só marca o modelo como carregado,
+    sem entrar na latência média nem nas métricas do modelo. Com uma
+    interrupcao (http_cliente.Interrupcao), a corrida pode abandonar a
+    tentativa enquanto ela ainda espera os headers.
+
+    Retorna:
+    - dict do arquivo baixado (veja _baixar_imagem), ou None se o modelo falhou
+      ou a corrida já foi vencida
+    """
+    if cancelado.is_set():
+        saude_modelos.liberar(modelo)
+        return None
+
+    logger.info(f'Tentando gerar imagem com modelo: {modelo}')
+    inicio = time.monotonic()
+    try:
+        # Com prazo, a tentativa recebe só o tempo que resta dele (no máximo timeout)
+        response = http_cliente.post((url_base or HUGGINGFACE_API_URL) + modelo, headers=headers, json=payload,
+                                     timeout=timeout, stream=True, prazo=prazo, interrupcao=interrupcao)
+    except PrazoEsgotado:
+        saude_modelos.liberar(modelo)
+        return None
+    except requests.RequestException as req_error:
+        if cancelado.is_set():
+            # Interrompida porque outro modelo venceu: não é falha do modelo
+            saude_modelos.liberar(modelo)
+            return None
+        logger.error(f'Erro de requisição no modelo {modelo}: {str(req_error)}')
+        saude_modelos.registrar_falha(modelo, type(req_error).__name__)
+        _medir_modelo(modelo, inicio, 'erro')
+        return None
+    # Até os headers chegarem: fila e inferência no Hugging Face
+    metricas.observar('atomai_etapa_segundos', time.monotonic() - inicio, etapa='espera_modelo')
+
+    with response:
+        # Se outro modelo já venceu, fechamos a conexão sem baixar o corpo
+        if cancelado.is_set():
+            saude_modelos.liberar(modelo)
+            return None
+
+        if response.status_code != 200:
+            if "loading" in response.text.lower():
+                logger.info(f'Modelo {modelo} ainda carregando, tentando próximo modelo...')
+                saude_modelos.registrar_carregando(modelo, tempo_estimado(response))
+                _medir_modelo(modelo, inicio, 'carregando')
+            else:
+                logger.warning(f'Erro no modelo {modelo}: {response.status_code} - {response.text}')
+                saude_modelos.registrar_falha(modelo, f'HTTP {response.status_code}')
+                _medir_modelo(modelo, inicio, 'erro')
+            return None
+
+        try:
+            arquivo = _baixar_imagem(modelo, response, diretorio, cancelado)
+        except InterruptedError:
+            saude_modelos.liberar(modelo)
+            return None
+        except (requests.RequestException, OSError) as erro:
+            logger.error(f'Erro ao receber imagem do modelo {modelo}: {str(erro)}')
+            saude_modelos.registrar_falha(modelo, type(erro).__name__)
+            _medir_modelo(modelo, inicio, 'erro')
+            return None
+
+    if arquivo is None:
+        saude_modelos.registrar_falha(modelo, 'imagem inválida')
+        _medir_modelo(modelo, inicio, 'imagem_invalida')
+    elif medir:
+        saude_modelos.registrar_sucesso(modelo, time.monotonic() - inicio)
+        _medir_modelo(modelo, inicio, 'sucesso')
+    else:
+        saude_modelos.marcar_pronto(modelo)
+    return arquivo
+
+
+def gerar_com_corrida(payload, headers, diretorio, modelos=None, timeout=20, paralelos=None, atraso=None,
+                      prazo=None, cancelado=None, medir=True, url_base=None):
+    """
+    Dispara os modelos de forma escalonada e devolve a primeira imagem válida
+
+    Parâmetros:
+    - payload (dict): corpo da requisição para a Inference API
+    - headers (dict): headers com o token do Hugging Face
+    - diretorio (str): onde a imagem vencedora é gravada (como arquivo temporário)
+    - modelos (list): modelos em ordem de preferência (padrão: MODELOS)
+    - timeout (float): timeout de cada tentativa, em segundos
+    - paralelos (int): modelos disparados imediatamente (padrão: HEDGE_PARALELOS)
+    - atraso (float): segundos antes de disparar o próximo modelo (padrão: HEDGE_ATRASO)
+    - prazo (Prazo): prazo da geração inteira; cada tentativa recebe só o que resta dele
+    - cancelado (threading.Event): permite a quem chama abandonar as tentativas em
+      andamento (as que esperam os headers só são abandonadas quando eles chegam);
+      é setado também quando a corrida termina, e aí as conexões das tentativas
+      perdedoras são fechadas
+    - medir (bool): False não registra a latência dos modelos (ex.: rascunhos)
+    - url_base (str): URL base da Inference API (padrão: HUGGINGFACE_API_URL)
+
+    Retorna:
+    - tupla (modelo, dict do arquivo temporário), ou None se todos os modelos falharam.
+      Quem chama é responsável por mover ou apagar o arquivo temporário.
+
+    Lança:
+    - PrazoEsgotado: se o prazo acabou sem nenhuma imagem válida
+    """
+    # Os modelos saudáveis e mais rápidos vão na frente
+    modelos = saude_modelos.ordenar(list(modelos or MODELOS))
+    paralelos = max(1, HEDGE_PARALELOS if paralelos is None else paralelos)
+    atraso = HEDGE_ATRASO if atraso is None else atraso
+
+    cancelado = threading.Event() if cancelado is None else cancelado
+    pendentes = {}
+    interrupcoes = {}
+    proximo = 0
+
+    def disparar():
+        nonlocal proximo
+        # Pula os modelos com o circuito aberto
+        while proximo < len(modelos):
+            modelo = modelos[proximo]
+            proximo += 1
+            if saude_modelos.permitir(modelo):
+                interrupcao = http_cliente.Interrupcao()
+                futuro = _executor.submit(_tentar_modelo, modelo, payload, headers, timeout, cancelado, diretorio,
+                                          prazo, medir, url_base, interrupcao)
+                pendentes[futuro] = modelo
+                interrupcoes[futuro] = interrupcao
+                return
+
+    while proximo < len(modelos) and len(pendentes) < paralelos:
+        disparar()
+
+    try:
+        while pendentes:
+            espera = atraso if proximo < len(modelos) else None
+            if prazo is not None:
+                espera = prazo.restante() if espera is None else min(espera, prazo.restante())
+            inicio = time.monotonic()
+            concluidos, _ = wait(pendentes, timeout=espera, return_when=FIRST_COMPLETED)
+
+            vencedor = None
+            for futuro in concluidos:
+                modelo = pendentes.pop(futuro)
+                arquivo = futuro.result()
+                if arquivo is None:
+                    # Falha: dispara o próximo modelo sem esperar o atraso
+                    if proximo < len(modelos) and vencedor is None:
+                        disparar()
+                elif vencedor is None:
+                    vencedor = (modelo, arquivo)
+                else:
+                    _remover_temporario(arquivo)
+            if vencedor:
+                if vencedor[0] != modelos[0] and medir:
+                    metricas.contar('atomai_fallback_modelo_total', modelo=vencedor[0])
+                return vencedor
+            if prazo is not None and prazo.esgotado():
+                # As tentativas em andamento são canceladas no finally
+                raise PrazoEsgotado()
+
+            # Ninguém respondeu dentro do atraso: dispara mais um modelo em paralelo
+            if not concluidos and proximo < len(modelos) and time.monotonic() - inicio >= atraso:
+                logger.info(f'Sem resposta em {atraso}s, disparando outro modelo em paralelo')
+                disparar()
+        if prazo is not None:
+            prazo.verificar()
+        return None
+    finally:
+        cancelado.set()
+        for futuro in pendentes:
+            if not futuro.cancel():
+                # Fecha a conexão de quem ainda espera os headers, liberando a thread na hora;
+                # quem já está baixando para no próximo pedaço
+                interrupcoes[futuro].interromper()
+                # Tentativa que ainda termina depois do vencedor: apaga o que ela tiver gravado
+                futuro.add_done_callback(lambda f: _remover_temporario(f.result()))
+
+
+def _reencodar(caminho, formato):
+    from PIL import Image
+    destino = f"{os.path.splitext(caminho)[0]}.{EXTENSOES[formato]}"
+    if os.path.exists(destino):
+        return
+    temporario = f'{destino}.{os.getpid()}.tmp'
+    try:
+        with metricas.etapa('reencodar'), Image.open(caminho) as imagem:
+            imagem.save(temporario, format=formato)
+        os.replace(temporario, destino)
+        metricas.contar('atomai_bytes_gravados_total', os.path.getsize(destino), origem='reencode')
+    except Exception as erro:
+        logger.error(f'Erro ao converter {caminho} para {formato}: {str(erro)}')
+        if os.path.exists(temporario):
+            os.remove(temporario)
+
+
+def reencodar_em_segundo_plano(caminho, formato=None):
+    """
+    Gera uma cópia da imagem em outro formato (ex.: WebP) ao lado do original,
+    numa thread separada, sem atrasar quem chamou
+
+    Parâmetros:
+    - formato (str): formato do Pillow; padrão IMAGENS_REENCODAR (vazio desliga)
+    """
+    formato = (formato or IMAGENS_REENCODAR).upper()
+    if formato and formato in EXTENSOES and not caminho.lower().endswith(f'.{EXTENSOES[formato]}'):
+        _executor_reencode.submit(_reencodar, caminho, formato)
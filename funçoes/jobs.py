@@ -0,0 +1,310 @@
+"""
+Fila de jobs em segundo plano, com estado durável em SQLite
+
+Tarefas lentas (como gerar uma imagem) são enfileiradas e executadas por um
+pool limitado de threads em cada processo. O estado de cada job fica num
+banco SQLite compartilhado pelos workers do gunicorn, então qualquer worker
+pode responder à consulta de status, e um job que estava executando quando
+o processo morreu volta para a fila quando o prazo de execução expira.
+
+Pedidos iguais simultâneos (mesma chave) são coalescidos: enquanto um job
+com a chave estiver na fila ou executando, os novos pedidos recebem o id
+desse job em vez de criar outro.
+
+Um job pode publicar um resultado parcial antes de terminar (ex.: o rascunho
+de uma imagem), que aparece em 'parcial' na consulta de status até o
+resultado final ficar pronto.
+
+Justiça entre clientes: cada cliente tem um limite de jobs pendentes, e o
+próximo job a executar é sempre o do cliente com menos jobs em execução
+(em caso de empate, o mais antigo).
+
+Configuração (variáveis de ambiente):
+- JOBS_WORKERS: threads executando jobs em cada processo (padrão: 2)
+- JOBS_FILA_MAXIMA: jobs pendentes no total antes de recusar novos (padrão: 100)
+- JOBS_MAX_POR_CLIENTE: jobs pendentes por cliente (padrão: 3)
+- JOBS_TEMPO_MAXIMO: segundos de execução antes do job ser devolvido à fila (padrão: 300)
+- JOBS_TENTATIVAS: execuções de um mesmo job antes de marcá-lo como erro (padrão: 3)
+- JOBS_RETENCAO: segundos que jobs terminados ficam consultáveis (padrão: 86400)
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import closing
+
+from funçoes import metricas
+
+logger = logging.getLogger(__name__)
+
+JOBS_WORKERS = int(os.environ.get('JOBS_WORKERS', 2))
+JOBS_FILA_MAXIMA = int(os.environ.get('JOBS_FILA_MAXIMA', 100))
+JOBS_MAX_POR_CLIENTE = int(os.environ.get('JOBS_MAX_POR_CLIENTE', 3))
+JOBS_TEMPO_MAXIMO = float(os.environ.get('JOBS_TEMPO_MAXIMO', 300))
+JOBS_TENTATIVAS = int(os.environ.get('JOBS_TENTATIVAS', 3))
+JOBS_RETENCAO = float(os.environ.get('JOBS_RETENCAO', 86400))
+
+# Estados possíveis de um job
+FILA = 'fila'
+EXECUTANDO = 'executando'
+CONCLUIDO = 'concluido'
+ERRO = 'erro'
+ESTADOS_FINAIS = (CONCLUIDO, ERRO)
+
+
+class FilaCheia(Exception):
+    """O job não foi aceito porque a fila (geral ou do cliente) está cheia"""
+
+    def __init__(self, mensagem, por_cliente=False):
+        super().__init__(mensagem)
+        self.por_cliente = por_cliente
+
+
+class FilaJobs:
+    """
+    Fila de jobs durável com pool de workers
+
+    Parâmetros:
+    - caminho_db (str): arquivo SQLite com o estado dos jobs
+    - workers (int): threads executando jobs neste processo
+    """
+
+    def __init__(self, caminho_db, workers=None):
+        self.caminho_db = caminho_db
+        self.workers = JOBS_WORKERS if workers is None else workers
+        self._tipos = {}
+        self._threads = []
+        self._pid = None
+        self._lock = threading.Lock()
+        self._novo_job = threading.Condition()
+
+        os.makedirs(os.path.dirname(os.path.abspath(caminho_db)), exist_ok=True)
+        with self._conectar() as conexao:
+            conexao.execute('PRAGMA journal_mode=WAL')
+            conexao.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    tipo TEXT NOT NULL,
+                    cliente TEXT NOT NULL,
+                    estado TEXT NOT NULL,
+                    dados TEXT NOT NULL,
+                    resultado TEXT,
+                    erro TEXT,
+                    progresso TEXT,
+                    tentativas INTEGER NOT NULL DEFAULT 0,
+                    criado REAL NOT NULL,
+                    atualizado REAL NOT NULL,
+                    expira REAL,
+                    chave TEXT,
+                    coalescidos INTEGER NOT NULL DEFAULT 0,
+                    parcial TEXT
+                )
+            ''')
+            # Bancos criados antes da coalescência não têm as colunas novas
+            colunas = {linha['name'] for linha in conexao.execute('PRAGMA table_info(jobs)')}
+            if 'chave' not in colunas:
+                conexao.execute('ALTER TABLE jobs ADD COLUMN chave TEXT')
+            if 'coalescidos' not in colunas:
+                conexao.execute('ALTER TABLE jobs ADD COLUMN coalescidos INTEGER NOT NULL DEFAULT 0')
+            if 'parcial' not in colunas:
+                conexao.execute('ALTER TABLE jobs ADD COLUMN parcial TEXT')
+            conexao.execute('CREATE INDEX IF NOT EXISTS jobs_estado ON jobs (estado, criado)')
+            conexao.execute('CREATE INDEX IF NOT EXISTS jobs_cliente ON jobs (cliente, estado)')
+            conexao.execute('CREATE INDEX IF NOT EXISTS jobs_chave ON jobs (chave, estado)')
+
+    def _conectar(self):
+        # Uma conexão por operação: conexões SQLite não devem ser compartilhadas entre threads
+        conexao = sqlite3.connect(self.caminho_db, timeout=10, isolation_level=None)
+        conexao.row_factory = sqlite3.Row
+        return closing(conexao)
+
+    def registrar(self, tipo, funcao):
+        """
+        Registra a função que executa os jobs de um tipo
+
+        A função recebe (dados, progresso), onde progresso(texto, parcial=None)
+        atualiza a mensagem de progresso do job e, opcionalmente, publica um
+        resultado parcial (dict), e retorna um dict com o resultado.
+        """
+        self._tipos[tipo] = funcao
+
+    def iniciar(self):
+        """Inicia as threads de execução deste processo (de novo, se o processo foi criado por fork)"""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._threads = []
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._executar_continuamente, name=f'job-worker-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def enfileirar(self, tipo, dados, cliente, chave=None):
+        """
+        Coloca um job na fila
+
+        Parâmetros:
+        - chave (str): identifica pedidos equivalentes; se já houver um job
+          pendente com a mesma chave, o id dele é devolvido e nada é enfileirado
+
+        Retorna:
+        - str: id do job
+
+        Lança:
+        - FilaCheia: se a fila geral ou a do cliente estiver no limite
+        """
+        self.iniciar()
+        agora = time.time()
+        job_id = uuid.uuid4().hex
+        with self._conectar() as conexao:
+            conexao.execute('BEGIN IMMEDIATE')
+            if chave is not None:
+                existente = conexao.execute(
+                    'SELECT id FROM jobs WHERE chave = ? AND tipo = ? AND estado IN (?, ?) ORDER BY criado LIMIT 1',
+                    (chave, tipo, FILA, EXECUTANDO)).fetchone()
+                if existente is not None:
+                    conexao.execute('UPDATE jobs SET coalescidos = coalescidos + 1 WHERE id = ?', (existente['id'],))
+                    conexao.execute('COMMIT')
+                    return existente['id']
+            pendentes = conexao.execute(
+                'SELECT COUNT(*), SUM(cliente = ?) FROM jobs WHERE estado IN (?, ?)',
+                (cliente, FILA, EXECUTANDO)).fetchone()
+            total, do_cliente = pendentes[0], pendentes[1] or 0
+            if do_cliente >= JOBS_MAX_POR_CLIENTE:
+                conexao.execute('ROLLBACK')
+                raise FilaCheia('Você já tem gerações em andamento. Aguarde elas terminarem.', por_cliente=True)
+            if total >= JOBS_FILA_MAXIMA:
+                conexao.execute('ROLLBACK')
+                raise FilaCheia('Fila de geração cheia. Tente novamente em instantes.')
+            conexao.execute(
+                'INSERT INTO jobs (id, tipo, cliente, estado, dados, progresso, criado, atualizado, chave) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (job_id, tipo, cliente, FILA, json.dumps(dados), 'Na fila', agora, agora, chave))
+            conexao.execute('COMMIT')
+        with self._novo_job:
+            self._novo_job.notify()
+        return job_id
+
+    def consultar(self, job_id):
+        """
+        Retorna o estado público de um job, ou None se ele não existir
+        """
+        with self._conectar() as conexao:
+            linha = conexao.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if linha is None:
+                return None
+            estado = {
+                'job_id': linha['id'],
+                'estado': linha['estado'],
+                'progresso': linha['progresso'],
+                'criado': linha['criado'],
+                'atualizado': linha['atualizado'],
+            }
+            if linha['estado'] == FILA:
+                estado['posicao'] = conexao.execute(
+                    'SELECT COUNT(*) FROM jobs WHERE estado = ? AND criado < ?', (FILA, linha['criado'])).fetchone()[0] + 1
+            if linha['resultado']:
+                estado['resultado'] = json.loads(linha['resultado'])
+            elif linha['parcial']:
+                estado['parcial'] = json.loads(linha['parcial'])
+            if linha['erro']:
+                estado['erro'] = linha['erro']
+            return estado
+
+    def estatisticas(self):
+        with self._conectar() as conexao:
+            contagem = dict(conexao.execute('SELECT estado, COUNT(*) FROM jobs GROUP BY estado').fetchall())
+            coalescidos = conexao.execute('SELECT COALESCE(SUM(coalescidos), 0) FROM jobs').fetchone()[0]
+        estatisticas = {estado: contagem.get(estado, 0) for estado in (FILA, EXECUTANDO, CONCLUIDO, ERRO)}
+        # Pedidos que reaproveitaram um job igual já pendente (entre os jobs ainda guardados)
+        estatisticas['coalescidos'] = coalescidos
+        return estatisticas
+
+    # -- execução -------------------------------------------------------------
+
+    def _reservar(self):
+        """
+        Reserva o próximo job a executar, ou devolve None se não houver
+
+        Jobs em execução cujo prazo expirou (o processo que os executava
+        morreu ou travou) também podem ser reservados de novo.
+        """
+        agora = time.time()
+        with self._conectar() as conexao:
+            conexao.execute('BEGIN IMMEDIATE')
+            conexao.execute(
+                'UPDATE jobs SET estado = ?, erro = ?, atualizado = ? WHERE estado = ? AND expira < ? AND tentativas >= ?',
+                (ERRO, 'O job excedeu o número de tentativas.', agora, EXECUTANDO, agora, JOBS_TENTATIVAS))
+            linha = conexao.execute('''
+                SELECT j.* FROM jobs j
+                WHERE j.estado = ? OR (j.estado = ? AND j.expira < ?)
+                ORDER BY (SELECT COUNT(*) FROM jobs r
+                          WHERE r.cliente = j.cliente AND r.estado = ? AND r.expira >= ?), j.criado
+                LIMIT 1
+            ''', (FILA, EXECUTANDO, agora, EXECUTANDO, agora)).fetchone()
+            if linha is None:
+                conexao.execute('COMMIT')
+                return None
+            conexao.execute(
+                'UPDATE jobs SET estado = ?, progresso = ?, tentativas = tentativas + 1, atualizado = ?, expira = ? '
+                'WHERE id = ?',
+                (EXECUTANDO, 'Executando', agora, agora + JOBS_TEMPO_MAXIMO, linha['id']))
+            conexao.execute('COMMIT')
+            return linha
+
+    def _atualizar(self, job_id, **campos):
+        campos['atualizado'] = time.time()
+        colunas = ', '.join(f'{nome} = ?' for nome in campos)
+        with self._conectar() as conexao:
+            conexao.execute(f'UPDATE jobs SET {colunas} WHERE id = ?', list(campos.values()) + [job_id])
+
+    def _limpar_antigos(self):
+        with self._conectar() as conexao:
+            conexao.execute('DELETE FROM jobs WHERE estado IN (?, ?) AND atualizado < ?',
+                            (CONCLUIDO, ERRO, time.time() - JOBS_RETENCAO))
+
+    def _executar(self, linha):
+        job_id = linha['id']
+        funcao = self._tipos.get(linha['tipo'])
+        if funcao is None:
+            self._atualizar(job_id, estado=ERRO, erro=f"Tipo de job desconhecido: {linha['tipo']}")
+            return
+
+        def progresso(texto, parcial=None):
+            if parcial is None:
+                self._atualizar(job_id, progresso=texto)
+            else:
+                self._atualizar(job_id, progresso=texto, parcial=json.dumps(parcial))
+
+        metricas.observar('atomai_etapa_segundos', max(0.0, time.time() - linha['criado']), etapa='fila_jobs')
+        try:
+            with metricas.etapa(f"job_{linha['tipo']}"):
+                resultado = funcao(json.loads(linha['dados']), progresso)
+            self._atualizar(job_id, estado=CONCLUIDO, progresso='Concluído', resultado=json.dumps(resultado))
+        except Exception as e:
+            logger.error(f'Erro no job {job_id}: {str(e)}')
+            self._atualizar(job_id, estado=ERRO, progresso='Falhou', erro=str(e))
+
+    def _executar_continuamente(self):
+        ultima_limpeza = 0
+        while True:
+            try:
+                linha = self._reservar()
+                if linha is not None:
+                    self._executar(linha)
+                    continue
+                if time.monotonic() - ultima_limpeza > 600:
+                    ultima_limpeza = time.monotonic()
+                    self._limpar_antigos()
+            except Exception as e:
+                logger.error(f'Erro no worker de jobs: {str(e)}')
+            # Sem jobs: espera um aviso deste processo ou verifica de novo em 1s
+            # (jobs enfileirados por outros workers do gunicorn)
+            with self._novo_job:
+                self._novo_job.wait(timeout=1)
+
@@ -0,0 +1,54 @@
+"""
+Limite de chamadas por minuto a uma API externa, dentro do processo
+
+As chamadas são espaçadas igualmente: cada uma reserva o próximo horário
+livre da chave (ex.: o modelo ou o provedor) e espera até ele chegar. Com um
+prazo (veja funçoes/prazos.py), uma chamada cujo horário cairia depois dele
+desiste na hora, sem reservar o horário.
+
+Diferente dos baldes de funçoes/admissao.py, que limitam os pedidos de cada
+cliente às rotas, este limite protege a cota de uma API externa das
+chamadas que o próprio servidor faz (o modo em lote do gerador e as
+perguntas em lote).
+"""
+
+import threading
+import time
+
+from funçoes.prazos import PrazoEsgotado, PRAZO_TENTATIVA_MINIMA
+
+
+class LimiteTaxa:
+    """
+    Limita quantas chamadas por minuto são feitas para cada chave
+
+    Parâmetros:
+    - por_minuto (float): chamadas por minuto, por chave
+    """
+
+    def __init__(self, por_minuto):
+        self.intervalo = 60.0 / por_minuto
+        self._proximo = {}
+        self._lock = threading.Lock()
+
+    def aguardar(self, chave, prazo=None):
+        """
+        Espera o próximo horário livre da chave
+
+        Parâmetros:
+        - prazo (Prazo): prazo de quem chama; a espera não passa dele
+
+        Lança:
+        - PrazoEsgotado: se depois da espera não sobraria tempo para a chamada
+        """
+        with self._lock:
+            agora = time.monotonic()
+            horario = max(agora, self._proximo.get(chave, agora))
+            if prazo is not None and horario - agora + PRAZO_TENTATIVA_MINIMA > prazo.restante():
+                raise PrazoEsgotado()
+            self._proximo[chave] = horario + self.intervalo
+        if horario > agora:
+            if prazo is None:
+                time.sleep(horario - agora)
+            else:
+                prazo.dormir(horario - agora)
@@ -0,0 +1,334 @@
+"""
+Métricas no formato de texto do Prometheus e amostrador de perfil
+
+Contadores e histogramas são mantidos em memória, em cada processo. Para
+que uma coleta em qualquer worker do gunicorn mostre o total de todos, cada
+processo grava de METRICAS_INTERVALO em METRICAS_INTERVALO segundos uma
+cópia das suas métricas em <diretório>/<pid>.json (no app, dados/metricas;
+veja Registro.configurar), e a exportação soma as cópias dos outros
+processos (atualizadas nos últimos METRICAS_RETENCAO segundos) com as
+métricas atuais do processo que atende a coleta.
+
+Uso:
+    from funçoes import metricas
+
+    metricas.contar('atomai_imagens_total', resultado='modelo')
+    metricas.observar('atomai_modelo_segundos', 2.3, modelo=modelo, resultado='sucesso')
+    with metricas.etapa('ler_json'):
+        dados = request.get_json()
+
+O amostrador de perfil, desligado por padrão, pode ser ligado e desligado
+com o servidor rodando. Enquanto ligado, uma thread guarda a pilha de
+chamadas de cada thread do processo a cada intervalo, e o resultado sai no
+formato "folded" (uma pilha por linha, com a contagem no fim), aceito pelo
+flamegraph.pl e pelo speedscope.
+
+Configuração (variáveis de ambiente):
+- METRICAS_INTERVALO: segundos entre as gravações da cópia das métricas de cada processo (padrão: 5)
+- METRICAS_RETENCAO: segundos até a cópia de um processo parado ser ignorada (padrão: 60)
+- PERFIL_INTERVALO: segundos entre duas amostras do perfil (padrão: 0.01)
+- PERFIL_MAX_PILHAS: pilhas distintas guardadas pelo perfil (padrão: 5000)
+"""
+
+import json
+import logging
+import math
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+METRICAS_INTERVALO = float(os.environ.get('METRICAS_INTERVALO', 5))
+METRICAS_RETENCAO = float(os.environ.get('METRICAS_RETENCAO', 60))
+PERFIL_INTERVALO = float(os.environ.get('PERFIL_INTERVALO', 0.01))
+PERFIL_MAX_PILHAS = int(os.environ.get('PERFIL_MAX_PILHAS', 5000))
+
+# Limites superiores (em segundos) das faixas dos histogramas de latência
+FAIXAS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, math.inf)
+
+# Nome -> (tipo, descrição); métricas fora daqui saem sem HELP
+DESCRICOES = {
+    'atomai_rota_segundos': ('histogram', 'Duração das requisições por rota (até a resposta começar a ser enviada)'),
+    'atomai_etapa_segundos': ('histogram', 'Duração das etapas internas do processamento'),
+    'atomai_modelo_segundos': ('histogram', 'Duração das chamadas a cada modelo do Hugging Face'),
+    'atomai_upstream_segundos': ('histogram', 'Duração das chamadas às outras APIs externas'),
+    'atomai_imagens_total': ('counter', 'Pedidos de imagem atendidos, pela origem da imagem'),
+    'atomai_fallback_modelo_total': ('counter', 'Imagens geradas por um modelo que não era o primeiro da fila'),
+    'atomai_bytes_gravados_total': ('counter', 'Bytes gravados na pasta de imagens geradas'),
+    'atomai_cache_total': ('counter', 'Consultas aos caches, por resultado'),
+    'atomai_lote_perguntas_total': ('counter', 'Perguntas únicas respondidas em lotes, pela origem da resposta'),
+    'atomai_provedor_chamadas_total': ('counter', 'Chamadas aos provedores de geração, por capacidade e resultado'),
+    'atomai_provedor_custo_total': ('counter', 'Custo estimado das chamadas bem-sucedidas aos provedores, em dólares'),
+    'atomai_prazos_esgotados_total': ('counter', 'Pedidos e jobs cujo prazo acabou antes da resposta'),
+    'atomai_taxa_fallback_unsplash': ('gauge', 'Fração dos pedidos de imagem atendidos pelo Unsplash'),
+}
+
+
+def _chave(nome, rotulos):
+    return nome, tuple(sorted(rotulos.items()))
+
+
+def _escapar(valor):
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _formatar_rotulos(rotulos, extra=()):
+    pares = list(rotulos) + list(extra)
+    if not pares:
+        return ''
+    return '{' + ','.join(f'{nome}="{_escapar(valor)}"' for nome, valor in pares) + '}'
+
+
+def _numero(valor):
+    if math.isinf(valor):
+        return '+Inf'
+    return repr(float(valor)) if not float(valor).is_integer() else str(int(valor))
+
+
+class Registro:
+    """Contadores e histogramas de um processo, com a soma dos outros processos na exportação"""
+
+    def __init__(self):
+        self._contadores = {}
+        self._histogramas = {}
+        self._coletores = []
+        self._lock = threading.Lock()
+        self.diretorio = None
+        self._pid = None
+
+    def configurar(self, diretorio):
+        """Liga a soma entre processos, com as cópias gravadas em diretorio"""
+        os.makedirs(diretorio, exist_ok=True)
+        self.diretorio = diretorio
+        self.iniciar()
+
+    def iniciar(self):
+        """Inicia a thread que grava a cópia das métricas (de novo, se o processo foi criado por fork)"""
+        if self.diretorio is None or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._gravar_continuamente, name='metricas', daemon=True).start()
+
+    def registrar_coletor(self, coletor):
+        """
+        Registra uma função chamada em cada exportação
+
+        Parâmetros:
+        - coletor (callable): retorna lista de (nome, rótulos (dict), valor) de
+          contadores mantidos em outro lugar (ex.: acertos de um cache)
+        """
+        self._coletores.append(coletor)
+
+    def contar(self, nome, valor=1, **rotulos):
+        chave = _chave(nome, rotulos)
+        with self._lock:
+            self._contadores[chave] = self._contadores.get(chave, 0) + valor
+
+    def observar(self, nome, valor, **rotulos):
+        chave = _chave(nome, rotulos)
+        with self._lock:
+            histograma = self._histogramas.get(chave)
+            if histograma is None:
+                # Contagem por faixa e, no fim, a soma dos valores
+                histograma = self._histogramas[chave] = [0] * len(FAIXAS) + [0.0]
+            for i, limite in enumerate(FAIXAS):
+                if valor <= limite:
+                    histograma[i] += 1
+                    break
+            histograma[-1] += valor
+
+    @contextmanager
+    def etapa(self, nome, metrica='atomai_etapa_segundos', **rotulos):
+        """Mede a duração do bloco no histograma das etapas"""
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observar(metrica, time.perf_counter() - inicio, etapa=nome, **rotulos)
+
+    def _copia(self):
+        contadores = {}
+        for coletor in self._coletores:
+            try:
+                for nome, rotulos, valor in coletor():
+                    contadores[_chave(nome, rotulos)] = valor
+            except Exception as e:
+                logger.error(f'Erro num coletor de métricas: {str(e)}')
+        with self._lock:
+            contadores.update(self._contadores)
+            histogramas = {chave: list(valores) for chave, valores in self._histogramas.items()}
+        return contadores, histogramas
+
+    def _gravar(self):
+        contadores, histogramas = self._copia()
+        dados = {
+            'contadores': [[nome, rotulos, valor] for (nome, rotulos), valor in contadores.items()],
+            'histogramas': [[nome, rotulos, valores] for (nome, rotulos), valores in histogramas.items()],
+        }
+        destino = os.path.join(self.diretorio, f'{os.getpid()}.json')
+        temporario = f'{destino}.tmp'
+        with open(temporario, 'w', encoding='utf-8') as f:
+            json.dump(dados, f)
+        os.replace(temporario, destino)
+
+    def _gravar_continuamente(self):
+        while True:
+            time.sleep(METRICAS_INTERVALO)
+            try:
+                self._gravar()
+            except Exception as e:
+                logger.error(f'Erro ao gravar as métricas: {str(e)}')
+
+    def _somar_outros_processos(self, contadores, histogramas):
+        if self.diretorio is None:
+            return
+        limite = time.time() - METRICAS_RETENCAO
+        for nome_arquivo in os.listdir(self.diretorio):
+            caminho = os.path.join(self.diretorio, nome_arquivo)
+            if not nome_arquivo.endswith('.json') or nome_arquivo == f'{os.getpid()}.json':
+                continue
+            try:
+                if os.path.getmtime(caminho) < limite:
+                    # Processo que parou de gravar (encerrado ou reiniciado)
+                    os.remove(caminho)
+                    continue
+                with open(caminho, encoding='utf-8') as f:
+                    dados = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for nome, rotulos, valor in dados['contadores']:
+                chave = (nome, tuple(tuple(par) for par in rotulos))
+                contadores[chave] = contadores.get(chave, 0) + valor
+            for nome, rotulos, valores in dados['histogramas']:
+                chave = (nome, tuple(tuple(par) for par in rotulos))
+                atual = histogramas.setdefault(chave, [0] * len(valores))
+                for i, valor in enumerate(valores):
+                    atual[i] += valor
+
+    def exportar(self):
+        """Texto no formato de exposição do Prometheus, somando todos os processos"""
+        self.iniciar()
+        contadores, histogramas = self._copia()
+        self._somar_outros_processos(contadores, histogramas)
+
+        # Fração dos pedidos de imagem que acabaram no Unsplash
+        imagens = {dict(rotulos).get('resultado'): valor for (nome, rotulos), valor in contadores.items()
+                   if nome == 'atomai_imagens_total'}
+        total = sum(imagens.values())
+        medidas = {('atomai_taxa_fallback_unsplash', ()): imagens.get('unsplash', 0) / total if total else 0.0}
+
+        linhas = []
+        por_nome = {}
+        for (nome, rotulos), valor in list(contadores.items()) + list(medidas.items()):
+            por_nome.setdefault(nome, []).append((rotulos, valor))
+        for (nome, rotulos), valores in histogramas.items():
+            por_nome.setdefault(nome, []).append((rotulos, valores))
+
+        nomes_histogramas = {nome for nome, _ in histogramas}
+        for nome in sorted(por_nome):
+            tipo, ajuda = DESCRICOES.get(nome, ('histogram' if nome in nomes_histogramas else 'counter', None))
+            if ajuda:
+                linhas.append(f'# HELP {nome} {ajuda}')
+            linhas.append(f'# TYPE {nome} {tipo}')
+            for rotulos, valor in sorted(por_nome[nome], key=lambda item: item[0]):
+                if tipo != 'histogram':
+                    linhas.append(f'{nome}{_formatar_rotulos(rotulos)} {_numero(valor)}')
+                    continue
+                acumulado = 0
+                for limite, quantidade in zip(FAIXAS, valor):
+                    acumulado += quantidade
+                    linhas.append(f'{nome}_bucket{_formatar_rotulos(rotulos, [("le", _numero(limite))])} {acumulado}')
+                linhas.append(f'{nome}_sum{_formatar_rotulos(rotulos)} {_numero(valor[-1])}')
+                linhas.append(f'{nome}_count{_formatar_rotulos(rotulos)} {acumulado}')
+        return '\n'.join(linhas) + '\n'
+
+
+class AmostradorPerfil:
+    """
+    Perfil por amostragem das pilhas de chamadas das threads deste processo
+
+    Parâmetros:
+    - intervalo (float): segundos entre duas amostras
+    - max_pilhas (int): pilhas distintas guardadas (as novas são ignoradas depois disso)
+    """
+
+    def __init__(self, intervalo=None, max_pilhas=None):
+        self.intervalo = PERFIL_INTERVALO if intervalo is None else intervalo
+        self.max_pilhas = PERFIL_MAX_PILHAS if max_pilhas is None else max_pilhas
+        self._pilhas = {}
+        self._amostras = 0
+        self._inicio = None
+        self._parar = None
+        self._lock = threading.Lock()
+
+    @property
+    def ativo(self):
+        return self._parar is not None and not self._parar.is_set()
+
+    def ligar(self, intervalo=None):
+        """Liga o amostrador, descartando o perfil anterior"""
+        with self._lock:
+            if self.ativo:
+                return
+            if intervalo:
+                self.intervalo = max(0.001, float(intervalo))
+            self._pilhas = {}
+            self._amostras = 0
+            self._inicio = time.time()
+            self._parar = threading.Event()
+            threading.Thread(target=self._amostrar, args=(self._parar,), name='perfil', daemon=True).start()
+
+    def desligar(self):
+        with self._lock:
+            if self._parar is not None:
+                self._parar.set()
+
+    def _amostrar(self, parar):
+        propria = threading.get_ident()
+        while not parar.wait(self.intervalo):
+            quadros = sys._current_frames()
+            with self._lock:
+                self._amostras += 1
+                for ident, quadro in quadros.items():
+                    if ident == propria:
+                        continue
+                    pilha = []
+                    while quadro is not None:
+                        codigo = quadro.f_code
+                        pilha.append(f'{codigo.co_name} ({os.path.basename(codigo.co_filename)}:{codigo.co_firstlineno})')
+                        quadro = quadro.f_back
+                    pilha = ';'.join(reversed(pilha))
+                    if pilha in self._pilhas or len(self._pilhas) < self.max_pilhas:
+                        self._pilhas[pilha] = self._pilhas.get(pilha, 0) + 1
+
+    def folded(self, limite=None):
+        """Pilhas no formato "folded", das mais frequentes para as menos"""
+        with self._lock:
+            pilhas = sorted(self._pilhas.items(), key=lambda item: item[1], reverse=True)
+        return ''.join(f'{pilha} {quantidade}\n' for pilha, quantidade in pilhas[:limite])
+
+    def estatisticas(self):
+        with self._lock:
+            return {
+                'ativo': self.ativo,
+                'pid': os.getpid(),
+                'intervalo': self.intervalo,
+                'inicio': self._inicio,
+                'amostras': self._amostras,
+                'pilhas': len(self._pilhas),
+            }
+
+
+# Instâncias compartilhadas pelo processo
+registro = Registro()
+perfil = AmostradorPerfil()
+
+contar = registro.contar
+observar = registro.observar
+etapa = registro.etapa
@@ -0,0 +1,181 @@
+"""
+Variantes redimensionadas (miniaturas) das imagens geradas
+
+Uma requisição como /imagens_geradas/img_<hash>.png?w=256&fmt=webp recebe
+uma versão reduzida da imagem, gerada uma única vez com o Pillow num pool
+em segundo plano e gravada ao lado do original (img_<hash>.w256.webp), no
+mesmo subdiretório quando o original está num (ex.: ab/img_ab12....png). As
+larguras são arredondadas para um conjunto fixo, o que limita o número de
+variantes por imagem e permite montar um srcset.
+
+As variantes ocupam no máximo MINIATURAS_MAX_MB; acima disso as menos
+acessadas são apagadas.
+
+Configuração (variáveis de ambiente):
+- MINIATURAS_MAX_MB: espaço máximo das variantes (padrão: 200)
+- MINIATURAS_THREADS: threads gerando variantes (padrão: 2)
+- MINIATURAS_ESPERA: segundos que a requisição espera a variante ficar pronta
+  antes de receber o original (padrão: 5)
+"""
+
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturoTimeout
+
+from funçoes import metricas
+
+logger = logging.getLogger(__name__)
+
+MINIATURAS_MAX_MB = float(os.environ.get('MINIATURAS_MAX_MB', 200))
+MINIATURAS_THREADS = int(os.environ.get('MINIATURAS_THREADS', 2))
+MINIATURAS_ESPERA = float(os.environ.get('MINIATURAS_ESPERA', 5))
+
+# Larguras disponíveis; pedidos são arredondados para a próxima da lista
+LARGURAS = (128, 256, 384, 512, 768, 1024)
+
+# Formato pedido -> (extensão, formato do Pillow, opções de gravação)
+FORMATOS = {
+    'webp': ('webp', 'WEBP', {'quality': 80, 'method': 4}),
+    'jpeg': ('jpg', 'JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+    'jpg': ('jpg', 'JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+    'png': ('png', 'PNG', {'optimize': True}),
+}
+
+_VARIANTE = re.compile(r'\.w\d+\.[a-z0-9]+$')
+# Originais aceitos: na raiz ou num subdiretório do cache de imagens (dois caracteres do hash)
+_ORIGINAL = re.compile(r'^(?:[0-9a-f]{2}/)?[^/]+$')
+_SUBDIRETORIO = re.compile(r'^[0-9a-f]{2}$')
+
+_executor = ThreadPoolExecutor(max_workers=MINIATURAS_THREADS, thread_name_prefix='miniaturas')
+_em_andamento = {}
+# Variantes conhecidas por diretório: caminho -> tamanho, da menos para a mais acessada
+_variantes = {}
+_lock = threading.Lock()
+
+
+def largura_permitida(largura):
+    for permitida in LARGURAS:
+        if largura <= permitida:
+            return permitida
+    return LARGURAS[-1]
+
+
+def nome_variante(nome, largura, formato):
+    """Ex.: ('img_ab12.png', 256, 'webp') -> 'img_ab12.w256.webp'"""
+    return f"{os.path.splitext(nome)[0]}.w{largura}.{FORMATOS[formato][0]}"
+
+
+def _conhecidas(diretorio):
+    """
+    Índice das variantes do diretório e dos seus subdiretórios, montado uma vez por processo
+
+    A varredura percorre todos os subdiretórios, então é feita fora do _lock (e só
+    pela geração, em segundo plano); quem já tem a variante no disco não precisa dela.
+    """
+    variantes = _variantes.get(diretorio)
+    if variantes is None:
+        indice = []
+        pendentes = [diretorio]
+        while pendentes:
+            for entrada in os.scandir(pendentes.pop()):
+                if entrada.is_dir() and _SUBDIRETORIO.match(entrada.name):
+                    pendentes.append(entrada.path)
+                elif _VARIANTE.search(entrada.name) and entrada.is_file():
+                    estado = entrada.stat()
+                    indice.append((estado.st_atime, entrada.path, estado.st_size))
+        with _lock:
+            variantes = _variantes.setdefault(
+                diretorio, OrderedDict((caminho, tamanho) for _, caminho, tamanho in sorted(indice)))
+    return variantes
+
+
+def _expulsar(variantes):
+    limite = MINIATURAS_MAX_MB * 1024 * 1024
+    total = sum(variantes.values())
+    while total > limite and variantes:
+        caminho, tamanho = variantes.popitem(last=False)
+        total -= tamanho
+        try:
+            os.remove(caminho)
+        except OSError:
+            pass
+
+
+def _gerar(diretorio, original, destino, largura, formato):
+    from PIL import Image
+    _, formato_pil, opcoes = FORMATOS[formato]
+    with metricas.etapa('gerar_miniatura'), Image.open(original) as imagem:
+        # Em JPEG, o draft decodifica direto numa escala reduzida (bem mais rápido)
+        imagem.draft('RGB', (largura, largura))
+        if imagem.width > largura:
+            altura = max(1, round(imagem.height * largura / imagem.width))
+            imagem = imagem.resize((largura, altura), Image.LANCZOS, reducing_gap=2.0)
+        if formato_pil == 'JPEG' and imagem.mode not in ('RGB', 'L'):
+            imagem = imagem.convert('RGB')
+        temporario = f'{destino}.{os.getpid()}.tmp'
+        imagem.save(temporario, format=formato_pil, **opcoes)
+    os.replace(temporario, destino)
+    tamanho = os.path.getsize(destino)
+    metricas.contar('atomai_bytes_gravados_total', tamanho, origem='miniatura')
+    variantes = _conhecidas(diretorio)
+    with _lock:
+        variantes[destino] = tamanho
+        _expulsar(variantes)
+    return destino
+
+
+def obter_variante(diretorio, nome, largura=None, formato=None, espera=None):
+    """
+    Retorna o nome da variante pedida, gerando-a em segundo plano se preciso
+
+    Parâmetros:
+    - diretorio (str): diretório das imagens geradas
+    - nome (str): arquivo original, relativo ao diretório (ex.: 'ab/img_ab12.png')
+    - largura (int): largura desejada (arredondada para LARGURAS); None mantém a largura
+    - formato (str): 'webp', 'jpeg' ou 'png'; None mantém o formato original
+    - espera (float): segundos esperando a geração (padrão: MINIATURAS_ESPERA)
+
+    Retorna:
+    - str: nome do arquivo da variante, ou None se não houver variante (pedido
+      inválido, original inexistente ou geração ainda não terminada)
+    """
+    original = os.path.join(diretorio, nome)
+    if not _ORIGINAL.match(nome) or _VARIANTE.search(nome) or not os.path.isfile(original):
+        return None
+    formato = (formato or os.path.splitext(nome)[1].lstrip('.')).lower()
+    if formato not in FORMATOS:
+        return None
+    largura = largura_permitida(largura) if largura else LARGURAS[-1]
+
+    variante = nome_variante(nome, largura, formato)
+    destino = os.path.join(diretorio, variante)
+    if os.path.exists(destino):
+        # Gravada por este ou outro worker (a gravação termina com os.replace, então está completa)
+        with _lock:
+            variantes = _variantes.get(diretorio)
+            if variantes is not None and destino in variantes:
+                variantes.move_to_end(destino)
+        return variante
+    with _lock:
+        futuro = _em_andamento.get(destino)
+        if futuro is None:
+            futuro = _executor.submit(_gerar, diretorio, original, destino, largura, formato)
+            _em_andamento[destino] = futuro
+            futuro.add_done_callback(lambda f: _em_andamento.pop(destino, None))
+
+    try:
+        futuro.result(timeout=MINIATURAS_ESPERA if espera is None else espera)
+        return variante
+    except FuturoTimeout:
+        return None
+    except Exception as erro:
+        logger.error(f'Erro ao gerar variante {variante}: {str(erro)}')
+        return None
+
+
+def srcset(url):
+    """Valor de srcset com as variantes WebP de uma imagem gerada"""
+    return ', '.join(f'{url}?w={largura}&fmt=webp {largura}w' for largura in LARGURAS)
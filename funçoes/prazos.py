@@ -0,0 +1,112 @@
+"""
+Prazos (deadlines) de ponta a ponta para as chamadas às APIs externas
+
+Cada pedido recebe um prazo: o instante até o qual a resposta precisa estar
+pronta. O prazo é passado adiante para cada tentativa, troca de modelo e
+espera entre tentativas, e cada uma recebe só o tempo que ainda resta
+(limitado pelo timeout próprio dela, quando houver). Com o prazo esgotado,
+PrazoEsgotado é lançado e a rota responde na hora (504), em vez de deixar
+o worker preso numa API que parou de responder.
+
+O cliente pode pedir um prazo menor com o header X-Prazo (em segundos),
+mas nunca maior que o configurado para a rota.
+
+Configuração (variáveis de ambiente):
+- PRAZO_PERGUNTAR: segundos para responder uma pergunta (padrão: 30)
+- PRAZO_PERGUNTAR_STREAM: segundos para terminar uma resposta em streaming (padrão: 120)
+- PRAZO_PERGUNTAR_LOTE: segundos para responder um lote de perguntas inteiro (padrão: 300)
+- PRAZO_IMAGEM: segundos para um job de imagem terminar, contados desde o pedido (padrão: 180)
+- PRAZO_GERADOR: segundos de cada geração no gerador em linha de comando (padrão: 600)
+- PRAZO_TENTATIVA_MINIMA: uma tentativa não começa com menos tempo que isso (padrão: 0.5)
+"""
+
+import os
+import time
+
+PRAZO_PERGUNTAR = float(os.environ.get('PRAZO_PERGUNTAR', 30))
+PRAZO_PERGUNTAR_STREAM = float(os.environ.get('PRAZO_PERGUNTAR_STREAM', 120))
+PRAZO_PERGUNTAR_LOTE = float(os.environ.get('PRAZO_PERGUNTAR_LOTE', 300))
+PRAZO_IMAGEM = float(os.environ.get('PRAZO_IMAGEM', 180))
+PRAZO_GERADOR = float(os.environ.get('PRAZO_GERADOR', 600))
+PRAZO_TENTATIVA_MINIMA = float(os.environ.get('PRAZO_TENTATIVA_MINIMA', 0.5))
+
+# Header com o prazo pedido pelo cliente, em segundos
+HEADER_PRAZO = 'X-Prazo'
+
+
+class PrazoEsgotado(Exception):
+    """O tempo do pedido acabou antes da resposta ficar pronta"""
+
+    def __init__(self, mensagem='Tempo limite do pedido esgotado.'):
+        super().__init__(mensagem)
+
+
+class Prazo:
+    """
+    Instante limite de um pedido, no relógio monotônico
+
+    Parâmetros:
+    - segundos (float): tempo disponível a partir de agora
+    """
+
+    def __init__(self, segundos):
+        self.segundos = segundos
+        self.limite = time.monotonic() + segundos
+
+    @classmethod
+    def ate(cls, instante):
+        """Prazo até um timestamp (time.time()), ex.: guardado junto de um job em outro processo"""
+        return cls(instante - time.time())
+
+    @classmethod
+    def do_pedido(cls, maximo, pedido=None):
+        """
+        Prazo de um pedido: o do cliente (header X-Prazo), se for menor que o máximo da rota
+
+        Parâmetros:
+        - maximo (float): prazo configurado para a rota
+        - pedido (str): valor do header; inválido ou ausente usa o máximo
+        """
+        try:
+            segundos = float(pedido)
+        except (TypeError, ValueError):
+            segundos = maximo
+        return cls(min(maximo, segundos) if segundos > 0 else maximo)
+
+    def restante(self):
+        return max(0.0, self.limite - time.monotonic())
+
+    def esgotado(self):
+        return time.monotonic() >= self.limite
+
+    def instante(self):
+        """O limite como timestamp (time.time())"""
+        return time.time() + self.limite - time.monotonic()
+
+    def timeout(self, maximo=None):
+        """
+        Timeout de uma tentativa: o que resta do prazo, sem passar do timeout próprio dela
+
+        Lança:
+        - PrazoEsgotado: se resta menos que PRAZO_TENTATIVA_MINIMA
+        """
+        restante = self.restante()
+        if restante < PRAZO_TENTATIVA_MINIMA:
+            raise PrazoEsgotado()
+        return restante if maximo is None else min(maximo, restante)
+
+    def verificar(self):
+        """Lança PrazoEsgotado se o prazo acabou"""
+        if self.esgotado():
+            raise PrazoEsgotado()
+
+    def dormir(self, segundos):
+        """
+        Espera entre tentativas; se a espera passaria do prazo, desiste na hora
+
+        Lança:
+        - PrazoEsgotado: se depois da espera não sobraria tempo para outra tentativa
+        """
+        if segundos + PRAZO_TENTATIVA_MINIMA > self.restante():
+            raise PrazoEsgotado()
+        time.sleep(segundos)
@@ -0,0 +1,143 @@
+"""
+Preparo das imagens de entrada para image-to-image
+
+A mesma etapa atende a rota /api/editar-imagem e o gerador em linha de
+comando:
+- o arquivo é lido em pedaços para calcular o hash, sem ser carregado
+  inteiro na memória (um upload grande fica no arquivo temporário do
+  werkzeug)
+- a imagem é reduzida para a resolução nativa dos modelos (lado maior
+  EDICAO_RESOLUCAO, dimensões múltiplas de 8) com um filtro bilinear; em
+  JPEG o draft já decodifica numa escala reduzida, então uma foto de
+  4000x3000 nunca é aberta no tamanho cheio
+- o resultado é gravado em JPEG, o formato mais compacto aceito pela
+  Inference API (um PNG do mesmo tamanho costuma ser 5 a 10 vezes maior)
+
+As entradas preparadas ficam num cache endereçado pelo hash do arquivo
+original (um CacheImagens com diretório próprio), então editar de novo a
+mesma imagem não repete o trabalho.
+
+Configuração (variáveis de ambiente):
+- EDICAO_RESOLUCAO: lado maior da imagem enviada aos modelos (padrão: 512)
+- EDICAO_QUALIDADE: qualidade do JPEG enviado (padrão: 90)
+- EDICAO_MAX_MB: tamanho máximo do arquivo recebido (padrão: 20)
+- EDICAO_CACHE_MB: espaço das entradas preparadas no cache (padrão: 100)
+"""
+
+import hashlib
+import io
+import os
+
+from funçoes import imagens, metricas
+
+EDICAO_RESOLUCAO = int(os.environ.get('EDICAO_RESOLUCAO', 512))
+EDICAO_QUALIDADE = int(os.environ.get('EDICAO_QUALIDADE', 90))
+EDICAO_MAX_MB = float(os.environ.get('EDICAO_MAX_MB', 20))
+EDICAO_CACHE_MB = float(os.environ.get('EDICAO_CACHE_MB', 100))
+
+# Nome do "modelo" das entradas no cache: muda junto com o resultado do preparo
+_VERSAO = 'preparo-jpeg'
+
+
+class EntradaInvalida(ValueError):
+    """O arquivo recebido não é uma imagem utilizável (ou é grande demais)"""
+
+
+def calcular_hash(arquivo, limite=None):
+    """
+    SHA-256 do arquivo, lido em pedaços; o arquivo volta para o início
+
+    Parâmetros:
+    - arquivo: arquivo binário aberto, com seek
+    - limite (int): tamanho máximo em bytes (padrão: EDICAO_MAX_MB)
+
+    Lança:
+    - EntradaInvalida: se o arquivo passar do limite
+    """
+    limite = int(EDICAO_MAX_MB * 1024 * 1024) if limite is None else limite
+    sha256 = hashlib.sha256()
+    lidos = 0
+    while True:
+        pedaco = arquivo.read(imagens.TAMANHO_PEDACO)
+        if not pedaco:
+            break
+        lidos += len(pedaco)
+        if lidos > limite:
+            raise EntradaInvalida(f'Imagem maior que {limite // (1024 * 1024)} MB.')
+        sha256.update(pedaco)
+    arquivo.seek(0)
+    return sha256.hexdigest()
+
+
+def dimensoes_alvo(largura, altura, resolucao):
+    """Reduz (sem ampliar) para o lado maior caber na resolução, com múltiplos de 8"""
+    escala = min(1.0, resolucao / max(largura, altura))
+    return max(8, int(largura * escala) // 8 * 8), max(8, int(altura * escala) // 8 * 8)
+
+
+def _reduzir(arquivo, resolucao, qualidade):
+    from PIL import Image, ImageOps
+    try:
+        with Image.open(arquivo) as imagem:
+            imagem.draft('RGB', (resolucao, resolucao))
+            # Fotos de celular vêm deitadas com a orientação só no EXIF
+            imagem = ImageOps.exif_transpose(imagem)
+            largura, altura = dimensoes_alvo(imagem.width, imagem.height, resolucao)
+            if imagem.mode != 'RGB':
+                imagem = imagem.convert('RGB')
+            if (largura, altura) != imagem.size:
+                imagem = imagem.resize((largura, altura), Image.BILINEAR, reducing_gap=2.0)
+            saida = io.BytesIO()
+            imagem.save(saida, format='JPEG', quality=qualidade)
+    except (OSError, ValueError, Image.DecompressionBombError) as erro:
+        raise EntradaInvalida('O arquivo enviado não é uma imagem válida.') from erro
+    return saida.getvalue(), largura, altura
+
+
+def preparar(origem, cache=None, resolucao=None, qualidade=None):
+    """
+    Prepara uma imagem de entrada para os modelos de image-to-image
+
+    Parâmetros:
+    - origem: caminho do arquivo ou arquivo binário aberto (com seek), ex.: o
+      stream de um upload
+    - cache (CacheImagens): cache das entradas preparadas; None prepara sempre
+    - resolucao (int): lado maior da imagem preparada (padrão: EDICAO_RESOLUCAO)
+    - qualidade (int): qualidade do JPEG (padrão: EDICAO_QUALIDADE)
+
+    Retorna:
+    - dict com 'conteudo' (bytes do JPEG), 'sha256' (do arquivo original),
+      'largura', 'altura', 'caminho' (arquivo no cache, ou None) e 'cache'
+      (True se veio do cache)
+
+    Lança:
+    - EntradaInvalida: arquivo grande demais ou que não é uma imagem
+    """
+    resolucao = EDICAO_RESOLUCAO if resolucao is None else resolucao
+    qualidade = EDICAO_QUALIDADE if qualidade is None else qualidade
+    if isinstance(origem, str):
+        with open(origem, 'rb') as arquivo:
+            return preparar(arquivo, cache, resolucao, qualidade)
+
+    with metricas.etapa('hash_entrada'):
+        sha256 = calcular_hash(origem)
+    versao = f'{_VERSAO}-{resolucao}-q{qualidade}'
+
+    if cache is not None:
+        em_cache = cache.buscar(sha256, [versao], 0, 0, '')
+        if em_cache:
+            try:
+                with open(em_cache[1], 'rb') as f:
+                    conteudo = f.read()
+            except OSError:
+                conteudo = None
+            dimensoes = conteudo and imagens.ler_dimensoes(conteudo[:imagens.CABECALHO_MAXIMO])
+            if dimensoes:
+                return {'conteudo': conteudo, 'sha256': sha256, 'largura': dimensoes[1], 'altura': dimensoes[2],
+                        'caminho': em_cache[1], 'cache': True}
+
+    with metricas.etapa('preparar_entrada'):
+        conteudo, largura, altura = _reduzir(origem, resolucao, qualidade)
+    caminho = cache.guardar(sha256, versao, 0, 0, '', conteudo, 'jpg') if cache is not None else None
+    return {'conteudo': conteudo, 'sha256': sha256, 'largura': largura, 'altura': altura,
+            'caminho': caminho, 'cache': False}
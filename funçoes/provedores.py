@@ -0,0 +1,543 @@
+"""
+Provedores de geração (chat e imagens) atrás de uma interface comum
+
+Cada provedor declara o que sabe fazer (capacidades), o custo estimado de
+cada chamada e a latência esperada no momento. O registro ordena, para cada
+capacidade, os provedores principais pela latência esperada; os provedores
+de reserva de uma capacidade só são usados depois que os principais falham.
+
+Provedores incluídos:
+- cohere: chat, pela API de chat da Cohere
+- huggingface: text-to-image e image-to-image, pela Inference API, com a
+  corrida entre modelos de funçoes/imagens.py
+- local: chat, text-to-image e image-to-image determinísticos, gerados na
+  CPU em milissegundos (a mesma pergunta ou o mesmo prompt sempre dá a
+  mesma resposta ou imagem). Serve para rodar o serviço inteiro sem rede,
+  por exemplo nos testes de carga, e como reserva quando as APIs externas
+  estão fora do ar, no lugar do antigo redirecionamento para o Unsplash.
+
+Configuração (variáveis de ambiente):
+- PROVEDORES_OFFLINE: 1 usa só o provedor local, sem chamar nenhuma API externa (padrão: 0)
+- PROVEDOR_LOCAL_RESERVA: capacidades em que o provedor local é reserva, separadas por
+  vírgula; vazio desliga (padrão: texto-imagem)
+- PROVEDOR_LOCAL_LADO: largura e altura das imagens do provedor local, em pixels (padrão: 512)
+- COHERE_API_URL: endpoint de chat da Cohere (padrão: o da Cohere)
+"""
+
+import base64
+import hashlib
+import io
+import json
+import logging
+import math
+import os
+import random
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+
+from funçoes import http_cliente, imagens, metricas
+from funçoes.prazos import Prazo, PrazoEsgotado, PRAZO_PERGUNTAR, PRAZO_PERGUNTAR_STREAM
+from funçoes.saude_modelos import saude_modelos, MODELOS_LATENCIA_INICIAL, PESO_MEDIA
+
+logger = logging.getLogger(__name__)
+
+# Capacidades
+CHAT = 'chat'
+TEXTO_IMAGEM = 'texto-imagem'
+IMAGEM_IMAGEM = 'imagem-imagem'
+
+PROVEDORES_OFFLINE = os.environ.get('PROVEDORES_OFFLINE', '0') == '1'
+PROVEDOR_LOCAL_RESERVA = [capacidade.strip() for capacidade in
+                          os.environ.get('PROVEDOR_LOCAL_RESERVA', TEXTO_IMAGEM).split(',') if capacidade.strip()]
+PROVEDOR_LOCAL_LADO = int(os.environ.get('PROVEDOR_LOCAL_LADO', 512))
+
+# Pode apontar para um servidor falso em testes de carga
+COHERE_API_URL = os.environ.get('COHERE_API_URL', 'https://api.cohere.ai/v1/chat')
+
+
+class Provedor(ABC):
+    """
+    Interface comum dos provedores; as capacidades declaradas vêm de ProvedorChat e ProvedorImagem
+
+    Atributos de classe:
+    - nome (str): identificador do provedor
+    - capacidades (frozenset): CHAT, TEXTO_IMAGEM e/ou IMAGEM_IMAGEM
+    - custo (dict): capacidade -> custo estimado de uma chamada, em dólares
+    - local (bool): True se não depende de nenhuma API externa
+    - rascunho (bool): True se vale a pena pedir um rascunho rápido enquanto a imagem final é gerada
+
+    Parâmetros:
+    - reserva (iterable): capacidades em que o provedor só é usado depois dos principais
+    """
+
+    nome = ''
+    capacidades = frozenset()
+    custo = {}
+    local = False
+    rascunho = False
+
+    def __init__(self, reserva=()):
+        self.reserva = frozenset(reserva) & self.capacidades
+
+    @abstractmethod
+    def modelos(self, capacidade):
+        """Modelos usados na capacidade, em ordem de preferência (nomes que vão para o cache de imagens)"""
+
+    @abstractmethod
+    def latencia(self, capacidade):
+        """Latência esperada de uma chamada agora, em segundos (infinita se indisponível)"""
+
+    def descrever(self):
+        """Capacidades, custos e latências esperadas, para a rota de status"""
+        latencias = {capacidade: self.latencia(capacidade) for capacidade in sorted(self.capacidades)}
+        return {
+            'nome': self.nome,
+            'capacidades': sorted(self.capacidades),
+            'reserva': sorted(self.reserva),
+            'local': self.local,
+            'custo': self.custo,
+            'latencia_esperada': {capacidade: None if math.isinf(latencia) else round(latencia, 3)
+                                  for capacidade, latencia in latencias.items()},
+            'modelos': {capacidade: self.modelos(capacidade) for capacidade in latencias},
+        }
+
+
+class ProvedorChat(Provedor):
+    """Provedor com a capacidade CHAT"""
+
+    @abstractmethod
+    def responder(self, pergunta, credencial=None, historico=None, prazo=None):
+        """
+        Responde uma pergunta
+
+        Retorna:
+        - dict com 'status' (HTTP; 200 se deu certo) e 'texto' (None numa falha)
+
+        Lança:
+        - PrazoEsgotado: se a resposta não ficou pronta dentro do prazo
+        """
+
+    @abstractmethod
+    def responder_stream(self, pergunta, credencial=None, historico=None, prazo=None):
+        """Gerador com os pedaços da resposta; uma falha vem como um único pedaço 'Erro: ...'"""
+
+
+class ProvedorImagem(Provedor):
+    """Provedor com as capacidades TEXTO_IMAGEM e/ou IMAGEM_IMAGEM"""
+
+    @abstractmethod
+    def gerar_imagem(self, payload, diretorio, credencial=None, prazo=None, modelos=None, timeout=20,
+                     cancelado=None, medir=True):
+        """
+        Gera uma imagem (capacidades TEXTO_IMAGEM e IMAGEM_IMAGEM)
+
+        Parâmetros:
+        - payload (dict): corpo no formato da Inference API (veja imagens.montar_payload*)
+        - diretorio (str): onde a imagem é gravada, como arquivo temporário
+        - demais parâmetros: como em imagens.gerar_com_corrida
+
+        Retorna:
+        - tupla (modelo, dict do arquivo temporário) como em imagens.gerar_com_corrida,
+          ou None se não conseguiu gerar
+
+        Lança:
+        - PrazoEsgotado: se o prazo acabou sem nenhuma imagem
+        """
+
+
+class ProvedorCohere(ProvedorChat):
+    """
+    Chat pela API da Cohere; a latência esperada é a média móvel das respostas deste processo
+
+    Parâmetros:
+    - url (str): endpoint de chat (padrão: COHERE_API_URL)
+    - modelo (str): modelo de chat
+    """
+
+    nome = 'cohere'
+    capacidades = frozenset({CHAT})
+    # Estimativa para uma pergunta curta no command-r-plus
+    custo = {CHAT: 0.003}
+
+    def __init__(self, url=None, modelo='command-r-plus', reserva=()):
+        super().__init__(reserva)
+        self.url = url or COHERE_API_URL
+        self.modelo = modelo
+        self._latencia_media = None
+        self._lock = threading.Lock()
+
+    def requisicao(self, pergunta, credencial, historico=None):
+        """Headers e corpo de uma chamada à API de chat"""
+        headers = {
+            'Authorization': f'Bearer {credencial}',
+            'Content-Type': 'application/json'
+        }
+        payload = {
+            'message': pergunta,
+            'model': self.modelo,
+            'chat_history': historico or []
+        }
+        return headers, payload
+
+    def _credencial(self, credencial):
+        return os.environ.get('COHERE_API_KEY', '') if credencial is None else credencial
+
+    def _medir(self, segundos):
+        with self._lock:
+            if self._latencia_media is None:
+                self._latencia_media = segundos
+            else:
+                self._latencia_media += PESO_MEDIA * (segundos - self._latencia_media)
+
+    def modelos(self, capacidade):
+        return [self.modelo]
+
+    def latencia(self, capacidade):
+        with self._lock:
+            return MODELOS_LATENCIA_INICIAL if self._latencia_media is None else self._latencia_media
+
+    def responder(self, pergunta, credencial=None, historico=None, prazo=None):
+        headers, payload = self.requisicao(pergunta, self._credencial(credencial), historico)
+        inicio = time.monotonic()
+        response = http_cliente.post(self.url, headers=headers, json=payload, prazo=prazo or Prazo(PRAZO_PERGUNTAR))
+        segundos = time.monotonic() - inicio
+        metricas.observar('atomai_upstream_segundos', segundos, servico='cohere', status=response.status_code)
+        if response.status_code == 200:
+            self._medir(segundos)
+            return {'status': 200, 'texto': response.json().get('text')}
+        logger.error(f'Erro na API Cohere: {response.status_code} - {response.text}')
+        return {'status': response.status_code, 'texto': None, 'erro': response.text}
+
+    def responder_stream(self, pergunta, credencial=None, historico=None, prazo=None):
+        prazo = prazo or Prazo(PRAZO_PERGUNTAR_STREAM)
+        headers, payload = self.requisicao(pergunta, self._credencial(credencial), historico)
+        payload['stream'] = True
+        inicio = time.monotonic()
+        with http_cliente.post(self.url, headers=headers, json=payload, stream=True, prazo=prazo) as response:
+            # Até os headers chegarem; a geração em si vem depois, em pedaços
+            metricas.observar('atomai_etapa_segundos', time.monotonic() - inicio, etapa='espera_cohere')
+            if response.status_code != 200:
+                yield f'Erro: {response.status_code} - {response.text}'
+                return
+            # A API envia um evento JSON por linha
+            for linha in response.iter_lines():
+                prazo.verificar()
+                if not linha:
+                    continue
+                evento = json.loads(linha)
+                if evento.get('event_type') == 'text-generation':
+                    yield evento.get('text', '')
+                elif evento.get('event_type') == 'stream-end':
+                    break
+        metricas.observar('atomai_upstream_segundos', time.monotonic() - inicio, servico='cohere_stream',
+                          status=response.status_code)
+
+
+class ProvedorHuggingFace(ProvedorImagem):
+    """
+    Imagens pela Inference API do Hugging Face, com a corrida entre modelos e a
+    saúde de cada modelo (funçoes/saude_modelos.py) decidindo a ordem
+
+    Parâmetros:
+    - url_base (str): URL base da Inference API (padrão: imagens.HUGGINGFACE_API_URL)
+    """
+
+    nome = 'huggingface'
+    capacidades = frozenset({TEXTO_IMAGEM, IMAGEM_IMAGEM})
+    # Estimativa por imagem de 30 passos na Inference API
+    custo = {TEXTO_IMAGEM: 0.002, IMAGEM_IMAGEM: 0.002}
+    rascunho = True
+
+    def __init__(self, url_base=None, reserva=()):
+        super().__init__(reserva)
+        self.url_base = url_base or imagens.HUGGINGFACE_API_URL
+        self._modelos = {TEXTO_IMAGEM: imagens.MODELOS, IMAGEM_IMAGEM: imagens.MODELOS_EDICAO}
+
+    def url(self, modelo):
+        return self.url_base + modelo
+
+    def headers(self, credencial=None):
+        credencial = os.environ.get('HUGGINGFACE_API_TOKEN', '') if credencial is None else credencial
+        return {"Authorization": f"Bearer {credencial}"}
+
+    def modelos(self, capacidade):
+        return list(self._modelos.get(capacidade, []))
+
+    def latencia(self, capacidade):
+        return saude_modelos.melhor_latencia(self.modelos(capacidade))
+
+    def gerar_imagem(self, payload, diretorio, credencial=None, prazo=None, modelos=None, timeout=20,
+                     cancelado=None, medir=True):
+        capacidade = IMAGEM_IMAGEM if isinstance(payload.get('inputs'), dict) else TEXTO_IMAGEM
+        return imagens.gerar_com_corrida(payload, self.headers(credencial), diretorio,
+                                         modelos or self.modelos(capacidade), timeout=timeout, prazo=prazo,
+                                         cancelado=cancelado, medir=medir, url_base=self.url_base)
+
+
+# Respostas do provedor local; a escolhida depende só da pergunta
+RESPOSTAS_LOCAIS = [
+    'Resposta local para "{pergunta}": o serviço está rodando sem acesso à IA externa.',
+    'Modo local: "{pergunta}" foi recebida, mas esta resposta é só um exemplo fixo.',
+    'Sem conexão com a IA no momento. Pergunta recebida: "{pergunta}".',
+]
+
+
+class ProvedorLocal(ProvedorChat, ProvedorImagem):
+    """
+    Respostas prontas e imagens procedurais, sem rede, determinísticas e rápidas
+
+    As imagens são um degradê com círculos sobrepostos, com cores e posições
+    sorteadas a partir do hash do prompt e dos parâmetros; numa edição, a
+    imagem enviada é misturada ao padrão na proporção do strength.
+
+    Parâmetros:
+    - lado (int): largura e altura das imagens geradas (padrão: PROVEDOR_LOCAL_LADO)
+    """
+
+    nome = 'local'
+    capacidades = frozenset({CHAT, TEXTO_IMAGEM, IMAGEM_IMAGEM})
+    custo = {CHAT: 0.0, TEXTO_IMAGEM: 0.0, IMAGEM_IMAGEM: 0.0}
+    local = True
+    modelo = 'local/procedural'
+
+    def __init__(self, lado=None, reserva=()):
+        super().__init__(reserva)
+        self.lado = PROVEDOR_LOCAL_LADO if lado is None else lado
+
+    def modelos(self, capacidade):
+        return [self.modelo]
+
+    def latencia(self, capacidade):
+        return 0.0
+
+    def responder(self, pergunta, credencial=None, historico=None, prazo=None):
+        indice = int(hashlib.sha256(pergunta.encode('utf-8')).hexdigest(), 16) % len(RESPOSTAS_LOCAIS)
+        return {'status': 200, 'texto': RESPOSTAS_LOCAIS[indice].format(pergunta=pergunta.strip())}
+
+    def responder_stream(self, pergunta, credencial=None, historico=None, prazo=None):
+        palavras = self.responder(pergunta)['texto'].split(' ')
+        # Pedaços de algumas palavras, como numa resposta em streaming de verdade
+        for i in range(0, len(palavras), 4):
+            yield ' '.join(palavras[i:i + 4]) + (' ' if i + 4 < len(palavras) else '')
+
+    def imagem(self, payload):
+        """
+        Bytes (PNG) da imagem para um payload no formato da Inference API
+
+        Retorna:
+        - tupla (conteúdo, largura, altura)
+        """
+        from PIL import Image, ImageDraw
+        entradas = payload['inputs']
+        if isinstance(entradas, dict):
+            prompt, parametros = entradas['prompt'], entradas
+        else:
+            prompt, parametros = entradas, payload.get('parameters', {})
+        entrada = None
+        if isinstance(entradas, dict) and entradas.get('image'):
+            entrada = Image.open(io.BytesIO(base64.b64decode(entradas['image']))).convert('RGB')
+            largura, altura = entrada.size
+        else:
+            largura = altura = int(parametros.get('width') or self.lado)
+        semente = json.dumps([prompt, parametros.get('num_inference_steps'), parametros.get('guidance_scale'),
+                              parametros.get('strength'), largura, altura], sort_keys=True)
+        sorteio = random.Random(hashlib.sha256(semente.encode('utf-8')).digest())
+
+        def cor():
+            return tuple(sorteio.randrange(256) for _ in range(3))
+
+        degrade = Image.linear_gradient('L').rotate(sorteio.uniform(0, 360)).resize((largura, altura))
+        imagem = Image.composite(Image.new('RGB', (largura, altura), cor()),
+                                 Image.new('RGB', (largura, altura), cor()), degrade)
+        desenho = ImageDraw.Draw(imagem)
+        for _ in range(12):
+            x, y = sorteio.randrange(largura), sorteio.randrange(altura)
+            raio = sorteio.randrange(max(2, min(largura, altura) // 12), max(3, min(largura, altura) // 3))
+            desenho.ellipse((x - raio, y - raio, x + raio, y + raio), fill=cor())
+        if entrada is not None:
+            imagem = Image.blend(entrada, imagem, min(1.0, max(0.0, float(parametros.get('strength', 0.8)))))
+        saida = io.BytesIO()
+        # Compressão mínima: o PNG sai maior, mas em poucos milissegundos
+        imagem.save(saida, format='PNG', compress_level=1)
+        return saida.getvalue(), largura, altura
+
+    def gerar_imagem(self, payload, diretorio, credencial=None, prazo=None, modelos=None, timeout=20,
+                     cancelado=None, medir=True):
+        with metricas.etapa('gerar_imagem_local'):
+            conteudo, largura, altura = self.imagem(payload)
+        descritor, caminho = tempfile.mkstemp(prefix='.baixando_', suffix='.tmp', dir=diretorio)
+        with os.fdopen(descritor, 'wb') as f:
+            f.write(conteudo)
+        metricas.contar('atomai_bytes_gravados_total', len(conteudo), origem='local')
+        return self.modelo, {
+            'caminho': caminho,
+            'sha256': hashlib.sha256(conteudo).hexdigest(),
+            'tamanho': len(conteudo),
+            'formato': 'PNG',
+            'extensao': 'png',
+            'largura': largura,
+            'altura': altura,
+        }
+
+
+class RegistroProvedores:
+    """
+    Provedores disponíveis e a ordem em que são tentados em cada capacidade
+
+    Parâmetros:
+    - offline (bool): só os provedores locais são usados
+    """
+
+    def __init__(self, offline=False):
+        self.offline = offline
+        self._provedores = {}
+        self._lock = threading.Lock()
+
+    def registrar(self, provedor):
+        """Acrescenta (ou substitui, pelo nome) um provedor; devolve o próprio provedor"""
+        with self._lock:
+            self._provedores[provedor.nome] = provedor
+        return provedor
+
+    def obter(self, nome):
+        return self._provedores[nome]
+
+    def ordenar(self, capacidade, reserva=None):
+        """
+        Provedores com a capacidade, na ordem em que devem ser tentados
+
+        Os principais vêm primeiro, da menor para a maior latência esperada
+        (empates mantêm a ordem de registro), e depois os de reserva.
+
+        Parâmetros:
+        - reserva (bool): None devolve todos; False só os principais; True só os de reserva
+        """
+        with self._lock:
+            candidatos = [provedor for provedor in self._provedores.values() if self._disponivel(provedor, capacidade)]
+        principais = [provedor for provedor in candidatos if not self.e_reserva(provedor, capacidade)]
+        reservas = [provedor for provedor in candidatos if provedor not in principais]
+        principais.sort(key=lambda provedor: provedor.latencia(capacidade))
+        if reserva is None:
+            return principais + reservas
+        return reservas if reserva else principais
+
+    def _disponivel(self, provedor, capacidade):
+        if capacidade not in provedor.capacidades:
+            return False
+        # Offline só os provedores locais; fora disso, um provedor local só entra como reserva
+        if self.offline:
+            return provedor.local
+        return not provedor.local or capacidade in provedor.reserva
+
+    def e_reserva(self, provedor, capacidade):
+        """True se o provedor só é usado na capacidade depois dos principais (offline, o local é o principal)"""
+        return not self.offline and capacidade in provedor.reserva
+
+    def melhor_latencia(self, capacidade):
+        """Menor latência esperada entre os provedores principais (infinita se nenhum está disponível)"""
+        return min((provedor.latencia(capacidade) for provedor in self.ordenar(capacidade, reserva=False)),
+                   default=math.inf)
+
+    def modelos(self, capacidade):
+        """Modelos dos provedores principais, na ordem de registro (ex.: para buscar no cache de imagens)"""
+        with self._lock:
+            provedores = list(self._provedores.values())
+        return [modelo for provedor in provedores
+                if self._disponivel(provedor, capacidade) and not self.e_reserva(provedor, capacidade)
+                for modelo in provedor.modelos(capacidade)]
+
+    def tabela(self):
+        with self._lock:
+            provedores = list(self._provedores.values())
+        return {'offline': self.offline, 'provedores': [provedor.descrever() for provedor in provedores]}
+
+
+def _contar(provedor, capacidade, resultado):
+    metricas.contar('atomai_provedor_chamadas_total', provedor=provedor.nome, capacidade=capacidade,
+                    resultado=resultado)
+    if resultado == 'sucesso' and provedor.custo.get(capacidade):
+        metricas.contar('atomai_provedor_custo_total', provedor.custo[capacidade], provedor=provedor.nome)
+
+
+def responder(pergunta, credencial=None, historico=None, prazo=None, reserva=None):
+    """
+    Resposta do primeiro provedor de chat que conseguir responder
+
+    Parâmetros:
+    - credencial (str): chave dos provedores externos (padrão: a variável de ambiente de cada um)
+    - reserva (bool): como em RegistroProvedores.ordenar
+
+    Retorna:
+    - dict com 'status', 'texto', 'provedor' (o da última tentativa) e 'reserva'
+      (True se a resposta veio de um provedor de reserva e não deve ir para o cache)
+
+    Lança:
+    - PrazoEsgotado: se o prazo acabou
+    - a exceção do último provedor tentado, se ele falhou com uma
+    """
+    provedores = registro.ordenar(CHAT, reserva)
+    resultado = {'status': 503, 'texto': None, 'provedor': None, 'reserva': False}
+    for i, provedor in enumerate(provedores):
+        try:
+            resultado = dict(provedor.responder(pergunta, credencial, historico, prazo), provedor=provedor.nome,
+                             reserva=registro.e_reserva(provedor, CHAT))
+        except PrazoEsgotado:
+            _contar(provedor, CHAT, 'prazo_esgotado')
+            raise
+        except Exception as erro:
+            _contar(provedor, CHAT, 'erro')
+            if i == len(provedores) - 1:
+                raise
+            logger.warning(f'Provedor {provedor.nome} falhou ({type(erro).__name__}), tentando o próximo')
+            continue
+        if resultado['status'] == 200:
+            _contar(provedor, CHAT, 'sucesso')
+            return resultado
+        _contar(provedor, CHAT, 'erro')
+    return resultado
+
+
+def provedor_chat():
+    """Provedor de chat usado agora (o principal de menor latência), ou None"""
+    provedores = registro.ordenar(CHAT)
+    return provedores[0] if provedores else None
+
+
+def gerar_imagem(payload, diretorio, capacidade=TEXTO_IMAGEM, reserva=None, credencial=None, prazo=None, **opcoes):
+    """
+    Imagem do primeiro provedor da capacidade que conseguir gerá-la
+
+    Parâmetros:
+    - reserva (bool): como em RegistroProvedores.ordenar
+    - credencial (str): token dos provedores externos (padrão: a variável de ambiente de cada um)
+    - opcoes: repassadas a Provedor.gerar_imagem (modelos, timeout, cancelado, medir)
+
+    Retorna:
+    - tupla (provedor, modelo, dict do arquivo temporário), ou None se nenhum conseguiu
+
+    Lança:
+    - PrazoEsgotado: se o prazo acabou sem nenhuma imagem
+    """
+    for provedor in registro.ordenar(capacidade, reserva):
+        try:
+            resultado = provedor.gerar_imagem(payload, diretorio, credencial, prazo, **opcoes)
+        except PrazoEsgotado:
+            _contar(provedor, capacidade, 'prazo_esgotado')
+            raise
+        except Exception as erro:
+            logger.error(f'Erro no provedor {provedor.nome}: {str(erro)}')
+            resultado = None
+        if resultado:
+            _contar(provedor, capacidade, 'sucesso')
+            return (provedor,) + tuple(resultado)
+        _contar(provedor, capacidade, 'erro')
+    return None
+
+
+# Registro compartilhado pelo app, pelo gerador em linha de comando e por funçoes/ia.py
+registro = RegistroProvedores(offline=PROVEDORES_OFFLINE)
+cohere = registro.registrar(ProvedorCohere())
+huggingface = registro.registrar(ProvedorHuggingFace())
+local = registro.registrar(ProvedorLocal(reserva=PROVEDOR_LOCAL_RESERVA))
@@ -0,0 +1,289 @@
+"""
+Saúde dos modelos do Hugging Face e escolha do melhor modelo para cada pedido
+
+Cada tentativa de geração registra aqui a latência e o resultado (sucesso,
+erro ou modelo "loading"). Com isso cada modelo tem:
+- um histograma de latências das gerações bem-sucedidas e uma média móvel
+- a taxa de sucesso nas últimas MODELOS_JANELA tentativas
+- o estado de carregamento (cold start), com a previsão de quando termina
+- um circuit breaker: depois de MODELOS_FALHAS_PARA_ABRIR falhas seguidas o
+  modelo deixa de receber pedidos por MODELOS_TEMPO_ABERTO segundos (o tempo
+  dobra a cada nova abertura, até MODELOS_TEMPO_ABERTO_MAXIMO); passado esse
+  tempo, um único pedido de teste é liberado (meio aberto) e o resultado dele
+  fecha o circuito ou o abre de novo. Um "loading" (cold start) não é falha:
+  só adia o modelo até a previsão de carregamento, sem contar para o circuito
+
+Os pedidos vão primeiro para o modelo com a menor latência esperada, que é
+a latência média dividida pela chance de sucesso, mais o tempo que falta
+para o modelo terminar de carregar.
+
+O estado é mantido em memória, em cada processo.
+
+Configuração (variáveis de ambiente):
+- MODELOS_JANELA: tentativas consideradas na taxa de sucesso (padrão: 50)
+- MODELOS_FALHAS_PARA_ABRIR: falhas seguidas que abrem o circuito (padrão: 3)
+- MODELOS_TEMPO_ABERTO: segundos com o circuito aberto na primeira vez (padrão: 30)
+- MODELOS_TEMPO_ABERTO_MAXIMO: limite do tempo com o circuito aberto (padrão: 600)
+- MODELOS_LATENCIA_INICIAL: latência suposta de um modelo ainda sem medidas, em segundos (padrão: 10)
+"""
+
+import math
+import os
+import threading
+import time
+from collections import deque
+
+MODELOS_JANELA = int(os.environ.get('MODELOS_JANELA', 50))
+MODELOS_FALHAS_PARA_ABRIR = int(os.environ.get('MODELOS_FALHAS_PARA_ABRIR', 3))
+MODELOS_TEMPO_ABERTO = float(os.environ.get('MODELOS_TEMPO_ABERTO', 30))
+MODELOS_TEMPO_ABERTO_MAXIMO = float(os.environ.get('MODELOS_TEMPO_ABERTO_MAXIMO', 600))
+MODELOS_LATENCIA_INICIAL = float(os.environ.get('MODELOS_LATENCIA_INICIAL', 10))
+
+# Limites superiores (em segundos) das faixas do histograma de latência
+FAIXAS_LATENCIA = (0.5, 1, 2, 4, 8, 16, 32, 64, math.inf)
+
+# Peso da última medida na média móvel de latência
+PESO_MEDIA = 0.2
+
+# Estados do circuit breaker
+FECHADO = 'fechado'
+ABERTO = 'aberto'
+MEIO_ABERTO = 'meio_aberto'
+
+
+def _segundos(valor):
+    """Valor para o JSON: None quando não há medida ou o valor é infinito"""
+    return None if valor is None or math.isinf(valor) else round(valor, 3)
+
+
+class _Modelo:
+    def __init__(self):
+        self.histograma = [0] * len(FAIXAS_LATENCIA)
+        self.latencia_media = None
+        self.resultados = deque(maxlen=MODELOS_JANELA)
+        self.sucessos = 0
+        self.falhas = 0
+        self.carregamentos = 0
+        self.carregando_ate = 0.0
+        self.ultimo_pronto = 0.0
+        self.circuito = FECHADO
+        self.falhas_seguidas = 0
+        self.aberturas = 0
+        self.aberto_ate = 0.0
+        self.teste_em_andamento = False
+        self.ultimo_erro = None
+        self.atualizado = None
+
+    def taxa_sucesso(self):
+        # Suavizada para que poucas tentativas não levem a 0% ou 100%
+        return (sum(self.resultados) + 1) / (len(self.resultados) + 2)
+
+    def percentil(self, fracao):
+        """Estimativa do percentil pelo limite superior da faixa do histograma"""
+        total = sum(self.histograma)
+        if not total:
+            return None
+        acumulado = 0
+        for limite, quantidade in zip(FAIXAS_LATENCIA, self.histograma):
+            acumulado += quantidade
+            if acumulado >= fracao * total:
+                return limite
+        return FAIXAS_LATENCIA[-1]
+
+
+class SaudeModelos:
+    """
+    Registro da saúde dos modelos e roteamento dos pedidos
+
+    Uso típico:
+        for modelo in saude.ordenar(modelos):
+            if not saude.permitir(modelo):
+                continue
+            inicio = time.monotonic()
+            ... tenta gerar ...
+            saude.registrar_sucesso(modelo, time.monotonic() - inicio)  # ou registrar_falha
+    """
+
+    def __init__(self):
+        self._modelos = {}
+        self._lock = threading.Lock()
+
+    def _estado(self, modelo):
+        if modelo not in self._modelos:
+            self._modelos[modelo] = _Modelo()
+        return self._modelos[modelo]
+
+    def _latencia_esperada(self, estado, agora):
+        if estado.circuito == ABERTO and agora < estado.aberto_ate:
+            return math.inf
+        if estado.circuito == MEIO_ABERTO and estado.teste_em_andamento:
+            return math.inf
+        latencia = estado.latencia_media if estado.latencia_media is not None else MODELOS_LATENCIA_INICIAL
+        return latencia / estado.taxa_sucesso() + max(0.0, estado.carregando_ate - agora)
+
+    def ordenar(self, modelos):
+        """
+        Ordena os modelos pela latência esperada, do melhor para o pior
+
+        Modelos com o circuito aberto ficam no fim; empates mantêm a ordem recebida.
+        """
+        agora = time.time()
+        with self._lock:
+            esperadas = {modelo: self._latencia_esperada(self._estado(modelo), agora) for modelo in modelos}
+        return sorted(modelos, key=lambda modelo: esperadas[modelo])
+
+    def melhor_latencia(self, modelos):
+        """Menor latência esperada entre os modelos, em segundos (infinita se todos têm o circuito aberto)"""
+        agora = time.time()
+        with self._lock:
+            return min((self._latencia_esperada(self._estado(modelo), agora) for modelo in modelos), default=math.inf)
+
+    def permitir(self, modelo):
+        """
+        Diz se um pedido pode ir para o modelo agora
+
+        Com o circuito aberto e o prazo vencido, libera um único pedido de teste.
+        """
+        agora = time.time()
+        with self._lock:
+            estado = self._estado(modelo)
+            if estado.circuito == FECHADO:
+                return True
+            if estado.circuito == ABERTO and agora >= estado.aberto_ate:
+                estado.circuito = MEIO_ABERTO
+                estado.teste_em_andamento = False
+            if estado.circuito == MEIO_ABERTO and not estado.teste_em_andamento:
+                estado.teste_em_andamento = True
+                return True
+            return False
+
+    def registrar_sucesso(self, modelo, latencia):
+        with self._lock:
+            estado = self._estado(modelo)
+            for i, limite in enumerate(FAIXAS_LATENCIA):
+                if latencia <= limite:
+                    estado.histograma[i] += 1
+                    break
+            if estado.latencia_media is None:
+                estado.latencia_media = latencia
+            else:
+                estado.latencia_media += PESO_MEDIA * (latencia - estado.latencia_media)
+            estado.resultados.append(1)
+            estado.sucessos += 1
+            estado.carregando_ate = 0.0
+            estado.ultimo_pronto = time.time()
+            estado.falhas_seguidas = 0
+            estado.aberturas = 0
+            estado.circuito = FECHADO
+            estado.teste_em_andamento = False
+            estado.atualizado = time.time()
+
+    def registrar_falha(self, modelo, erro=None):
+        """
+        Registra uma tentativa que falhou
+
+        Parâmetros:
+        - erro (str): descrição curta do erro (mostrada na tabela de saúde)
+        """
+        agora = time.time()
+        with self._lock:
+            estado = self._estado(modelo)
+            estado.resultados.append(0)
+            estado.falhas += 1
+            estado.ultimo_erro = erro
+            estado.atualizado = agora
+            estado.falhas_seguidas += 1
+            estado.teste_em_andamento = False
+            if estado.circuito == MEIO_ABERTO or estado.falhas_seguidas >= MODELOS_FALHAS_PARA_ABRIR:
+                tempo = min(MODELOS_TEMPO_ABERTO * 2 ** estado.aberturas, MODELOS_TEMPO_ABERTO_MAXIMO)
+                estado.circuito = ABERTO
+                estado.aberturas += 1
+                estado.aberto_ate = agora + tempo
+
+    def registrar_carregando(self, modelo, tempo_estimado=None):
+        """
+        Registra uma tentativa respondida com "loading" (503 do cold start)
+
+        Não conta como falha nem abre o circuito: o modelo só fica atrás dos outros
+        até a previsão de carregamento. Um pedido de teste do circuito meio aberto
+        é devolvido, já que a tentativa não mostrou se o modelo se recuperou.
+
+        Parâmetros:
+        - tempo_estimado (float): segundos que o Hugging Face estima para o carregamento
+        """
+        agora = time.time()
+        with self._lock:
+            estado = self._estado(modelo)
+            estado.carregamentos += 1
+            estado.carregando_ate = agora + (tempo_estimado or MODELOS_LATENCIA_INICIAL)
+            estado.ultimo_erro = 'loading'
+            estado.teste_em_andamento = False
+            estado.atualizado = agora
+
+    def marcar_carregando(self, modelo, tempo_estimado=None):
+        """Anota que o modelo está carregando, sem contar como falha (ex.: resposta a um aquecimento)"""
+        with self._lock:
+            estado = self._estado(modelo)
+            estado.carregando_ate = time.time() + (tempo_estimado or MODELOS_LATENCIA_INICIAL)
+
+    def marcar_pronto(self, modelo):
+        """Anota que o modelo respondeu e está carregado, sem registrar latência"""
+        with self._lock:
+            estado = self._estado(modelo)
+            estado.carregando_ate = 0.0
+            estado.ultimo_pronto = time.time()
+
+    def situacao(self, modelo):
+        """
+        Retorna:
+        - tupla (até quando o modelo deve ficar carregando, última vez em que ele
+          respondeu carregado), como timestamps; 0 quando não se sabe
+        """
+        with self._lock:
+            estado = self._estado(modelo)
+            return estado.carregando_ate, estado.ultimo_pronto
+
+    def liberar(self, modelo):
+        """Devolve o pedido de teste de um circuito meio aberto quando a tentativa não chegou a ter resultado"""
+        with self._lock:
+            estado = self._estado(modelo)
+            estado.teste_em_andamento = False
+
+    def tabela(self):
+        """Estado atual de cada modelo, do melhor para o pior"""
+        agora = time.time()
+        with self._lock:
+            linhas = []
+            for modelo, estado in self._modelos.items():
+                esperada = self._latencia_esperada(estado, agora)
+                circuito = estado.circuito
+                if circuito == ABERTO and agora >= estado.aberto_ate:
+                    circuito = MEIO_ABERTO
+                linhas.append({
+                    'modelo': modelo,
+                    'circuito': circuito,
+                    'aberto_por': round(max(0.0, estado.aberto_ate - agora), 1) if circuito == ABERTO else 0,
+                    'carregando': estado.carregando_ate > agora,
+                    'carregando_por': round(max(0.0, estado.carregando_ate - agora), 1),
+                    'ultimo_pronto': estado.ultimo_pronto or None,
+                    'latencia_esperada': _segundos(esperada),
+                    'latencia_media': _segundos(estado.latencia_media),
+                    'latencia_p50': _segundos(estado.percentil(0.5)),
+                    'latencia_p95': _segundos(estado.percentil(0.95)),
+                    # Pares [limite superior da faixa em segundos, quantidade]
+                    'histograma': [['+Inf' if math.isinf(limite) else limite, quantidade]
+                                   for limite, quantidade in zip(FAIXAS_LATENCIA, estado.histograma)],
+                    'taxa_sucesso': round(sum(estado.resultados) / len(estado.resultados), 4) if estado.resultados else None,
+                    'sucessos': estado.sucessos,
+                    'falhas': estado.falhas,
+                    'carregamentos': estado.carregamentos,
+                    'falhas_seguidas': estado.falhas_seguidas,
+                    'ultimo_erro': estado.ultimo_erro,
+                    'atualizado': estado.atualizado,
+                })
+        linhas.sort(key=lambda linha: math.inf if linha['latencia_esperada'] is None else linha['latencia_esperada'])
+        return linhas
+
+
+# Instância compartilhada pelo app e pelo gerador em linha de comando
+saude_modelos = SaudeModelos()
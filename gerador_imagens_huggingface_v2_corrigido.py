@@ -8,68 +8,74 @@ Este script permite gerar imagens de duas formas diferentes:
 1. Text-to-Image: Gerar imagens a partir de descrições textuais
 2. Image-to-Image: Modificar imagens existentes com base em prompts
 
+A geração em si fica em funçoes/gerador.py, que pode ser importado sem
+efeitos colaterais (por exemplo pelo app.py ou por jobs em lote). Este
+arquivo acrescenta a exibição com o matplotlib e o menu interativo; importá-lo
+também não imprime nada nem cria diretórios, e o matplotlib só é carregado
+quando uma imagem é exibida.
+
 Autor: GitHub Copilot
 Data: Maio de 2025
 """
 
 # Importação das bibliotecas
-import requests
-import json
+import logging
 import os
-import io
-import base64
-from datetime import datetime
-from PIL import Image
-import matplotlib.pyplot as plt
 import warnings
 
-# Suprimir os avisos para deixar a execução mais limpa
-warnings.filterwarnings('ignore')
-
-# Configurar o matplotlib para exibir imagens maiores
-plt.rcParams['figure.figsize'] = (12, 12)
-plt.rcParams['figure.dpi'] = 100
+from funçoes import gerador
+from funçoes.gerador import MODELOS, OUTPUT_DIR
 
-print("Todas as bibliotecas foram importadas com sucesso!")
-
-# Configuração do Token da Hugging Face
+# Token da Hugging Face (relido do .env ao executar o script)
 # O token deve começar com "hf_" - substitua pelo seu token real
 # Para obter um token, acesse: https://huggingface.co/settings/tokens
-import os
-from dotenv import load_dotenv
-# Carregar variáveis de ambiente
-load_dotenv()
-API_TOKEN = os.environ.get('HUGGINGFACE_API_TOKEN', '')  # Obter token da variável de ambiente
-
-# Criando uma pasta para salvar as imagens geradas
-OUTPUT_DIR = "imagens_geradas"
-os.makedirs(OUTPUT_DIR, exist_ok=True)
-print(f"Pasta {OUTPUT_DIR} criada/verificada com sucesso!")
-
-# Verificação simples do token
-if not API_TOKEN.startswith("hf_"):
-    print("⚠️ ATENÇÃO: O token da Hugging Face parece incorreto. Deve começar com 'hf_'.")
-else:
-    print("✅ Token configurado. Pronto para usar a API!")
-
-# Configuração dos modelos - você pode alternar entre diferentes modelos disponíveis
-MODELOS = {
-    "text2image": [
-        "runwayml/stable-diffusion-v1-5",      # Modelo popular e bem estabelecido
-        "stabilityai/stable-diffusion-xl-base-1.0",  # SDXL Base
-        "prompthero/openjourney"               # Estilo Midjourney
-    ],
-    "image2image": [
-        "runwayml/stable-diffusion-v1-5",      # Também funciona bem para image-to-image
-        "timbrooks/instruct-pix2pix",          # Bom para edição de imagens com instruções
-    ]
-}
+API_TOKEN = os.environ.get('HUGGINGFACE_API_TOKEN', '')
 
 # Modelo padrão para text-to-image
 MODELO_PADRAO_TEXT2IMAGE = MODELOS["text2image"][0]
 # Modelo padrão para image-to-image
 MODELO_PADRAO_IMAGE2IMAGE = MODELOS["image2image"][0]
 
+_plt = None
+
+def _pyplot():
+    """Carrega e configura o matplotlib só quando uma imagem vai ser exibida"""
+    global _plt
+    if _plt is None:
+        import matplotlib.pyplot as plt
+        # Configurar o matplotlib para exibir imagens maiores
+        plt.rcParams['figure.figsize'] = (12, 12)
+        plt.rcParams['figure.dpi'] = 100
+        _plt = plt
+    return _plt
+
+def preparar():
+    """
+    Prepara a execução como script: carrega o .env, suprime avisos, cria a
+    pasta de saída e mostra o estado do token
+    """
+    global API_TOKEN
+    from dotenv import load_dotenv
+    
+    # Suprimir os avisos para deixar a execução mais limpa
+    warnings.filterwarnings('ignore')
+    # As mensagens de andamento da geração são exibidas como texto simples
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    
+    # Carregar variáveis de ambiente
+    load_dotenv()
+    API_TOKEN = os.environ.get('HUGGINGFACE_API_TOKEN', '')
+    
+    # Criando uma pasta para salvar as imagens geradas
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    print(f"Pasta {OUTPUT_DIR} criada/verificada com sucesso!")
+    
+    # Verificação simples do token
+    if not API_TOKEN.startswith("hf_"):
+        print("⚠️ ATENÇÃO: O token da Hugging Face parece incorreto. Deve começar com 'hf_'.")
+    else:
+        print("✅ Token configurado. Pronto para usar a API!")
+
 def verificar_token_e_conexao():
     """
     Verifica se o token da Hugging Face está configurado e se é possível conectar à API
@@ -79,6 +85,14 @@ def verificar_token_e_conexao():
     """
     global MODELO_PADRAO_TEXT2IMAGE, MODELO_PADRAO_IMAGE2IMAGE
     
+    import requests
+    from funçoes import http_cliente, provedores
+    
+    # Sem rede: as imagens vêm do provedor local
+    if provedores.registro.offline:
+        print("✅ Modo offline (PROVEDORES_OFFLINE=1): usando o provedor local, sem a API da Hugging Face.")
+        return True
+    
     # Verificar formato básico do token
     if not API_TOKEN.startswith("hf_"):
         print("❌ Erro: O token da Hugging Face está em formato incorreto.")
@@ -90,13 +104,13 @@ def verificar_token_e_conexao():
         print("Verificando conexão com a API da Hugging Face...")
         
         # URL do modelo de teste
-        api_url = f"https://api-inference.huggingface.co/models/{MODELO_PADRAO_TEXT2IMAGE}"
+        api_url = provedores.huggingface.url(MODELO_PADRAO_TEXT2IMAGE)
         
         # Headers com o token
-        headers = {"Authorization": f"Bearer {API_TOKEN}"}
+        headers = provedores.huggingface.headers(API_TOKEN)
         
         # Fazer uma requisição GET simples
-        response = requests.get(api_url, headers=headers)
+        response = http_cliente.get(api_url, headers=headers)
         
         # Verificar o código de status
         if response.status_code == 401 or response.status_code == 403:
@@ -112,8 +126,8 @@ def verificar_token_e_conexao():
             print("   Tentando com modelos alternativos...")
             
             # Tentar com o segundo modelo da lista
-            alt_api_url = f"https://api-inference.huggingface.co/models/{MODELOS['text2image'][1]}"
-            alt_response = requests.get(alt_api_url, headers=headers)
+            alt_api_url = provedores.huggingface.url(MODELOS['text2image'][1])
+            alt_response = http_cliente.get(alt_api_url, headers=headers)
             
             if alt_response.status_code == 200:
                 print(f"✅ Conexão com o modelo alternativo {MODELOS['text2image'][1]} estabelecida!")
@@ -136,7 +150,7 @@ def verificar_token_e_conexao():
         print(f"❌ Erro inesperado: {str(e)}")
         return True  # Retornamos True mesmo com erro para permitir tentar usar a API
 
-def gerar_por_texto(prompt, num_inference_steps=30, guidance_scale=7.5, save=True, modelo=None):
+def gerar_por_texto(prompt, num_inference_steps=30, guidance_scale=7.5, save=True, modelo=None, exibir=True):
     """
     Gera uma imagem a partir de um prompt de texto usando o modelo Stable Diffusion
     
@@ -145,97 +159,29 @@ def gerar_por_texto(prompt, num_inference_steps=30, guidance_scale=7.5, save=Tru
     - num_inference_steps (int): Número de etapas de inferência (mais etapas = mais detalhes, mas mais lento)
     - guidance_scale (float): Quão fielmente o modelo deve seguir o prompt (valores maiores = mais fidelidade)
     - save (bool): Se True, salva a imagem gerada no disco
-    - modelo (str): Modelo específico a ser usado, se None usa o modelo padrão
+    - modelo (str): Modelo específico a ser usado, se None escolhe pela saúde dos modelos
+    - exibir (bool): Se True, mostra a imagem com o matplotlib
     
     Retorna:
     - Objeto de imagem PIL
     """
-    # Adicionar melhores práticas para prompts
-    prompt_melhorado = prompt
-    if not prompt.lower().startswith(("a photo of", "an image of")):
-        # Melhorar um pouco o prompt para obter melhores resultados
-        prompt_melhorado = f"A detailed high quality image of {prompt}, 4k resolution, detailed"
-    try:
-        # Usar o modelo especificado ou o padrão
-        modelo_atual = modelo if modelo else MODELO_PADRAO_TEXT2IMAGE
-        
-        # 1. Configurar a URL do modelo e headers para autenticação
-        api_url = f"https://api-inference.huggingface.co/models/{modelo_atual}"
-        headers = {"Authorization": f"Bearer {API_TOKEN}"}
-          # 2. Preparar o payload da requisição com os parâmetros
-        payload = {
-            "inputs": prompt_melhorado,
-            "parameters": {
-                "num_inference_steps": num_inference_steps,
-                "guidance_scale": guidance_scale,
-                "negative_prompt": "blurry, bad anatomy, bad hands, cropped, worst quality, low quality, text, watermark"
-            }
-        }
-          # 3. Fazer a requisição POST para a API
-        print(f"Gerando imagem para o prompt: '{prompt}'...")
-        if prompt_melhorado != prompt:
-            print(f"Prompt melhorado: '{prompt_melhorado}'")
-        print(f"Usando modelo: {modelo_atual}")
-        print(f"Passos de inferência: {num_inference_steps} | Guidance scale: {guidance_scale}")
-        print("Isso pode levar alguns minutos. Por favor, aguarde...")
-        
-        response = requests.post(api_url, headers=headers, json=payload)
-          # 4. Verificar se a requisição foi bem-sucedida
-        if response.status_code != 200:
-            print(f"Erro na requisição: {response.status_code}")
-            print(f"Mensagem: {response.text}")
-            
-            # Verificar se o erro é devido ao modelo estar carregando
-            if "loading" in response.text.lower() or "still loading" in response.text.lower():
-                print("O modelo está sendo carregado pela primeira vez. Tentando novamente em 10 segundos...")
-                import time
-                time.sleep(10)  # Esperar 10 segundos antes de tentar novamente
-                # Tentar a mesma requisição novamente
-                print("Tentando novamente...")
-                response = requests.post(api_url, headers=headers, json=payload)
-                # Verificar se a segunda tentativa foi bem-sucedida
-                if response.status_code == 200:
-                    print("Segunda tentativa bem-sucedida!")
-                else:
-                    print(f"Segunda tentativa falhou: {response.status_code}")
-                    print(f"Mensagem: {response.text}")
-            
-            # Se o modelo atual falhar e não for o último da lista, tente o próximo
-            if modelo_atual != MODELOS["text2image"][-1]:
-                proximo_indice = MODELOS["text2image"].index(modelo_atual) + 1
-                if proximo_indice < len(MODELOS["text2image"]):
-                    proximo_modelo = MODELOS["text2image"][proximo_indice]
-                    print(f"Tentando com modelo alternativo: {proximo_modelo}")
-                    return gerar_por_texto(prompt, num_inference_steps, guidance_scale, save, proximo_modelo)
-            return None
-            
-        # 5. Transformar a resposta em uma imagem
-        image = Image.open(io.BytesIO(response.content))
-        
-        # 6. Salvar a imagem se solicitado
-        if save:
-            # Criar um nome de arquivo baseado no prompt e timestamp
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            # Limitar o tamanho do nome do arquivo e remover caracteres especiais
-            prompt_slug = "".join(c for c in prompt if c.isalnum() or c in " ")[:30].strip().replace(" ", "_")
-            filename = f"{OUTPUT_DIR}/text_{prompt_slug}_{timestamp}.png"
-            image.save(filename)
-            print(f"Imagem salva como: {filename}")
-        
-        # 7. Exibir a imagem
+    resultado = gerador.gerar_texto(prompt, num_inference_steps, guidance_scale, save,
+                                    modelo, API_TOKEN, OUTPUT_DIR)
+    if resultado is None:
+        return None
+    
+    # Exibir a imagem
+    if exibir:
+        plt = _pyplot()
         plt.figure(figsize=(10, 10))
-        plt.imshow(image)
+        plt.imshow(resultado['imagem'])
         plt.axis('off')  # Remove os eixos
-        plt.title(f"Prompt: {prompt}\nModelo: {modelo_atual}")
+        plt.title(f"Prompt: {prompt}\nModelo: {resultado['modelo']}")
         plt.show()
-        
-        return image
     
-    except Exception as e:
-        print(f"Ocorreu um erro: {str(e)}")
-        return None
+    return resultado['imagem']
 
-def gerar_por_imagem(prompt, caminho_imagem, strength=0.8, num_inference_steps=30, guidance_scale=7.5, save=True, modelo=None):
+def gerar_por_imagem(prompt, caminho_imagem, strength=0.8, num_inference_steps=30, guidance_scale=7.5, save=True, modelo=None, exibir=True):
     """
     Modifica uma imagem existente com base em um prompt usando o modelo Stable Diffusion
     
@@ -246,108 +192,35 @@ def gerar_por_imagem(prompt, caminho_imagem, strength=0.8, num_inference_steps=3
     - num_inference_steps (int): Número de etapas de inferência
     - guidance_scale (float): Quão fielmente seguir o prompt
     - save (bool): Se True, salva a imagem gerada no disco
-    - modelo (str): Modelo específico a ser usado, se None usa o modelo padrão
+    - modelo (str): Modelo específico a ser usado, se None escolhe pela saúde dos modelos
+    - exibir (bool): Se True, mostra a original e a modificada com o matplotlib
     
     Retorna:
     - Objeto de imagem PIL
     """
-    try:
-        # Usar o modelo especificado ou o padrão
-        modelo_atual = modelo if modelo else MODELO_PADRAO_IMAGE2IMAGE
-        
-        # 1. Verificar se o arquivo existe
-        if not os.path.exists(caminho_imagem):
-            print(f"Erro: O arquivo '{caminho_imagem}' não existe.")
-            return None
-        
-        # 2. Abrir e redimensionar a imagem (o modelo geralmente espera tamanhos específicos)
-        image = Image.open(caminho_imagem)
-        # Redimensionar para um tamanho adequado para o modelo (múltiplo de 8)
-        width, height = image.size
-        # Ajustar para dimensões que sejam múltiplos de 8
-        new_width = (width // 8) * 8
-        new_height = (height // 8) * 8
-        if new_width != width or new_height != height:
-            image = image.resize((new_width, new_height))
-            print(f"Imagem redimensionada de {width}x{height} para {new_width}x{new_height}")
-        
-        # 3. Converter a imagem para formato base64
-        buffered = io.BytesIO()
-        image.save(buffered, format="PNG")
-        img_str = base64.b64encode(buffered.getvalue()).decode('utf-8')
-        
-        # 4. Configurar URL e headers
-        api_url = f"https://api-inference.huggingface.co/models/{modelo_atual}"
-        headers = {"Authorization": f"Bearer {API_TOKEN}"}
-        
-        # 5. Preparar o payload da requisição
-        payload = {
-            "inputs": {
-                "prompt": prompt,
-                "image": img_str,
-                "strength": strength,
-                "num_inference_steps": num_inference_steps,
-                "guidance_scale": guidance_scale
-            }
-        }
-        
-        # 6. Enviar a requisição
-        print(f"Modificando imagem com o prompt: '{prompt}'...")
-        print(f"Usando modelo: {modelo_atual}")
-        print(f"Intensidade da transformação: {strength * 100}%")
-        print(f"Passos de inferência: {num_inference_steps} | Guidance scale: {guidance_scale}")
-        print("Isso pode levar alguns minutos. Por favor, aguarde...")
-        
-        response = requests.post(api_url, headers=headers, json=payload)
-        
-        # 7. Verificar resposta
-        if response.status_code != 200:
-            print(f"Erro na requisição: {response.status_code}")
-            print(f"Mensagem: {response.text}")
-            
-            # Se o modelo atual falhar e não for o último da lista, tente o próximo
-            if modelo_atual != MODELOS["image2image"][-1]:
-                proximo_indice = MODELOS["image2image"].index(modelo_atual) + 1
-                if proximo_indice < len(MODELOS["image2image"]):
-                    proximo_modelo = MODELOS["image2image"][proximo_indice]
-                    print(f"Tentando com modelo alternativo: {proximo_modelo}")
-                    return gerar_por_imagem(prompt, caminho_imagem, strength, num_inference_steps, 
-                                           guidance_scale, save, proximo_modelo)
-            return None
-            
-        # 8. Transformar a resposta em uma imagem
-        result_image = Image.open(io.BytesIO(response.content))
-        
-        # 9. Salvar a imagem se solicitado
-        if save:
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            # Criar um nome de arquivo baseado no prompt e nome do arquivo original
-            base_filename = os.path.basename(caminho_imagem).split(".")[0]
-            prompt_slug = "".join(c for c in prompt if c.isalnum() or c in " ")[:20].strip().replace(" ", "_")
-            filename = f"{OUTPUT_DIR}/img2img_{base_filename}_{prompt_slug}_{timestamp}.png"
-            result_image.save(filename)
-            print(f"Imagem salva como: {filename}")
-        
-        # 10. Exibir a imagem original e a modificada lado a lado
+    resultado = gerador.gerar_imagem(prompt, caminho_imagem, strength, num_inference_steps, guidance_scale, save,
+                                     modelo, API_TOKEN, OUTPUT_DIR)
+    if resultado is None:
+        return None
+    
+    # Exibir a imagem original e a modificada lado a lado
+    if exibir:
+        plt = _pyplot()
         plt.figure(figsize=(20, 10))
         plt.subplot(1, 2, 1)
-        plt.imshow(image)
+        plt.imshow(resultado['original'])
         plt.title("Imagem Original")
         plt.axis('off')
         
         plt.subplot(1, 2, 2)
-        plt.imshow(result_image)
-        plt.title(f"Imagem Modificada\nPrompt: {prompt}\nModelo: {modelo_atual}")
+        plt.imshow(resultado['imagem'])
+        plt.title(f"Imagem Modificada\nPrompt: {prompt}\nModelo: {resultado['modelo']}")
         plt.axis('off')
         
         plt.tight_layout()
         plt.show()
-        
-        return result_image
     
-    except Exception as e:
-        print(f"Ocorreu um erro: {str(e)}")
-        return None
+    return resultado['imagem']
 
 def menu_modo_linha_comando():
     """
@@ -484,11 +357,30 @@ def menu_modo_linha_comando():
         else:
             print("Opção inválida! Por favor, escolha uma opção entre 1 e 5.")
 
+def executar_lote(caminho_lote, manifesto=None, workers=4, taxa_por_modelo=None):
+    """
+    Gera as imagens de um arquivo de lote sem exibi-las (veja gerador.executar_lote)
+    """
+    return gerador.executar_lote(caminho_lote, manifesto, workers, taxa_por_modelo, API_TOKEN, OUTPUT_DIR)
+
 # Se o script for executado diretamente (não importado como módulo)
 if __name__ == "__main__":
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="Gerador de Imagens com Hugging Face API")
+    parser.add_argument("--lote", help="arquivo .txt ou .jsonl com prompts para gerar sem interação")
+    parser.add_argument("--manifesto", help="arquivo JSONL de resultados do lote (permite retomar)")
+    parser.add_argument("--workers", type=int, default=4, help="gerações simultâneas no lote (padrão: 4)")
+    parser.add_argument("--taxa-por-modelo", type=float, help="requisições por minuto para cada modelo")
+    args = parser.parse_args()
+    
     try:
+        preparar()
         print("\nIniciando Gerador de Imagens com Hugging Face API...")
-        menu_modo_linha_comando()
+        if args.lote:
+            executar_lote(args.lote, args.manifesto, args.workers, args.taxa_por_modelo)
+        else:
+            menu_modo_linha_comando()
     except KeyboardInterrupt:
         print("\n\nPrograma interrompido pelo usuário. Encerrando...")
     except Exception as e:
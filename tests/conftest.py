@@ -0,0 +1,53 @@
+"""
+Fixtures compartilhadas: o servidor falso das APIs (benchmarks/servidor_falso.py)
+numa porta livre e o app apontando para ele, com dados e imagens em diretórios
+temporários
+"""
+
+import os
+import sys
+import threading
+
+import pytest
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+sys.path.insert(0, os.path.join(RAIZ, 'benchmarks'))
+
+import servidor_falso  # noqa: E402
+
+
+def iniciar_servidor_falso(**opcoes):
+    """Inicia o servidor falso numa thread; retorna (servidor, URL base)"""
+    servidor = servidor_falso.criar_servidor(**opcoes)
+    threading.Thread(target=servidor.serve_forever, name='servidor-falso', daemon=True).start()
+    return servidor, f'http://127.0.0.1:{servidor.server_port}'
+
+
+@pytest.fixture(scope='session')
+def url_falso():
+    servidor, url = iniciar_servidor_falso(carregamento=0, latencia=0.05, latencia_cohere=0.01,
+                                           tamanho_imagem=64)
+    yield url
+    servidor.shutdown()
+
+
+@pytest.fixture(scope='session')
+def app_atomai(url_falso, tmp_path_factory):
+    """O módulo app, importado uma vez por sessão com as APIs apontando para o servidor falso"""
+    base = tmp_path_factory.mktemp('atomai')
+    os.environ.update({
+        'DADOS_DIR': str(base / 'dados'),
+        'IMAGENS_DIR': str(base / 'imagens'),
+        'HUGGINGFACE_API_URL': f'{url_falso}/models/',
+        'COHERE_API_URL': f'{url_falso}/v1/chat',
+        'AQUECIMENTO_ATIVO': '0',
+        'ADMISSAO_ATIVA': '0',
+    })
+    import app
+    return app
+
+
+@pytest.fixture
+def cliente(app_atomai):
+    return app_atomai.app.test_client()
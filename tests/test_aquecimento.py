@@ -0,0 +1,42 @@
+"""
+Previsão de tráfego do aquecedor de modelos (funçoes/aquecimento.py)
+"""
+
+import time
+
+import pytest
+
+
+@pytest.fixture
+def aquecimento(app_atomai):
+    # Importado depois do app: funçoes/imagens.py lê a URL da Inference API do ambiente
+    from funçoes import aquecimento
+    return aquecimento
+
+
+def _local(ano, mes, dia, hora, minuto=0):
+    return time.mktime((ano, mes, dia, hora, minuto, 0, 0, 0, -1))
+
+
+def test_historico_atravessa_a_virada_do_ano(aquecimento):
+    aquecedor = aquecimento.AquecedorModelos([], token='', janela=0)
+    inicio = _local(2025, 12, 25, 0)
+    # Um pedido por hora durante dez dias, passando por 1º de janeiro
+    for hora in range(24 * 10):
+        aquecedor.registrar_pedido(inicio + hora * 3600 + 60)
+    ultimo = int((inicio + (24 * 10 - 1) * 3600 + 60) // 3600)
+
+    # Ficam as horas mais recentes (as de janeiro inclusive), não as de menor dia do ano
+    assert len(aquecedor._trafego) == 24 * aquecimento.DIAS_HISTORICO
+    assert min(aquecedor._trafego) == ultimo - 24 * aquecimento.DIAS_HISTORICO + 1 and max(aquecedor._trafego) == ultimo
+
+
+def test_hora_movimentada_nos_dias_anteriores(aquecimento):
+    aquecedor = aquecimento.AquecedorModelos([], token='', janela=0)
+    for dia in (30, 31):
+        aquecedor.registrar_pedido(_local(2025, 12, dia, 10, 15))
+    aquecedor.registrar_pedido(_local(2026, 1, 1, 10, 15))
+
+    # Antes das 10h do dia 2 o aquecedor já prevê o tráfego; antes das 15h, não
+    assert aquecedor._ha_trafego(_local(2026, 1, 2, 10) - aquecimento.AQUECIMENTO_ANTECEDENCIA)
+    assert not aquecedor._ha_trafego(_local(2026, 1, 2, 15) - aquecimento.AQUECIMENTO_ANTECEDENCIA)
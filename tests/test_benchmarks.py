@@ -0,0 +1,124 @@
+"""
+O harness de carga (benchmarks/carga.py) e as opções do servidor falso
+chegando à saúde dos modelos e à corrida entre modelos (funçoes/imagens.py)
+"""
+
+import json
+import os
+import subprocess
+import sys
+import time
+import uuid
+
+import pytest
+import requests
+
+from conftest import RAIZ, iniciar_servidor_falso
+from funçoes.saude_modelos import saude_modelos, ABERTO
+
+PAYLOAD = {'inputs': 'teste', 'parameters': {'num_inference_steps': 30}}
+
+
+@pytest.fixture
+def imagens(app_atomai):
+    # Importado depois do app: a URL da Inference API é lida do ambiente na importação
+    from funçoes import imagens
+    return imagens
+
+
+@pytest.fixture
+def servidor():
+    """Inicia servidores falsos com as opções dadas; retorna (servidor, URL dos modelos)"""
+    iniciados = []
+
+    def iniciar(**opcoes):
+        falso, url = iniciar_servidor_falso(**{'carregamento': 0, 'tamanho_imagem': 64, **opcoes})
+        iniciados.append(falso)
+        return falso, f'{url}/models/'
+    yield iniciar
+    for falso in iniciados:
+        falso.shutdown()
+
+
+def _modelo(nome):
+    # Nome novo a cada teste: a saúde dos modelos é compartilhada pelo processo
+    return f'teste/{nome}-{uuid.uuid4().hex[:8]}'
+
+
+def _linha(modelo):
+    return next(linha for linha in saude_modelos.tabela() if linha['modelo'] == modelo)
+
+
+def test_carga_grava_resultado(tmp_path):
+    pytest.importorskip('uvicorn')
+    saida = tmp_path / 'resultado.json'
+    cenarios = ['perguntar', 'gerar-imagem']
+    subprocess.run([sys.executable, os.path.join(RAIZ, 'benchmarks', 'carga.py'), '--cenarios', ','.join(cenarios),
+                    '--concorrencia', '2', '--duracao', '1', '--latencia-hf', '0.05', '--latencia-cohere', '0.01',
+                    '--tamanho-imagem', '64', '--saida', str(saida)],
+                   cwd=RAIZ, check=True, timeout=120, capture_output=True)
+
+    resultado = json.loads(saida.read_text(encoding='utf-8'))
+    assert {'commit', 'data', 'python', 'parametros', 'cenarios', 'servidor_falso'} <= set(resultado)
+    assert resultado['parametros']['duracao'] == 1 and resultado['parametros']['servidor'] == 'asgi'
+    assert list(resultado['cenarios']) == cenarios
+    for medidas in resultado['cenarios'].values():
+        assert {'rps', 'latencia_p50', 'latencia_p95', 'latencia_p99', 'erros', 'status',
+                'workers_ocupados_em_media', 'utilizacao_workers'} <= set(medidas)
+        assert medidas['pedidos'] > 0 and medidas['erros'] == 0 and medidas['rps'] > 0
+    assert 'utilizacao_jobs' in resultado['cenarios']['gerar-imagem']
+    # Os pedidos do app passaram pelo servidor falso
+    falso = resultado['servidor_falso']
+    assert falso['pedidos_cohere'] > 0 and sum(m['pedidos'] for m in falso['modelos'].values()) > 0
+
+
+def test_carregamento_chega_na_saude(imagens, servidor, tmp_path):
+    falso, url = servidor(carregamento=30, latencia=0.01)
+    modelo = _modelo('frio')
+    assert imagens.gerar_com_corrida(PAYLOAD, {}, str(tmp_path), modelos=[modelo], url_base=url) is None
+
+    linha = _linha(modelo)
+    # "loading" adia o modelo pela previsão do servidor, sem contar como falha
+    assert linha['carregando'] and 20 < linha['carregando_por'] <= 30
+    assert linha['carregamentos'] == 1 and linha['falhas'] == 0 and linha['circuito'] != ABERTO
+    assert falso.estado.resumo()['modelos'][modelo]['respostas_loading'] == 1
+
+
+def test_taxa_de_erro_abre_o_circuito(imagens, servidor, tmp_path, monkeypatch):
+    monkeypatch.setattr('funçoes.saude_modelos.MODELOS_FALHAS_PARA_ABRIR', 2)
+    falso, url = servidor(latencia=0.01, taxa_erro=1.0)
+    modelo = _modelo('erro')
+    for _ in range(2):
+        assert imagens.gerar_com_corrida(PAYLOAD, {}, str(tmp_path), modelos=[modelo], url_base=url) is None
+
+    linha = _linha(modelo)
+    assert linha['falhas'] == 2 and linha['ultimo_erro'] == 'HTTP 500' and linha['circuito'] == ABERTO
+    # Com o circuito aberto, a corrida nem chama o modelo
+    assert imagens.gerar_com_corrida(PAYLOAD, {}, str(tmp_path), modelos=[modelo], url_base=url) is None
+    assert falso.estado.resumo()['modelos'][modelo]['pedidos'] == 2
+    assert falso.estado.resumo()['erros_simulados'] == 2
+
+
+def test_latencia_dispara_a_corrida(imagens, servidor, tmp_path):
+    falso, url = servidor(latencia=0.5)
+    modelos = [_modelo('lento'), _modelo('reserva')]
+    inicio = time.monotonic()
+    vencedor = imagens.gerar_com_corrida(PAYLOAD, {}, str(tmp_path), modelos=modelos, paralelos=1, atraso=0.1,
+                                         url_base=url)
+    decorrido = time.monotonic() - inicio
+    assert vencedor is not None
+    modelo, arquivo = vencedor
+    os.remove(arquivo['caminho'])
+
+    # O primeiro não respondeu dentro do atraso: o segundo foi disparado em paralelo
+    estado = falso.estado.resumo()['modelos']
+    assert all(estado[m]['pedidos'] == 1 for m in modelos)
+    assert 0.5 <= decorrido < 1.0
+    # A latência medida do vencedor é a do servidor falso
+    assert 0.5 <= _linha(modelo)['latencia_media'] < 1.0
+
+
+def test_estado_do_servidor_falso(servidor):
+    falso, url = servidor()
+    estado = requests.get(url.replace('/models/', '/estado'), timeout=5).json()
+    assert estado == {'modelos': {}, 'pedidos_cohere': 0, 'erros_simulados': 0}
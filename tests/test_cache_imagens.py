@@ -0,0 +1,69 @@
+"""
+Cache de imagens (funçoes/cache_imagens.py) com dois processos no mesmo diretório
+"""
+
+import hashlib
+import os
+import threading
+
+import pytest
+
+from funçoes.cache_imagens import CacheImagens, fcntl
+
+CONTEUDO = b'\x89PNG\r\n\x1a\n imagem de teste'
+
+
+def _guardar(cache, prompt):
+    temporario = os.path.join(cache.diretorio, f'.teste_{prompt}.tmp')
+    with open(temporario, 'wb') as f:
+        f.write(CONTEUDO)
+    return cache.guardar_arquivo(prompt, 'modelo', 30, 7.5, '', temporario, hashlib.sha256(CONTEUDO).hexdigest(),
+                                 len(CONTEUDO))
+
+
+@pytest.mark.skipif(fcntl is None, reason='sem flock entre processos')
+def test_coleta_nao_apaga_arquivo_reaproveitado_por_outro_processo(tmp_path):
+    # Duas instâncias no mesmo diretório fazem o papel de dois workers
+    coletor = CacheImagens(str(tmp_path), intervalo_gc=3600)
+    outro = CacheImagens(str(tmp_path), intervalo_gc=3600)
+    caminho = _guardar(coletor, 'velho')
+    apagar = coletor._apagar_arquivo
+    depois = []
+
+    def apagar_com_outro_guardando(arquivo):
+        # O outro processo guarda a mesma imagem bem quando a coleta decide apagá-la
+        guardando = threading.Thread(target=_guardar, args=(outro, 'novo'))
+        guardando.start()
+        guardando.join(0.3)
+        apagar(arquivo)
+        # Ainda travado pelo log até a coleta terminar
+        assert guardando.is_alive()
+        depois.append(guardando)
+
+    coletor._apagar_arquivo = apagar_com_outro_guardando
+    coletor.tamanho_maximo = 0
+    assert coletor.coletar() == 1
+    depois[0].join(5)
+
+    # A entrada nova aponta para um arquivo que existe
+    assert outro.buscar('novo', ['modelo'], 30, 7.5, '') == ('modelo', caminho)
+    assert os.path.exists(caminho)
+
+
+def test_acertos_repetidos_nao_gravam_no_log(tmp_path, monkeypatch):
+    cache = CacheImagens(str(tmp_path), intervalo_gc=3600)
+    _guardar(cache, 'gato')
+    tamanho = os.path.getsize(cache.arquivo_indice)
+
+    travas = []
+    travar = cache._travar_log
+    monkeypatch.setattr(cache, '_travar_log', lambda: travas.append(1) or travar())
+    for _ in range(20):
+        assert cache.buscar('gato', ['modelo'], 30, 7.5, '')
+    # Acesso dentro da precisão: nem acréscimo ao log nem flock
+    assert os.path.getsize(cache.arquivo_indice) == tamanho and not travas
+
+    # Passada a precisão, o acesso entra no log (e no LRU)
+    monkeypatch.setattr('funçoes.cache_imagens.CACHE_IMAGENS_PRECISAO_ACESSO', 0)
+    cache.buscar('gato', ['modelo'], 30, 7.5, '')
+    assert os.path.getsize(cache.arquivo_indice) > tamanho
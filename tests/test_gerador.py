@@ -0,0 +1,33 @@
+"""
+Gerador em linha de comando (funçoes/gerador.py) contra o servidor falso
+"""
+
+import uuid
+
+import pytest
+
+from conftest import iniciar_servidor_falso
+from funçoes.saude_modelos import saude_modelos
+
+
+@pytest.fixture
+def gerador(app_atomai, monkeypatch):
+    """O gerador com um servidor falso que responde 200 com um JSON no lugar da imagem"""
+    from funçoes import gerador, provedores
+    falso, url = iniciar_servidor_falso(carregamento=0, latencia=0.01, imagem=b'{"generated_text": "sem imagem"}')
+    monkeypatch.setattr(provedores.huggingface, 'url_base', f'{url}/models/')
+    yield gerador
+    falso.shutdown()
+
+
+def test_resposta_que_nao_e_imagem_conta_como_falha(gerador, tmp_path, monkeypatch):
+    modelo = f'teste/sem-imagem-{uuid.uuid4().hex[:8]}'
+    monkeypatch.setattr(gerador, 'sequencia_modelos', lambda *_: [modelo])
+    diretorio = str(tmp_path)
+
+    assert gerador.gerar_texto('um gato', modelo=modelo, diretorio=diretorio, abrir=False) is None
+    linha = next(linha for linha in saude_modelos.tabela() if linha['modelo'] == modelo)
+    assert linha['falhas'] == 1 and linha['sucessos'] == 0 and linha['ultimo_erro'] == 'imagem inválida'
+    # Nada foi para o cache nem para o disco
+    assert not list(tmp_path.glob('text_*'))
+    assert gerador._cache(diretorio).estatisticas()['entradas'] == 0
@@ -0,0 +1,51 @@
+"""
+Cliente HTTP compartilhado (funçoes/http_cliente.py) contra o servidor falso
+"""
+
+import threading
+import time
+
+import pytest
+import requests
+
+from conftest import iniciar_servidor_falso
+from funçoes import http_cliente
+
+PAYLOAD = {'inputs': 'teste', 'parameters': {'num_inference_steps': 30}}
+
+
+@pytest.fixture
+def url_lento():
+    falso, url = iniciar_servidor_falso(carregamento=0, latencia=5, tamanho_imagem=64)
+    yield url
+    falso.shutdown()
+
+
+def test_interrupcao_abandona_a_espera_pelos_headers(url_lento):
+    interrupcao = http_cliente.Interrupcao()
+    resultado = {}
+
+    def chamar():
+        inicio = time.monotonic()
+        try:
+            http_cliente.post(f'{url_lento}/models/teste/lento', json=PAYLOAD, timeout=30, stream=True, interrupcao=interrupcao)
+        except requests.ConnectionError as erro:
+            resultado['erro'] = erro
+        resultado['segundos'] = time.monotonic() - inicio
+
+    thread = threading.Thread(target=chamar)
+    thread.start()
+    time.sleep(0.3)
+    interrupcao.interromper()
+    thread.join(5)
+    # A thread acorda logo, sem esperar os 5 s do servidor nem repetir a chamada
+    assert not thread.is_alive() and 'erro' in resultado and resultado['segundos'] < 1.5
+    # A conexão fechada não volta para o pool
+    assert http_cliente.get(f'{url_lento}/estado', timeout=5).status_code == 200
+
+
+def test_interrupcao_antes_da_chamada(url_lento):
+    interrupcao = http_cliente.Interrupcao()
+    interrupcao.interromper()
+    with pytest.raises(requests.ConnectionError):
+        http_cliente.post(f'{url_lento}/models/teste/lento', json=PAYLOAD, timeout=30, interrupcao=interrupcao)
@@ -0,0 +1,139 @@
+"""
+Fila de jobs (funçoes/jobs.py) e as rotas /api/jobs/<id>, contra o servidor falso
+"""
+
+import json
+import os
+import threading
+import time
+import uuid
+
+import pytest
+
+from funçoes import jobs
+from funçoes.jobs import FilaJobs, FilaCheia, CONCLUIDO, ERRO, EXECUTANDO, FILA
+
+
+@pytest.fixture
+def fila(tmp_path):
+    # Sem workers: os jobs ficam na fila até o teste reservá-los
+    return FilaJobs(str(tmp_path / 'jobs.sqlite3'), workers=0)
+
+
+def test_limite_por_cliente(fila):
+    for i in range(jobs.JOBS_MAX_POR_CLIENTE):
+        fila.enfileirar('tipo', {'i': i}, 'cliente-a')
+    with pytest.raises(FilaCheia) as erro:
+        fila.enfileirar('tipo', {}, 'cliente-a')
+    assert erro.value.por_cliente
+    # Os outros clientes continuam sendo atendidos
+    fila.enfileirar('tipo', {}, 'cliente-b')
+
+
+def test_fila_maxima(fila):
+    assert jobs.JOBS_MAX_POR_CLIENTE == 3 and jobs.JOBS_FILA_MAXIMA == 100
+    for i in range(jobs.JOBS_FILA_MAXIMA):
+        fila.enfileirar('tipo', {}, f'cliente-{i}')
+    with pytest.raises(FilaCheia) as erro:
+        fila.enfileirar('tipo', {}, 'cliente-novo')
+    assert not erro.value.por_cliente
+    assert fila.estatisticas()[FILA] == jobs.JOBS_FILA_MAXIMA
+
+
+def test_coalescencia_por_chave(fila):
+    primeiro = fila.enfileirar('tipo', {}, 'cliente-a', chave='mesmo-prompt')
+    assert fila.enfileirar('tipo', {}, 'cliente-b', chave='mesmo-prompt') == primeiro
+    assert fila.estatisticas()['coalescidos'] == 1
+
+
+def test_justica_entre_clientes(fila):
+    a = [fila.enfileirar('tipo', {}, 'cliente-a') for _ in range(3)]
+    b = fila.enfileirar('tipo', {}, 'cliente-b')
+    # O mais antigo primeiro; depois o cliente sem nada executando passa à frente dos outros jobs de A
+    assert [fila._reservar()['id'] for _ in range(3)] == [a[0], b, a[1]]
+
+
+def test_job_travado_volta_para_a_fila_depois_de_reiniciar(fila, monkeypatch):
+    monkeypatch.setattr(jobs, 'JOBS_TEMPO_MAXIMO', 0.2)
+    job_id = fila.enfileirar('tipo', {}, 'cliente-a')
+    assert fila._reservar()['id'] == job_id
+    assert fila.consultar(job_id)['estado'] == EXECUTANDO
+
+    # O processo "morreu" com o job executando: outro processo o reserva depois do prazo
+    reiniciada = FilaJobs(fila.caminho_db, workers=0)
+    assert reiniciada._reservar() is None
+    time.sleep(0.3)
+    linha = reiniciada._reservar()
+    assert linha['id'] == job_id and linha['tentativas'] == 1
+
+
+def test_job_travado_vira_erro_depois_das_tentativas(fila, monkeypatch):
+    monkeypatch.setattr(jobs, 'JOBS_TEMPO_MAXIMO', 0.05)
+    job_id = fila.enfileirar('tipo', {}, 'cliente-a')
+    for _ in range(jobs.JOBS_TENTATIVAS):
+        assert fila._reservar()['id'] == job_id
+        time.sleep(0.1)
+    assert fila._reservar() is None
+    assert fila.consultar(job_id)['estado'] == ERRO
+
+
+def test_execucao_com_resultado_parcial(tmp_path):
+    fila = FilaJobs(str(tmp_path / 'jobs.sqlite3'), workers=1)
+    publicado, liberar = threading.Event(), threading.Event()
+
+    def executar(dados, progresso):
+        progresso('Metade', parcial={'rascunho': True})
+        publicado.set()
+        liberar.wait(10)
+        return {'dobro': dados['valor'] * 2}
+
+    fila.registrar('dobrar', executar)
+    job_id = fila.enfileirar('dobrar', {'valor': 21}, 'cliente-a')
+    assert publicado.wait(10)
+    estado = fila.consultar(job_id)
+    assert estado['estado'] == EXECUTANDO and estado['progresso'] == 'Metade'
+    assert estado['parcial'] == {'rascunho': True}
+    liberar.set()
+    estado = _aguardar(fila.consultar, job_id)
+    assert estado['estado'] == CONCLUIDO
+    assert estado['resultado'] == {'dobro': 42}
+
+
+def _aguardar(consultar, job_id, limite=20):
+    fim = time.monotonic() + limite
+    while time.monotonic() < fim:
+        estado = consultar(job_id)
+        if estado['estado'] in jobs.ESTADOS_FINAIS:
+            return estado
+        time.sleep(0.05)
+    raise AssertionError(f'job {job_id} não terminou: {estado}')
+
+
+def _pedir_imagem(cliente):
+    resposta = cliente.post('/api/gerar-imagem', json={'prompt': f'teste da fila {uuid.uuid4().hex}'})
+    assert resposta.status_code == 202, resposta.get_json()
+    corpo = resposta.get_json()
+    assert corpo['estado'] == FILA and corpo['status_url'] == f"/api/jobs/{corpo['job_id']}"
+    return corpo['job_id']
+
+
+def test_rota_de_status_do_job(cliente, app_atomai):
+    job_id = _pedir_imagem(cliente)
+    estado = _aguardar(lambda i: cliente.get(f'/api/jobs/{i}').get_json(), job_id)
+    assert estado['estado'] == CONCLUIDO, estado
+    resultado = estado['resultado']
+    assert resultado['imagem_url'].startswith('/imagens_geradas/') and not resultado.get('fallback')
+    assert os.path.isfile(os.path.join(app_atomai.OUTPUT_DIR, resultado['imagem_url'][len('/imagens_geradas/'):]))
+    assert cliente.get('/api/jobs/nao-existe').status_code == 404
+
+
+def test_eventos_do_job(cliente):
+    job_id = _pedir_imagem(cliente)
+    resposta = cliente.get(f'/api/jobs/{job_id}/eventos')
+    assert resposta.mimetype == 'text/event-stream'
+    eventos = [json.loads(linha[len('data: '):]) for linha in resposta.get_data(as_text=True).splitlines()
+               if linha.startswith('data: ')]
+    # Um evento por mudança de estado, terminando no resultado final
+    assert eventos and all(evento['job_id'] == job_id for evento in eventos)
+    assert all(a != b for a, b in zip(eventos, eventos[1:]))
+    assert eventos[-1]['estado'] == CONCLUIDO and 'imagem_url' in eventos[-1]['resultado']